@@ -238,8 +238,7 @@ def main():
     for feature in features:
         unique_id_to_feature[feature.unique_id] = feature
 
-    model = BertModel.from_pretrained(args.bert_model)
-    model.to(device)
+    model = BertModel.from_pretrained(args.bert_model, device=device)
 
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
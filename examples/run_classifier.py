@@ -20,6 +20,7 @@ from __future__ import print_function
 
 import argparse
 import csv
+import inspect
 import json
 import logging
 import os
@@ -34,7 +35,7 @@ from tqdm import tqdm, trange
 from examples.run_squad import _compute_softmax
 from pytorch_pretrained_bert import BertForSequenceClassification
 from pytorch_pretrained_bert.file_utils import read_jsonl_lines, write_items, TsvIO
-from pytorch_pretrained_bert.modeling import BertForMultipleChoice
+from pytorch_pretrained_bert.modeling import BertForMultipleChoice, CONFIG_NAME
 from pytorch_pretrained_bert.optimization import BertAdam
 from pytorch_pretrained_bert.tokenization import printable_text, convert_to_unicode, BertTokenizer
 
@@ -792,7 +793,7 @@ def accuracy(out, labels):
 
 
 def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
-    """ Utility function for optimize_on_cpu and 16-bits training.
+    """ Utility function for optimize_on_cpu.
         Copy the parameters optimized on CPU/RAM back to the model on GPU
     """
     for (name_opti, param_opti), (name_model, param_model) in zip(named_params_optimizer,
@@ -804,7 +805,7 @@ def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
 
 
 def set_optimizer_params_grad(named_params_optimizer, named_params_model, test_nan=False):
-    """ Utility function for optimize_on_cpu and 16-bits training.
+    """ Utility function for optimize_on_cpu.
         Copy the gradient of the GPU parameters to the CPU/RAMM copy of the model
     """
     is_nan = False
@@ -825,6 +826,21 @@ def set_optimizer_params_grad(named_params_optimizer, named_params_model, test_n
     return is_nan
 
 
+def load_finetuned_model(output_dir, task_name, num_labels, device):
+    """Loads the model fine-tuned on `task_name` saved in `output_dir` by `main`: with `save_pretrained`,
+        or pickled whole in `bert-finetuned.model` by previous versions of this script (`output_dir` may
+        also be the path of this file).
+    """
+    legacy_model_path = output_dir if os.path.isfile(output_dir) else os.path.join(output_dir, "bert-finetuned.model")
+    if not os.path.exists(os.path.join(output_dir, CONFIG_NAME)) and os.path.exists(legacy_model_path):
+        # PyTorch >= 2.6 only unpickles tensors by default
+        load_kwargs = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+        return torch.load(legacy_model_path, map_location=device, **load_kwargs)
+    if task_name == 'bin_anli':
+        return BertForSequenceClassification.from_pretrained(output_dir, num_labels, device=device)
+    return BertForMultipleChoice.from_pretrained(output_dir, num_labels, num_labels, device=device)
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -919,10 +935,24 @@ def main():
     parser.add_argument('--fp16',
                         default=False,
                         action='store_true',
-                        help="Whether to use 16-bit float precision instead of 32-bit")
+                        help="Whether to use float16 mixed precision (autocast with dynamic loss scaling)")
+    parser.add_argument('--bf16',
+                        default=False,
+                        action='store_true',
+                        help="Whether to use bfloat16 mixed precision (autocast, also on recent CPUs)")
     parser.add_argument('--loss_scale',
                         type=float, default=128,
-                        help='Loss scaling, positive power of 2 values can improve fp16 convergence.')
+                        help='Initial loss scale of the dynamic gradient scaler used for fp16 training.')
+    parser.add_argument('--num_frozen_layers',
+                        type=int, default=0,
+                        help="Freeze the embeddings and this many bottom layers of the encoder (0: train them all).")
+    parser.add_argument('--max_shard_size',
+                        type=str, default=None,
+                        help="Split the saved model in shards of at most this size (e.g. 500MB), loaded in parallel.")
+    parser.add_argument('--adapter_size',
+                        type=int, default=None,
+                        help="Fine-tune bottleneck adapters of this size, the LayerNorms and the classifier only. "
+                             "They are also saved apart in adapter_model.bin.")
 
     args = parser.parse_args()
 
@@ -945,12 +975,15 @@ def main():
         n_gpu = 1
         # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.distributed.init_process_group(backend='nccl')
-        if args.fp16:
-            logger.info("16-bits training currently not supported in distributed training")
-            args.fp16 = False  # (see https://github.com/pytorch/pytorch/pull/13496)
     logger.info("device %s n_gpu %d distributed training %r", device, n_gpu,
                 bool(args.local_rank != -1))
 
+    if args.fp16 and args.bf16:
+        raise ValueError("Only one of `fp16` or `bf16` can be used.")
+    if args.fp16 and args.optimize_on_cpu:
+        raise ValueError("`optimize_on_cpu` can't be used with `fp16`: the gradient scaler steps the optimizer "
+                         "of the model parameters.")
+
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
             args.gradient_accumulation_steps))
@@ -991,30 +1024,33 @@ def main():
 
     # Prepare model
     if task_name == 'bin_anli':
-        model = BertForSequenceClassification.from_pretrained(args.bert_model, len(label_list))
+        model = BertForSequenceClassification.from_pretrained(args.bert_model, len(label_list), device=device)
     else:
         model = BertForMultipleChoice.from_pretrained(args.bert_model,
                                                       len(label_list),
-                                                      len(label_list)
+                                                      len(label_list),
+                                                      device=device
                                                       )
-    if args.fp16:
-        model.half()
-    model.to(device)
+    if args.adapter_size is not None:
+        model.add_adapters(args.adapter_size)
+        model.train_adapters_only()
+    if args.num_frozen_layers > 0:
+        model.freeze_layers(args.num_frozen_layers)
+    if args.fp16 or args.bf16:
+        model.set_mixed_precision('fp16' if args.fp16 else 'bf16')
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
                                                           output_device=args.local_rank)
     elif n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
-    # Prepare optimizer
-    if args.fp16:
-        param_optimizer = [(n, param.clone().detach().to('cpu').float().requires_grad_()) \
-                           for n, param in model.named_parameters()]
-    elif args.optimize_on_cpu:
+    # Prepare optimizer, frozen parameters are left out
+    trained_parameters = [(n, param) for n, param in model.named_parameters() if param.requires_grad]
+    if args.optimize_on_cpu:
         param_optimizer = [(n, param.clone().detach().to('cpu').requires_grad_()) \
-                           for n, param in model.named_parameters()]
+                           for n, param in trained_parameters]
     else:
-        param_optimizer = list(model.named_parameters())
+        param_optimizer = trained_parameters
     no_decay = ['bias', 'gamma', 'beta']
     optimizer_grouped_parameters = [
         {'params': [p for n, p in param_optimizer if n not in no_decay], 'weight_decay_rate': 0.01},
@@ -1024,10 +1060,12 @@ def main():
                          lr=args.learning_rate,
                          warmup=args.warmup_proportion,
                          t_total=num_train_steps)
+    # Dynamic loss scaling for fp16: the scale is reduced when gradients overflow (the step is then
+    # skipped) and increased after a series of steps without overflow
+    scaler = torch.cuda.amp.GradScaler(init_scale=args.loss_scale, enabled=args.fp16)
 
     global_step = 0
 
-    model_save_path = os.path.join(args.output_dir, "bert-finetuned.model")
     tr_loss = None
     if args.do_train:
         if task_name.lower().startswith("anli") or task_name.lower().startswith("wsc"):
@@ -1063,39 +1101,35 @@ def main():
                 loss, _ = model(input_ids, segment_ids, input_mask, label_ids)
                 if n_gpu > 1:
                     loss = loss.mean()  # mean() to average on multi-gpu.
-                if args.fp16 and args.loss_scale != 1.0:
-                    # rescale loss for fp16 training
-                    # see https://docs.nvidia.com/deeplearning/sdk/mixed-precision-training/index.html
-                    loss = loss * args.loss_scale
                 if args.gradient_accumulation_steps > 1:
                     loss = loss / args.gradient_accumulation_steps
-                loss.backward()
+                scaler.scale(loss).backward()
                 tr_loss += loss.item()
                 nb_tr_examples += input_ids.size(0)
                 nb_tr_steps += 1
                 if (step + 1) % args.gradient_accumulation_steps == 0:
-                    if args.fp16 or args.optimize_on_cpu:
-                        if args.fp16 and args.loss_scale != 1.0:
-                            # scale down gradients for fp16 training
-                            for param in model.parameters():
-                                param.grad.data = param.grad.data / args.loss_scale
+                    if args.optimize_on_cpu:
                         is_nan = set_optimizer_params_grad(param_optimizer,
-                                                           model.named_parameters(), test_nan=True)
+                                                           trained_parameters, test_nan=True)
                         if is_nan:
-                            logger.info("FP16 TRAINING: Nan in gradients, reducing loss scaling")
-                            args.loss_scale = args.loss_scale / 2
+                            logger.info("Nan in gradients, skipping the update")
                             model.zero_grad()
                             continue
                         optimizer.step()
-                        copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
+                        copy_optimizer_params_to_model(trained_parameters, param_optimizer)
                     else:
-                        optimizer.step()
+                        # Gradients are unscaled before the step, which is skipped if they overflowed
+                        scaler.step(optimizer)
+                        scaler.update()
                     model.zero_grad()
                     global_step += 1
                 status_tqdm.set_description_str("Iteration / Training Loss: {}".format((tr_loss /
                                                                                         nb_tr_examples)))
 
-        torch.save(model, model_save_path)
+        model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
+        model_to_save.save_pretrained(args.output_dir, max_shard_size=args.max_shard_size)
+        if args.adapter_size is not None:
+            model_to_save.save_adapters(os.path.join(args.output_dir, "adapter_model.bin"))
 
     if args.do_eval:
         if args.do_predict and args.input_file_for_pred is not None:
@@ -1123,8 +1157,10 @@ def main():
         eval_dataloader = DataLoader(eval_data, sampler=eval_sampler,
                                      batch_size=args.eval_batch_size)
 
-        logger.info("***** Loading model from: {} *****".format(model_save_path))
-        model = torch.load(model_save_path)
+        logger.info("***** Loading model from: {} *****".format(args.output_dir))
+        model = load_finetuned_model(args.output_dir, task_name, len(label_list), device)
+        if args.fp16 or args.bf16:
+            model.set_mixed_precision('fp16' if args.fp16 else 'bf16')
 
         model.eval()
         eval_loss, eval_accuracy = 0, 0
@@ -1133,7 +1169,7 @@ def main():
         eval_predictions = []
         eval_pred_probs = []
 
-        logger.info("***** Predicting ... *****".format(model_save_path))
+        logger.info("***** Predicting ... *****")
 
         for input_ids, input_mask, segment_ids, label_ids in tqdm(eval_dataloader):
             input_ids = input_ids.to(device)
@@ -0,0 +1,174 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Distillation of a fine-tuned BERT classifier into a smaller student."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+
+from examples.run_classifier import (AnliProcessor, AnliProcessor3Option, AnliWithCSKProcessor, WSCProcessor,
+                                     BinaryAnli, convert_examples_to_features, convert_examples_to_features_mc,
+                                     load_finetuned_model)
+from pytorch_pretrained_bert.distillation import create_student, TeacherOutputCache, DistillationLoss, distill
+from pytorch_pretrained_bert.optimization import BertAdam
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    ## Required parameters
+    parser.add_argument("--data_dir", default=None, type=str, required=True,
+                        help="The input data dir. Should contain the .tsv files (or other data files) for the task.")
+    parser.add_argument("--bert_model", default=None, type=str, required=True,
+                        help="Bert pre-trained model used for the vocabulary, e.g. bert-base-uncased.")
+    parser.add_argument("--teacher_model", default=None, type=str, required=True,
+                        help="The output directory of the fine-tuned teacher, as saved by `run_classifier.py`.")
+    parser.add_argument("--task_name", default=None, type=str, required=True,
+                        help="The name of the task to train.")
+    parser.add_argument("--output_dir", default=None, type=str, required=True,
+                        help="The output directory where the student will be written.")
+
+    ## Other parameters
+    parser.add_argument("--student_num_layers", default=6, type=int,
+                        help="Number of layers of the student.")
+    parser.add_argument("--student_hidden_size", default=None, type=int,
+                        help="Hidden size of the student. Default: the hidden size of the teacher.")
+    parser.add_argument("--teacher_cache_dir", default=None, type=str,
+                        help="Where to cache the teacher outputs. Default: `output_dir`/teacher_cache.")
+    parser.add_argument("--temperature", default=2.0, type=float,
+                        help="Softmax temperature of the soft targets.")
+    parser.add_argument("--alpha", default=0.5, type=float,
+                        help="Weight of the soft targets loss, (1 - alpha) is the weight of the hard labels loss.")
+    parser.add_argument("--hidden_weight", default=0.0, type=float,
+                        help="Weight of the hidden states loss.")
+    parser.add_argument("--attention_weight", default=0.0, type=float,
+                        help="Weight of the attention probabilities loss.")
+    parser.add_argument("--max_seq_length", default=128, type=int,
+                        help="The maximum total input sequence length after WordPiece tokenization.")
+    parser.add_argument("--train_batch_size", default=32, type=int,
+                        help="Total batch size for training.")
+    parser.add_argument("--learning_rate", default=5e-5, type=float,
+                        help="The initial learning rate for Adam.")
+    parser.add_argument("--num_train_epochs", default=3.0, type=float,
+                        help="Total number of training epochs to perform.")
+    parser.add_argument("--warmup_proportion", default=0.1, type=float,
+                        help="Proportion of training to perform linear learning rate warmup for.")
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=1,
+                        help="Number of updates steps to accumualte before performing a backward/update pass.")
+    parser.add_argument("--no_cuda", default=False, action='store_true',
+                        help="Whether not to use CUDA when available")
+    parser.add_argument('--seed', type=int, default=42,
+                        help="random seed for initialization")
+
+    args = parser.parse_args()
+
+    processors = {
+        "anli": AnliProcessor,
+        "anli3": AnliProcessor3Option,
+        'anli_csk': AnliWithCSKProcessor,
+        'bin_anli': BinaryAnli,
+        'wsc': WSCProcessor
+    }
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    task_name = args.task_name.lower()
+    if task_name not in processors:
+        raise ValueError("Task not found: %s" % (task_name))
+    processor = processors[task_name]()
+    label_list = processor.get_labels()
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    train_examples = processor.get_train_examples(args.data_dir)
+    if task_name.startswith("anli") or task_name.startswith("wsc"):
+        train_features = convert_examples_to_features_mc(
+            train_examples, label_list, args.max_seq_length, tokenizer)
+    else:
+        train_features = convert_examples_to_features(
+            train_examples, label_list, args.max_seq_length, tokenizer)
+    train_data = TensorDataset(torch.tensor([f.input_ids for f in train_features], dtype=torch.long),
+                               torch.tensor([f.input_mask for f in train_features], dtype=torch.long),
+                               torch.tensor([f.segment_ids for f in train_features], dtype=torch.long),
+                               torch.tensor([f.label_id for f in train_features], dtype=torch.long))
+
+    teacher = load_finetuned_model(args.teacher_model, task_name, len(label_list), device)
+    if task_name == 'bin_anli':
+        student, layer_map = create_student(teacher, args.student_num_layers, len(label_list),
+                                            hidden_size=args.student_hidden_size)
+    else:
+        student, layer_map = create_student(teacher, args.student_num_layers, len(label_list), len(label_list),
+                                            hidden_size=args.student_hidden_size)
+    student.to(device)
+    logger.info("Student layers initialized from teacher layers {}".format(layer_map))
+
+    # The teacher runs once over the training set, its outputs are then read from disk at every epoch
+    cache_dir = args.teacher_cache_dir or os.path.join(args.output_dir, "teacher_cache")
+    if os.path.exists(os.path.join(cache_dir, "cache_info.json")):
+        teacher_cache = TeacherOutputCache(cache_dir)
+    else:
+        teacher_cache = TeacherOutputCache.build(
+            teacher, train_data, cache_dir,
+            hidden_layers=layer_map if args.hidden_weight > 0 else (),
+            attention_layers=layer_map if args.attention_weight > 0 else (),
+            batch_size=args.train_batch_size, device=device)
+    teacher_config = teacher.config
+    del teacher
+
+    distillation_loss = DistillationLoss(student.config, teacher_config,
+                                         temperature=args.temperature, alpha=args.alpha,
+                                         hidden_weight=args.hidden_weight,
+                                         attention_weight=args.attention_weight).to(device)
+    train_batch_size = int(args.train_batch_size / args.gradient_accumulation_steps)
+    num_train_steps = int(len(train_data) / train_batch_size / args.gradient_accumulation_steps *
+                          args.num_train_epochs)
+    param_optimizer = list(student.named_parameters()) + list(distillation_loss.named_parameters())
+    no_decay = ['bias', 'gamma', 'beta']
+    optimizer_grouped_parameters = [
+        {'params': [p for n, p in param_optimizer if n not in no_decay], 'weight_decay_rate': 0.01},
+        {'params': [p for n, p in param_optimizer if n in no_decay], 'weight_decay_rate': 0.0}
+    ]
+    optimizer = BertAdam(optimizer_grouped_parameters,
+                         lr=args.learning_rate,
+                         warmup=args.warmup_proportion,
+                         t_total=num_train_steps)
+
+    distill(student, teacher_cache, train_data, distillation_loss, optimizer, layer_map,
+            num_train_epochs=args.num_train_epochs, batch_size=train_batch_size,
+            gradient_accumulation_steps=args.gradient_accumulation_steps, device=device)
+    student.save_pretrained(args.output_dir)
+    logger.info("Student saved in {}".format(args.output_dir))
+
+
+if __name__ == "__main__":
+    main()
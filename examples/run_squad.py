@@ -668,8 +668,15 @@ def _compute_softmax(scores):
         probs.append(score / total_sum)
     return probs
 
+def question_global_attention_mask(input_mask, segment_ids):
+    """ Attention mask of local attention (see `BertSelfAttention.local_attention`): the [CLS] token, the
+        question and the first [SEP] (segment 0) are global tokens (2), the document tokens are local (1).
+    """
+    return input_mask * (2 - segment_ids)
+
+
 def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
-    """ Utility function for optimize_on_cpu and 16-bits training.
+    """ Utility function for optimize_on_cpu.
         Copy the parameters optimized on CPU/RAM back to the model on GPU
     """
     for (name_opti, param_opti), (name_model, param_model) in zip(named_params_optimizer, named_params_model):
@@ -679,7 +686,7 @@ def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
         param_model.data.copy_(param_opti.data)
 
 def set_optimizer_params_grad(named_params_optimizer, named_params_model, test_nan=False):
-    """ Utility function for optimize_on_cpu and 16-bits training.
+    """ Utility function for optimize_on_cpu.
         Copy the gradient of the GPU parameters to the CPU/RAMM copy of the model
     """
     is_nan = False
@@ -716,6 +723,10 @@ def main():
                              "longer than this will be truncated, and sequences shorter than this will be padded.")
     parser.add_argument("--doc_stride", default=128, type=int,
                         help="When splitting up a long document into chunks, how much stride to take between chunks.")
+    parser.add_argument("--attention_window", default=None, type=int,
+                        help="Use local attention over this many tokens on each side, with the question as global "
+                             "tokens, so that long documents can be encoded in one `max_seq_length` sequence. "
+                             "The position embeddings are extended to `max_seq_length` if needed.")
     parser.add_argument("--max_query_length", default=64, type=int,
                         help="The maximum number of tokens for the question. Questions longer than this will "
                              "be truncated to this length.")
@@ -761,10 +772,17 @@ def main():
     parser.add_argument('--fp16',
                         default=False,
                         action='store_true',
-                        help="Whether to use 16-bit float precision instead of 32-bit")
+                        help="Whether to use float16 mixed precision (autocast with dynamic loss scaling)")
+    parser.add_argument('--bf16',
+                        default=False,
+                        action='store_true',
+                        help="Whether to use bfloat16 mixed precision (autocast, also on recent CPUs)")
     parser.add_argument('--loss_scale',
                         type=float, default=128,
-                        help='Loss scaling, positive power of 2 values can improve fp16 convergence.')
+                        help='Initial loss scale of the dynamic gradient scaler used for fp16 training.')
+    parser.add_argument('--num_frozen_layers',
+                        type=int, default=0,
+                        help="Freeze the embeddings and this many bottom layers of the encoder (0: train them all).")
 
     args = parser.parse_args()
 
@@ -776,11 +794,14 @@ def main():
         n_gpu = 1
         # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.distributed.init_process_group(backend='nccl')
-        if args.fp16:
-            logger.info("16-bits training currently not supported in distributed training")
-            args.fp16 = False # (see https://github.com/pytorch/pytorch/pull/13496)
-    logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits trainiing: {}".format(
-        device, n_gpu, bool(args.local_rank != -1), args.fp16))
+    logger.info("device: {} n_gpu: {}, distributed training: {}, mixed precision: {}".format(
+        device, n_gpu, bool(args.local_rank != -1), 'fp16' if args.fp16 else 'bf16' if args.bf16 else None))
+
+    if args.fp16 and args.bf16:
+        raise ValueError("Only one of `fp16` or `bf16` can be used.")
+    if args.fp16 and args.optimize_on_cpu:
+        raise ValueError("`optimize_on_cpu` can't be used with `fp16`: the gradient scaler steps the optimizer "
+                         "of the model parameters.")
 
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
@@ -821,25 +842,26 @@ def main():
             len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
 
     # Prepare model
-    model = BertForQuestionAnswering.from_pretrained(args.bert_model)
-    if args.fp16:
-        model.half()
-    model.to(device)
+    model = BertForQuestionAnswering.from_pretrained(args.bert_model, device=device)
+    if args.attention_window is not None:
+        model.set_attention_window(args.attention_window, max_position_embeddings=args.max_seq_length)
+    if args.num_frozen_layers > 0:
+        model.freeze_layers(args.num_frozen_layers)
+    if args.fp16 or args.bf16:
+        model.set_mixed_precision('fp16' if args.fp16 else 'bf16')
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
                                                           output_device=args.local_rank)
     elif n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
-    # Prepare optimizer
-    if args.fp16:
-        param_optimizer = [(n, param.clone().detach().to('cpu').float().requires_grad_()) \
-                            for n, param in model.named_parameters()]
-    elif args.optimize_on_cpu:
+    # Prepare optimizer, frozen parameters are left out
+    trained_parameters = [(n, param) for n, param in model.named_parameters() if param.requires_grad]
+    if args.optimize_on_cpu:
         param_optimizer = [(n, param.clone().detach().to('cpu').requires_grad_()) \
-                            for n, param in model.named_parameters()]
+                           for n, param in trained_parameters]
     else:
-        param_optimizer = list(model.named_parameters())
+        param_optimizer = trained_parameters
     no_decay = ['bias', 'gamma', 'beta']
     optimizer_grouped_parameters = [
         {'params': [p for n, p in param_optimizer if n not in no_decay], 'weight_decay_rate': 0.01},
@@ -849,6 +871,9 @@ def main():
                          lr=args.learning_rate,
                          warmup=args.warmup_proportion,
                          t_total=num_train_steps)
+    # Dynamic loss scaling for fp16: the scale is reduced when gradients overflow (the step is then
+    # skipped) and increased after a series of steps without overflow
+    scaler = torch.cuda.amp.GradScaler(init_scale=args.loss_scale, enabled=args.fp16)
 
     global_step = 0
     if args.do_train:
@@ -883,32 +908,27 @@ def main():
                 if n_gpu == 1:
                     batch = tuple(t.to(device) for t in batch) # multi-gpu does scattering it-self
                 input_ids, input_mask, segment_ids, start_positions, end_positions = batch
+                if args.attention_window is not None:
+                    input_mask = question_global_attention_mask(input_mask, segment_ids)
                 loss = model(input_ids, segment_ids, input_mask, start_positions, end_positions)
                 if n_gpu > 1:
                     loss = loss.mean() # mean() to average on multi-gpu.
-                if args.fp16 and args.loss_scale != 1.0:
-                    # rescale loss for fp16 training
-                    # see https://docs.nvidia.com/deeplearning/sdk/mixed-precision-training/index.html
-                    loss = loss * args.loss_scale
                 if args.gradient_accumulation_steps > 1:
                     loss = loss / args.gradient_accumulation_steps
-                loss.backward()
+                scaler.scale(loss).backward()
                 if (step + 1) % args.gradient_accumulation_steps == 0:
-                    if args.fp16 or args.optimize_on_cpu:
-                        if args.fp16 and args.loss_scale != 1.0:
-                            # scale down gradients for fp16 training
-                            for param in model.parameters():
-                                param.grad.data = param.grad.data / args.loss_scale
-                        is_nan = set_optimizer_params_grad(param_optimizer, model.named_parameters(), test_nan=True)
+                    if args.optimize_on_cpu:
+                        is_nan = set_optimizer_params_grad(param_optimizer, trained_parameters, test_nan=True)
                         if is_nan:
-                            logger.info("FP16 TRAINING: Nan in gradients, reducing loss scaling")
-                            args.loss_scale = args.loss_scale / 2
+                            logger.info("Nan in gradients, skipping the update")
                             model.zero_grad()
                             continue
                         optimizer.step()
-                        copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
+                        copy_optimizer_params_to_model(trained_parameters, param_optimizer)
                     else:
-                        optimizer.step()
+                        # Gradients are unscaled before the step, which is skipped if they overflowed
+                        scaler.step(optimizer)
+                        scaler.update()
                     model.zero_grad()
                     global_step += 1
 
@@ -948,6 +968,8 @@ def main():
             input_ids = input_ids.to(device)
             input_mask = input_mask.to(device)
             segment_ids = segment_ids.to(device)
+            if args.attention_window is not None:
+                input_mask = question_global_attention_mask(input_mask, segment_ids)
             with torch.no_grad():
                 batch_start_logits, batch_end_logits = model(input_ids, segment_ids, input_mask)
             for i, example_index in enumerate(example_indices):
@@ -1,5 +1,6 @@
 from .tokenization import BertTokenizer, BasicTokenizer, WordpieceTokenizer
 from .modeling import (BertConfig, BertModel, BertForPreTraining,
                        BertForMaskedLM, BertForNextSentencePrediction,
-                       BertForSequenceClassification, BertForQuestionAnswering)
+                       BertForSequenceClassification, BertForQuestionAnswering,
+                       BertForLongDocumentClassification, BertMultiTask)
 from .optimization import BertAdam
@@ -0,0 +1,175 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Low-rank factorization of the linear layers of BERT models."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+import torch
+from torch import nn
+
+from .modeling import BertSelfAttention, BertIntermediate, BertOutput, set_module, benchmark_latency
+
+logger = logging.getLogger(__name__)
+
+FACTORIZABLE_MODULES = (BertSelfAttention, BertIntermediate, BertOutput)
+
+
+class LowRankLinear(nn.Module):
+    """ A rank-`rank` factorization of a `nn.Linear`: a projection to `rank` dimensions (`first`, without bias)
+        followed by a projection to `out_features` (`second`).
+    """
+    def __init__(self, in_features, out_features, rank, bias=True):
+        super(LowRankLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.first = nn.Linear(in_features, rank, bias=False)
+        self.second = nn.Linear(rank, out_features, bias=bias)
+
+    @classmethod
+    def from_linear(cls, linear, rank):
+        """ Initializes the factorization with the truncated SVD of the weight of `linear`. """
+        module = cls(linear.in_features, linear.out_features, rank, bias=linear.bias is not None)
+        module = module.to(device=linear.weight.device)
+        u, s, vh = _svd(linear.weight.data.float())
+        sqrt_s = s[:rank].sqrt()
+        with torch.no_grad():
+            module.first.weight.copy_(sqrt_s.unsqueeze(1) * vh[:rank])
+            module.second.weight.copy_(u[:, :rank] * sqrt_s.unsqueeze(0))
+            if linear.bias is not None:
+                module.second.bias.copy_(linear.bias)
+        return module.to(dtype=linear.weight.dtype)
+
+    def forward(self, x):
+        return self.second(self.first(x))
+
+    def extra_repr(self):
+        return 'in_features={}, out_features={}, rank={}'.format(self.in_features, self.out_features, self.rank)
+
+
+def _svd(weight):
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'svd'):
+        return torch.linalg.svd(weight, full_matrices=False)
+    u, s, v = torch.svd(weight)
+    return u, s, v.t()
+
+
+def factorizable_linear_names(model):
+    """ Names of the `nn.Linear` layers of `BertSelfAttention`, `BertIntermediate` and `BertOutput`. """
+    names = []
+    for module_name, module in model.named_modules():
+        if isinstance(module, FACTORIZABLE_MODULES):
+            for child_name, child in module.named_children():
+                if isinstance(child, nn.Linear):
+                    names.append(module_name + '.' + child_name)
+    return names
+
+
+def select_rank(weight, energy=None, param_ratio=None):
+    """ Selects the rank of the factorization of `weight` ([out_features, in_features]), either
+        - the smallest rank keeping an `energy` fraction of the sum of the squared singular values, or
+        - the largest rank using at most a `param_ratio` fraction of the parameters of `weight`.
+    """
+    if (energy is None) == (param_ratio is None):
+        raise ValueError("Exactly one of `energy` or `param_ratio` must be set.")
+    out_features, in_features = weight.size()
+    if param_ratio is not None:
+        return max(1, int(param_ratio * out_features * in_features / (out_features + in_features)))
+    _, s, _ = _svd(weight.float())
+    cumulative_energy = (s ** 2).cumsum(0) / (s ** 2).sum()
+    return int((cumulative_energy < energy).sum().item()) + 1
+
+
+def factorize_linear_layers(model, energy=None, param_ratio=None, names=None):
+    """ Replaces `nn.Linear` layers of `BertSelfAttention`, `BertIntermediate` and `BertOutput` by
+        `LowRankLinear` layers initialized by truncated SVD of the pretrained weights.
+
+        Layers for which the selected rank would not reduce the number of parameters are kept.
+        The ranks are recorded in `model.config.low_rank` so that the model saved with `save_pretrained`
+        is rebuilt with the same shapes by `from_pretrained`.
+
+    Params:
+        model: a `PreTrainedBertModel` instance.
+        energy, param_ratio: rank selection budget, see `select_rank`.
+        names: optional list of the layers to factorize. Default: `factorizable_linear_names(model)`.
+
+    Returns a dict {layer name: rank} of the factorized layers.
+    """
+    modules = dict(model.named_modules())
+    ranks = {}
+    for name in (names if names is not None else factorizable_linear_names(model)):
+        linear = modules[name]
+        rank = select_rank(linear.weight.data, energy=energy, param_ratio=param_ratio)
+        if rank * (linear.in_features + linear.out_features) >= linear.in_features * linear.out_features:
+            continue
+        set_module(model, name, LowRankLinear.from_linear(linear, rank))
+        ranks[name] = rank
+    low_rank = getattr(model.config, 'low_rank', None) or {}
+    low_rank.update(ranks)
+    model.config.low_rank = low_rank
+    logger.info("Factorized {} linear layers".format(len(ranks)))
+    return ranks
+
+
+def convert_to_low_rank_structure(model, low_rank):
+    """ Replaces the layers listed in a `config.low_rank` description by `LowRankLinear` layers of the
+        recorded ranks, so that a factorized state_dict can be loaded in `model`. Used by `from_pretrained`.
+    """
+    modules = dict(model.named_modules())
+    for saved_name, rank in low_rank.items():
+        name = saved_name
+        # Checkpoints saved from a model with a head can be loaded in a `BertModel` (without `bert.` prefix)
+        if name not in modules and name.startswith('bert.'):
+            name = name[len('bert.'):]
+        if name not in modules:
+            continue
+        linear = modules[name]
+        set_module(model, name, LowRankLinear(linear.in_features, linear.out_features, rank,
+                                              bias=linear.bias is not None))
+    return model
+
+
+def count_linear_flops(model, seq_length):
+    """ Multiply-accumulate operations of the linear layers of the encoder for one sequence of
+        `seq_length` tokens (attention score computations are not included).
+    """
+    encoder = getattr(model, 'bert', model).encoder
+    return sum(module.in_features * module.out_features * seq_length
+               for module in encoder.modules() if isinstance(module, nn.Linear))
+
+
+def compression_report(model, compressed_model, input_ids, token_type_ids=None, attention_mask=None, num_runs=20):
+    """ Compares the number of parameters, linear layers FLOPs and latency of a model and its compressed
+        version. Returns a dict of the measures and their reduction ratios.
+    """
+    seq_length = input_ids.size(-1)
+    report = {
+        'params': sum(p.numel() for p in model.parameters()),
+        'compressed_params': sum(p.numel() for p in compressed_model.parameters()),
+        'flops': count_linear_flops(model, seq_length),
+        'compressed_flops': count_linear_flops(compressed_model, seq_length),
+        'latency': benchmark_latency(model, input_ids, token_type_ids, attention_mask, num_runs=num_runs),
+        'compressed_latency': benchmark_latency(compressed_model, input_ids, token_type_ids, attention_mask,
+                                                num_runs=num_runs),
+    }
+    report['flops_reduction'] = 1.0 - report['compressed_flops'] / report['flops']
+    report['params_reduction'] = 1.0 - report['compressed_params'] / report['params']
+    report['speedup'] = report['latency'] / report['compressed_latency']
+    logger.info("Compression report: {}".format(report))
+    return report
@@ -0,0 +1,347 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Knowledge distillation of fine-tuned BERT models into smaller students."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import json
+import logging
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from tqdm import tqdm, trange
+
+from .modeling import BertConfig
+
+logger = logging.getLogger(__name__)
+
+CACHE_INFO_NAME = 'cache_info.json'
+CACHE_LOGITS_NAME = 'teacher_logits.pt'
+
+
+def uniform_layer_map(num_student_layers, num_teacher_layers):
+    """ Maps each student layer to a teacher layer, taking the last layer of each block of
+        teacher layers (e.g. 12 -> 4 layers: [2, 5, 8, 11]).
+    """
+    return [(i + 1) * num_teacher_layers // num_student_layers - 1 for i in range(num_student_layers)]
+
+
+def make_student_config(teacher_config, num_hidden_layers, layer_map=None, hidden_size=None,
+                        num_attention_heads=None, intermediate_size=None):
+    """ Builds the `BertConfig` of a student with fewer layers and/or a smaller hidden size.
+        Per-layer settings of the teacher (pruned heads, feed-forward sizes) follow `layer_map`.
+    """
+    if layer_map is None:
+        layer_map = uniform_layer_map(num_hidden_layers, teacher_config.num_hidden_layers)
+    if len(layer_map) != num_hidden_layers:
+        raise ValueError("layer_map should have one teacher layer per student layer")
+    config = BertConfig.from_dict(teacher_config.to_dict())
+    config.__dict__.pop('quantization', None)
+    config.num_hidden_layers = num_hidden_layers
+    if isinstance(config.intermediate_size, list):
+        config.intermediate_size = [config.intermediate_size[j] for j in layer_map]
+    pruned_heads = getattr(config, 'pruned_heads', None) or {}
+    config.pruned_heads = dict((str(i), pruned_heads[str(j)])
+                               for i, j in enumerate(layer_map) if str(j) in pruned_heads)
+    if hidden_size is not None and hidden_size != teacher_config.hidden_size:
+        # Per-layer teacher settings do not apply to a narrower student
+        config.hidden_size = hidden_size
+        config.pruned_heads = {}
+        config.intermediate_size = 4 * hidden_size
+    if num_attention_heads is not None:
+        config.num_attention_heads = num_attention_heads
+    if intermediate_size is not None:
+        config.intermediate_size = intermediate_size
+    return config
+
+
+def _teacher_parameter_name(name, layer_map):
+    match = re.match(r'(.*encoder\.layer\.)(\d+)(\..*)', name)
+    if match is None:
+        return name
+    return match.group(1) + str(layer_map[int(match.group(2))]) + match.group(3)
+
+
+def init_student_from_teacher(student, teacher, layer_map):
+    """ Copies in `student` the teacher weights of the layers selected by `layer_map`, together with
+        the embeddings, pooler and task head. Weights whose shape differ (e.g. smaller hidden size)
+        keep their random initialization.
+    """
+    teacher_state = teacher.state_dict()
+    skipped = []
+    with torch.no_grad():
+        for name, tensor in student.state_dict().items():
+            teacher_name = _teacher_parameter_name(name, layer_map)
+            if teacher_name in teacher_state and teacher_state[teacher_name].size() == tensor.size():
+                tensor.copy_(teacher_state[teacher_name])
+            else:
+                skipped.append(name)
+    if len(skipped) > 0:
+        logger.info("Weights of the student not initialized from the teacher: {}".format(skipped))
+    return student
+
+
+def create_student(teacher, num_hidden_layers, *inputs, layer_map=None, hidden_size=None,
+                   num_attention_heads=None, intermediate_size=None, **kwargs):
+    """ Instantiates a student of the same class as `teacher` with `num_hidden_layers` layers,
+        initialized from the teacher layers selected by `layer_map` (default: `uniform_layer_map`).
+        *inputs, **kwargs: additional input for the specific Bert class (ex: num_labels).
+    Returns a tuple (student, layer_map).
+    """
+    if layer_map is None:
+        layer_map = uniform_layer_map(num_hidden_layers, teacher.config.num_hidden_layers)
+    config = make_student_config(teacher.config, num_hidden_layers, layer_map, hidden_size=hidden_size,
+                                 num_attention_heads=num_attention_heads, intermediate_size=intermediate_size)
+    student = teacher.__class__(config, *inputs, **kwargs)
+    if config.pruned_heads:
+        student.prune_heads(config.pruned_heads)
+    init_student_from_teacher(student, teacher, layer_map)
+    return student, layer_map
+
+
+class _InternalsRecorder(object):
+    """ Records the output of each `BertLayer` and the attention probabilities of each layer
+        (the input of the attention dropout) during a forward pass.
+    """
+    def __init__(self, model, hidden_states=False, attentions=False):
+        self.hidden_states = {}
+        self.attentions = {}
+        self.hooks = []
+        layers = getattr(model, 'bert', model).encoder.layer
+        for layer_num, layer in enumerate(layers):
+            if hidden_states:
+                self.hooks.append(layer.register_forward_hook(self._make_hook(self.hidden_states, layer_num)))
+            if attentions:
+                self.hooks.append(layer.attention.self.dropout.register_forward_hook(
+                    self._make_hook(self.attentions, layer_num, use_input=True)))
+
+    @staticmethod
+    def _make_hook(records, layer_num, use_input=False):
+        def hook(module, inputs, output):
+            records[layer_num] = inputs[0] if use_input else output
+        return hook
+
+    def remove(self):
+        for hook in self.hooks:
+            hook.remove()
+
+
+def _logits(model, input_ids, input_mask, segment_ids):
+    logits = model(input_ids, segment_ids, input_mask)
+    # BertForMultipleChoice returns [batch_size * num_options, 1] logits
+    return logits.view(input_ids.size(0), -1)
+
+
+class TeacherOutputCache(object):
+    """ Teacher outputs computed once over a training set and stored on disk in `cache_dir`:
+        the logits (`teacher_logits.pt`) and, optionally, the hidden states and attention probabilities
+        of selected layers as float16 numpy memory maps read per example during training.
+        Note that hidden states take num_examples * sequence_length * hidden_size * 2 bytes per layer.
+    """
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, CACHE_INFO_NAME), 'r') as reader:
+            info = json.loads(reader.read())
+        self.num_examples = info['num_examples']
+        self.logits = torch.load(os.path.join(cache_dir, CACHE_LOGITS_NAME))
+        self._hidden_states = dict((int(layer), np.load(os.path.join(cache_dir, filename), mmap_mode='r'))
+                                   for layer, filename in info['hidden_states'].items())
+        self._attentions = dict((int(layer), np.load(os.path.join(cache_dir, filename), mmap_mode='r'))
+                                for layer, filename in info['attentions'].items())
+
+    @classmethod
+    def build(cls, teacher, dataset, cache_dir, hidden_layers=(), attention_layers=(), batch_size=32, device='cpu'):
+        """ Runs the teacher once over `dataset` (a `TensorDataset` of input_ids, input_mask, segment_ids, ...)
+            and writes its outputs to `cache_dir`.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        num_examples = len(dataset)
+        dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size)
+        recorder = _InternalsRecorder(teacher, hidden_states=len(hidden_layers) > 0,
+                                      attentions=len(attention_layers) > 0)
+        info = {'num_examples': num_examples, 'hidden_states': {}, 'attentions': {}}
+        memmaps = {}
+
+        def write(kind, layer, start, batch_size, tensor):
+            # One flattened row per example (e.g. all the options of a multiple choice example)
+            tensor = tensor.contiguous().view(batch_size, -1)
+            if (kind, layer) not in memmaps:
+                filename = 'teacher_{}_{}.npy'.format(kind, layer)
+                info[kind][str(layer)] = filename
+                memmaps[(kind, layer)] = np.lib.format.open_memmap(
+                    os.path.join(cache_dir, filename), mode='w+', dtype=np.float16,
+                    shape=(num_examples, tensor.size(1)))
+            memmaps[(kind, layer)][start:start + tensor.size(0)] = tensor.cpu().numpy().astype(np.float16)
+
+        teacher.eval()
+        all_logits = []
+        start = 0
+        try:
+            for batch in tqdm(dataloader, desc="Teacher forward"):
+                input_ids, input_mask, segment_ids = tuple(t.to(device) for t in batch[:3])
+                with torch.no_grad():
+                    all_logits.append(_logits(teacher, input_ids, input_mask, segment_ids).float().cpu())
+                for layer in hidden_layers:
+                    write('hidden_states', layer, start, input_ids.size(0), recorder.hidden_states[layer])
+                for layer in attention_layers:
+                    write('attentions', layer, start, input_ids.size(0), recorder.attentions[layer])
+                start += input_ids.size(0)
+        finally:
+            recorder.remove()
+        for memmap in memmaps.values():
+            memmap.flush()
+        torch.save(torch.cat(all_logits, dim=0), os.path.join(cache_dir, CACHE_LOGITS_NAME))
+        with open(os.path.join(cache_dir, CACHE_INFO_NAME), 'w') as writer:
+            writer.write(json.dumps(info, indent=2, sort_keys=True) + "\n")
+        return cls(cache_dir)
+
+    def _read(self, memmaps, layer, indices):
+        rows = memmaps[layer][np.sort(indices.cpu().numpy())]
+        # Restore the batch order
+        order = np.argsort(np.argsort(indices.cpu().numpy()))
+        return torch.from_numpy(rows[order].astype(np.float32))
+
+    def hidden_states(self, layer, indices):
+        return self._read(self._hidden_states, layer, indices)
+
+    def attentions(self, layer, indices):
+        return self._read(self._attentions, layer, indices)
+
+    @property
+    def hidden_layers(self):
+        return sorted(self._hidden_states.keys())
+
+    @property
+    def attention_layers(self):
+        return sorted(self._attentions.keys())
+
+
+class DistillationLoss(nn.Module):
+    """ Distillation objective: soft cross-entropy with the teacher logits at temperature `temperature`,
+        optionally mixed with the hard-label loss and mean squared errors on the hidden states and
+        attention probabilities of the layers in `layer_map`.
+
+    Params:
+        student_config, teacher_config: the `BertConfig` of the student and of the teacher.
+        temperature: softmax temperature of the soft targets. Default: 2.0.
+        alpha: weight of the soft loss, (1 - alpha) being the weight of the hard-label loss. Default: 0.5.
+        hidden_weight: weight of the hidden states loss. A trainable projection is added when the
+            student hidden size differs from the teacher's (its parameters must be optimized too). Default: 0.
+        attention_weight: weight of the attention loss. Attention probabilities are averaged over
+            heads when the number of heads differ. Default: 0.
+    """
+    def __init__(self, student_config, teacher_config, temperature=2.0, alpha=0.5,
+                 hidden_weight=0.0, attention_weight=0.0):
+        super(DistillationLoss, self).__init__()
+        self.temperature = temperature
+        self.alpha = alpha
+        self.hidden_weight = hidden_weight
+        self.attention_weight = attention_weight
+        self.hidden_projection = None
+        if hidden_weight > 0 and student_config.hidden_size != teacher_config.hidden_size:
+            self.hidden_projection = nn.Linear(student_config.hidden_size, teacher_config.hidden_size)
+
+    def forward(self, student_logits, teacher_logits, labels=None, student_hidden_states=(),
+                teacher_hidden_states=(), student_attentions=(), teacher_attentions=()):
+        soft_loss = F.kl_div(F.log_softmax(student_logits / self.temperature, dim=-1),
+                             F.softmax(teacher_logits / self.temperature, dim=-1),
+                             reduction='sum') / student_logits.size(0) * self.temperature ** 2
+        loss = self.alpha * soft_loss
+        if labels is not None and self.alpha < 1.0:
+            loss = loss + (1.0 - self.alpha) * F.cross_entropy(student_logits, labels)
+        for student_hidden, teacher_hidden in zip(student_hidden_states, teacher_hidden_states):
+            if self.hidden_projection is not None:
+                student_hidden = self.hidden_projection(student_hidden)
+            teacher_hidden = teacher_hidden.view_as(student_hidden)
+            loss = loss + self.hidden_weight * F.mse_loss(student_hidden, teacher_hidden)
+        for student_attention, teacher_attention in zip(student_attentions, teacher_attentions):
+            seq_length = student_attention.size(-1)
+            teacher_attention = teacher_attention.view(student_attention.size(0), -1, seq_length, seq_length)
+            if teacher_attention.size(1) != student_attention.size(1):
+                student_attention = student_attention.mean(dim=1, keepdim=True)
+                teacher_attention = teacher_attention.mean(dim=1, keepdim=True)
+            loss = loss + self.attention_weight * F.mse_loss(student_attention, teacher_attention)
+        return loss
+
+
+def distill(student, teacher_cache, train_dataset, distillation_loss, optimizer, layer_map,
+            num_train_epochs=3, batch_size=32, gradient_accumulation_steps=1, device='cpu'):
+    """ Trains `student` on the cached teacher outputs.
+
+    Params:
+        teacher_cache: a `TeacherOutputCache` built on `train_dataset`.
+        train_dataset: a `TensorDataset` of (input_ids, input_mask, segment_ids, label_ids), in the same
+            order as when the cache was built.
+        distillation_loss: a `DistillationLoss` instance.
+        optimizer: optimizer of the student (and of `distillation_loss` parameters, if any).
+        layer_map: list mapping each student layer to a teacher layer.
+    Returns the average training loss of the last epoch.
+    """
+    if teacher_cache.num_examples != len(train_dataset):
+        raise ValueError("The teacher cache ({} examples) was not built on this dataset ({} examples)".format(
+            teacher_cache.num_examples, len(train_dataset)))
+    use_hidden = distillation_loss.hidden_weight > 0
+    use_attentions = distillation_loss.attention_weight > 0
+    for student_layer, teacher_layer in enumerate(layer_map):
+        if use_hidden and teacher_layer not in teacher_cache.hidden_layers or \
+                use_attentions and teacher_layer not in teacher_cache.attention_layers:
+            raise ValueError("Teacher layer {} (student layer {}) is not in the teacher cache".format(
+                teacher_layer, student_layer))
+
+    indexed_dataset = TensorDataset(*(tuple(train_dataset.tensors) + (torch.arange(len(train_dataset)),)))
+    dataloader = DataLoader(indexed_dataset, sampler=RandomSampler(indexed_dataset), batch_size=batch_size)
+    recorder = _InternalsRecorder(student, hidden_states=use_hidden, attentions=use_attentions)
+    student.train()
+    distillation_loss.train()
+    tr_loss = 0.0
+    try:
+        for _ in trange(int(num_train_epochs), desc="Epoch"):
+            tr_loss, nb_tr_steps = 0.0, 0
+            for step, batch in enumerate(tqdm(dataloader, desc="Iteration")):
+                indices = batch[-1]
+                input_ids, input_mask, segment_ids, label_ids = tuple(t.to(device) for t in batch[:4])
+                student_logits = _logits(student, input_ids, input_mask, segment_ids)
+                teacher_logits = teacher_cache.logits[indices].to(device)
+                student_hidden_states = [recorder.hidden_states[i] for i in range(len(layer_map))] \
+                    if use_hidden else []
+                teacher_hidden_states = [teacher_cache.hidden_states(j, indices).to(device) for j in layer_map] \
+                    if use_hidden else []
+                student_attentions = [recorder.attentions[i] for i in range(len(layer_map))] \
+                    if use_attentions else []
+                teacher_attentions = [teacher_cache.attentions(j, indices).to(device) for j in layer_map] \
+                    if use_attentions else []
+                loss = distillation_loss(student_logits, teacher_logits, label_ids,
+                                         student_hidden_states, teacher_hidden_states,
+                                         student_attentions, teacher_attentions)
+                if gradient_accumulation_steps > 1:
+                    loss = loss / gradient_accumulation_steps
+                loss.backward()
+                tr_loss += loss.item()
+                nb_tr_steps += 1
+                if (step + 1) % gradient_accumulation_steps == 0:
+                    optimizer.step()
+                    student.zero_grad()
+                    distillation_loss.zero_grad()
+            tr_loss = tr_loss / max(nb_tr_steps, 1)
+            logger.info("Distillation loss: {}".format(tr_loss))
+    finally:
+        recorder.remove()
+    return tr_loss
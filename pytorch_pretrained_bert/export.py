@@ -0,0 +1,218 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Export of BERT models to graph formats for inference outside of Python."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+from .modeling import (BertModel, BertForSequenceClassification, BertForMultipleChoice,
+                       BertForQuestionAnswering, benchmark_latency)
+
+logger = logging.getLogger(__name__)
+
+ONNX_EXPORTABLE_MODELS = (BertForSequenceClassification, BertForMultipleChoice, BertForQuestionAnswering)
+
+
+class InferenceWrapper(nn.Module):
+    """ Calls a model with the tensors (input_ids, token_type_ids, attention_mask) and returns tensors only:
+        - `BertModel`: (sequence_output, pooled_output) of the last layer,
+        - `BertForMultipleChoice`: logits of shape [batch_size, num_options],
+        - other heads: their outputs without labels.
+    """
+    def __init__(self, model):
+        super(InferenceWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, token_type_ids, attention_mask=None):
+        if isinstance(self.model, BertModel):
+            return self.model(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
+        outputs = self.model(input_ids, token_type_ids, attention_mask)
+        if isinstance(self.model, BertForMultipleChoice):
+            outputs = outputs.view(input_ids.size(0), input_ids.size(1))
+        return outputs
+
+
+def _complete_batch(example_batch):
+    """ Completes an example batch (input_ids[, token_type_ids[, attention_mask]]) with the defaults of
+        `BertModel`: all-zero token types and an all-one attention mask.
+    """
+    if isinstance(example_batch, torch.Tensor):
+        example_batch = (example_batch,)
+    input_ids = example_batch[0]
+    token_type_ids = example_batch[1] if len(example_batch) > 1 else torch.zeros_like(input_ids)
+    attention_mask = example_batch[2] if len(example_batch) > 2 else torch.ones_like(input_ids)
+    return input_ids, token_type_ids, attention_mask
+
+
+def export_torchscript(model, example_batch, path, optimize=True):
+    """ Traces a model into a TorchScript module saved at `path`, loadable with `torch.jit.load` without the
+        Python classes of this package.
+
+        The graph is traced in eval mode with `example_batch` and accepts other batch sizes, sequence
+        lengths (up to `max_position_embeddings`) and, for `BertForMultipleChoice`, numbers of options.
+        Settings resolved in Python at trace time (`ffn_chunk_size`, `set_mixed_precision`, quantized or
+        factorized layers) are recorded in the graph as they are when the model is exported.
+
+    Params:
+        model: a `BertModel` or one of the task models of `modeling.py`.
+        example_batch: a tuple (input_ids, token_type_ids, attention_mask) with the shapes expected by
+            `model.forward`. token_type_ids and attention_mask can be omitted.
+        path: file to write the TorchScript module to.
+        optimize: whether to freeze the module (inlining the weights as constants) and apply the
+            inference optimizations of `torch.jit.optimize_for_inference` when available. Default: True.
+
+    Returns the exported TorchScript module, which takes the three tensors (input_ids, token_type_ids,
+    attention_mask) and returns tensors (see `InferenceWrapper`).
+    """
+    example_batch = _complete_batch(example_batch)
+    training = model.training
+    # The wrapper is in eval mode too: `torch.jit.freeze` only accepts modules in eval mode
+    wrapper = InferenceWrapper(model).eval()
+    try:
+        with torch.no_grad():
+            traced = torch.jit.trace(wrapper, example_batch)
+    finally:
+        model.train(training)
+    if optimize and hasattr(torch.jit, 'freeze'):
+        traced = torch.jit.freeze(traced)
+        if hasattr(torch.jit, 'optimize_for_inference'):
+            traced = torch.jit.optimize_for_inference(traced)
+    torch.jit.save(traced, path)
+    logger.info("TorchScript module saved in {}".format(path))
+    return traced
+
+
+def _onnx_axes(model, fold_attention_mask):
+    """ Returns the input names, output names and dynamic axes of the ONNX graph of `model`. """
+    if isinstance(model, BertForMultipleChoice):
+        input_axes = {0: 'batch', 1: 'options', 2: 'sequence'}
+    else:
+        input_axes = {0: 'batch', 1: 'sequence'}
+    input_names = ['input_ids', 'token_type_ids'] + ([] if fold_attention_mask else ['attention_mask'])
+    if isinstance(model, BertForQuestionAnswering):
+        output_names = ['start_logits', 'end_logits']
+        output_axes = {0: 'batch', 1: 'sequence'}
+    elif isinstance(model, BertForMultipleChoice):
+        output_names = ['logits']
+        output_axes = {0: 'batch', 1: 'options'}
+    else:
+        output_names = ['logits']
+        output_axes = {0: 'batch'}
+    dynamic_axes = dict([(name, input_axes) for name in input_names] +
+                        [(name, output_axes) for name in output_names])
+    return input_names, output_names, dynamic_axes
+
+
+def export_onnx(model, example_batch, path, fold_attention_mask=False, opset_version=14):
+    """ Exports a `BertForSequenceClassification`, `BertForMultipleChoice` or `BertForQuestionAnswering`
+        model to an ONNX graph saved at `path`, with dynamic batch, sequence and (multiple choice) options axes.
+
+    Params:
+        model: the model to export, it is exported in eval mode.
+        example_batch: a tuple (input_ids, token_type_ids, attention_mask) used to trace the model.
+            token_type_ids and attention_mask can be omitted.
+        path: file to write the ONNX graph to.
+        fold_attention_mask: if True, the graph has no `attention_mask` input: it builds an all-one mask
+            from the shape of `input_ids` so that the mask extension `(1.0 - mask) * -10000.0` reduces to
+            a constant folded by the runtime. For unpadded inputs only (e.g. serving one sequence at a time).
+            Default: False, the graph takes the [0, 1] mask and extends it.
+        opset_version: ONNX opset to export to. Default: 14.
+
+    Returns the list of the input names of the graph.
+    """
+    if not isinstance(model, ONNX_EXPORTABLE_MODELS):
+        raise ValueError("ONNX export supports {}, not {}".format(
+            ', '.join(cls.__name__ for cls in ONNX_EXPORTABLE_MODELS), model.__class__.__name__))
+    input_ids, token_type_ids, attention_mask = _complete_batch(example_batch)
+    args = (input_ids, token_type_ids) if fold_attention_mask else (input_ids, token_type_ids, attention_mask)
+    input_names, output_names, dynamic_axes = _onnx_axes(model, fold_attention_mask)
+    training = model.training
+    wrapper = InferenceWrapper(model).eval()
+    try:
+        with torch.no_grad():
+            torch.onnx.export(wrapper, args, path,
+                              input_names=input_names,
+                              output_names=output_names,
+                              dynamic_axes=dynamic_axes,
+                              opset_version=opset_version,
+                              do_constant_folding=True)
+    finally:
+        model.train(training)
+    logger.info("ONNX graph saved in {}".format(path))
+    return input_names
+
+
+def compare_onnx_runtime(model, path, batch, num_runs=20, num_warmup=3):
+    """ Runs a model and its ONNX export (see `export_onnx`) on CPU with onnxruntime and compares their
+        outputs and latencies.
+
+    Params:
+        model: the exported PyTorch model.
+        path: the ONNX graph of `model`.
+        batch: a tuple (input_ids, token_type_ids, attention_mask) of inputs. attention_mask is ignored
+            if the graph was exported with `fold_attention_mask`.
+        num_runs, num_warmup: number of timed and untimed forward passes.
+
+    Returns a dict with the maximum absolute difference of the outputs, the average latencies in seconds
+    and the speedup of the ONNX runtime.
+    """
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("Running ONNX graphs requires onnxruntime. Please see "
+                          "https://onnxruntime.ai/ for installation instructions.")
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    batch = tuple(tensor.cpu() for tensor in _complete_batch(batch))
+    input_names = [graph_input.name for graph_input in session.get_inputs()]
+    feed = dict((name, tensor.numpy()) for name, tensor in zip(input_names, batch))
+
+    # The model is compared on CPU in eval mode, then put back on its device and in its mode
+    device = next(model.parameters()).device
+    training = model.training
+    model.cpu().eval()
+    try:
+        wrapper = InferenceWrapper(model)
+        with torch.no_grad():
+            outputs = wrapper(*batch[:len(input_names)])
+        outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+        onnx_outputs = session.run(None, feed)
+        max_abs_diff = max(float(np.abs(output.numpy() - onnx_output).max())
+                           for output, onnx_output in zip(outputs, onnx_outputs))
+
+        for _ in range(num_warmup):
+            session.run(None, feed)
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            session.run(None, feed)
+        onnx_latency = (time.perf_counter() - start) / num_runs
+        latency = benchmark_latency(wrapper, *batch[:len(input_names)], num_runs=num_runs, num_warmup=num_warmup)
+    finally:
+        model.to(device)
+        model.train(training)
+
+    result = {'max_abs_diff': max_abs_diff,
+              'latency': latency,
+              'onnx_latency': onnx_latency,
+              'speedup': latency / onnx_latency}
+    logger.info("ONNX runtime check: {}".format(result))
+    return result
@@ -8,8 +8,10 @@ import csv
 import os
 import logging
 import shutil
+import tarfile
 import tempfile
 import json
+from contextlib import contextmanager
 from urllib.parse import urlparse
 from pathlib import Path
 from typing import Optional, Tuple, Union, IO, Callable, Set, List
@@ -216,6 +218,94 @@ def get_from_cache(url: str, cache_dir: str = None) -> str:
     return cache_path
 
 
+@contextmanager
+def file_lock(lock_path: str):
+    """
+    Hold an exclusive inter-process lock on `lock_path` for the duration of the context.
+    The lock is advisory (fcntl) and skipped on platforms without fcntl.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    with open(lock_path, 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def archive_key(path: str) -> str:
+    """
+    Hash identifying a local file or directory in its current version:
+    its absolute path, size and modification time.
+    """
+    stat = os.stat(path)
+    return url_to_filename(os.path.realpath(path), "{}-{}".format(stat.st_size, stat.st_mtime))
+
+
+def _archive_version(archive_path: str) -> Tuple[str, str]:
+    """
+    Return the source and the content version of an archive: the url and etag recorded by `get_from_cache`
+    for a downloaded archive, else its absolute path and the sha256 of its content.
+    """
+    meta_path = archive_path + '.json'
+    if os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            metadata = json.load(meta_file)
+        if metadata.get('etag'):
+            return metadata['url'], metadata['etag']
+    content_hash = sha256()
+    with open(archive_path, 'rb') as archive_file:
+        for chunk in iter(lambda: archive_file.read(1024 * 1024), b''):
+            content_hash.update(chunk)
+    return os.path.realpath(archive_path), content_hash.hexdigest()
+
+
+def extracted_archive_path(archive_path: str, cache_dir: str = None) -> str:
+    """
+    Extract a .tar.gz archive once into the cache and return the path to the extracted directory.
+    The directory is keyed by the source of the archive and the etag of its download, or the hash of its
+    content for a local archive, so an archive replaced in place is extracted again; the directories of
+    its previous versions are then removed. Extraction happens in a temporary directory of the cache
+    renamed atomically once complete, under a lock so that concurrent processes extract once.
+    """
+    if cache_dir is None:
+        cache_dir = PYTORCH_PRETRAINED_BERT_CACHE
+    cache_dir = str(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    source, version = _archive_version(archive_path)
+    # <hash of the source>.<hash of the version>.extracted
+    source_prefix = url_to_filename(source) + '.'
+    extracted_path = os.path.join(cache_dir, url_to_filename(source, version) + '.extracted')
+    if os.path.isdir(extracted_path):
+        return extracted_path
+
+    with file_lock(os.path.join(cache_dir, source_prefix + 'extracted.lock')):
+        # Another process may have extracted the archive while we were waiting for the lock
+        if not os.path.isdir(extracted_path):
+            temp_dir = tempfile.mkdtemp(dir=cache_dir)
+            try:
+                logger.info("extracting archive file %s to %s", archive_path, extracted_path)
+                with tarfile.open(archive_path, 'r:gz') as archive:
+                    archive.extractall(temp_dir)
+                os.rename(temp_dir, extracted_path)
+            except BaseException:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                raise
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if name.startswith(source_prefix) and name.endswith('.extracted') and path != extracted_path:
+                logger.info("removing extracted archive %s of a previous version of %s", path, archive_path)
+                shutil.rmtree(path, ignore_errors=True)
+
+    return extracted_path
+
+
 def read_set_from_file(filename: str) -> Set[str]:
     '''
     Extract a de-duped collection (set) of text from a file.
@@ -0,0 +1,156 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Flat, memory-mappable weight files.
+
+Layout of a file:
+    - 8 bytes: the magic string `BERTFLAT`,
+    - 8 bytes: the length of the header (little-endian unsigned int),
+    - the header: a utf-8 JSON dict of {tensor name: {"dtype", "shape", "offset", "nbytes"}},
+    - the raw buffers of the tensors, in C order. Offsets are relative to the start of the data section,
+      which, as every buffer, is aligned on `ALIGNMENT` bytes.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import struct
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+FLAT_WEIGHTS_MAGIC = b'BERTFLAT'
+ALIGNMENT = 64
+
+# Numpy dtypes used to store each torch dtype. bfloat16 has no numpy equivalent and is stored as int16.
+_NUMPY_DTYPES = {
+    'float64': np.float64,
+    'float32': np.float32,
+    'float16': np.float16,
+    'bfloat16': np.int16,
+    'int64': np.int64,
+    'int32': np.int32,
+    'int16': np.int16,
+    'int8': np.int8,
+    'uint8': np.uint8,
+    'bool': np.bool_,
+}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _dtype_name(tensor):
+    return str(tensor.dtype).replace('torch.', '')
+
+
+def _to_numpy(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    if _dtype_name(tensor) == 'bfloat16':
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy()
+
+
+def save_flat_weights(state_dict, path):
+    """ Writes the tensors of `state_dict` to `path` in the flat format described in this module. """
+    header = OrderedDict()
+    arrays = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        if not isinstance(tensor, torch.Tensor) or tensor.is_quantized or _dtype_name(tensor) not in _NUMPY_DTYPES:
+            raise ValueError("Can't write {} in a flat weights file: only tensors of dtypes {} are supported".format(
+                name, ', '.join(sorted(_NUMPY_DTYPES))))
+        array = _to_numpy(tensor)
+        offset = _align(offset)
+        header[name] = {'dtype': _dtype_name(tensor),
+                        'shape': list(tensor.size()),
+                        'offset': offset,
+                        'nbytes': array.nbytes}
+        arrays.append((offset, array))
+        offset += array.nbytes
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(len(FLAT_WEIGHTS_MAGIC) + 8 + len(header_bytes))
+    with open(path, 'wb') as writer:
+        writer.write(FLAT_WEIGHTS_MAGIC)
+        writer.write(struct.pack('<Q', len(header_bytes)))
+        writer.write(header_bytes)
+        for offset, array in arrays:
+            writer.write(b'\0' * (data_start + offset - writer.tell()))
+            writer.write(array.tobytes())
+
+
+def read_flat_weights_header(path):
+    """ Returns the header of a flat weights file and the position of its data section. """
+    with open(path, 'rb') as reader:
+        if reader.read(len(FLAT_WEIGHTS_MAGIC)) != FLAT_WEIGHTS_MAGIC:
+            raise ValueError("{} is not a flat weights file".format(path))
+        header_length, = struct.unpack('<Q', reader.read(8))
+        header = json.loads(reader.read(header_length).decode('utf-8'), object_pairs_hook=OrderedDict)
+    return header, _align(len(FLAT_WEIGHTS_MAGIC) + 8 + header_length)
+
+
+def load_flat_weights(path):
+    """ Memory-maps a flat weights file and returns an OrderedDict of tensors viewing the mapping.
+
+        The file is mapped copy-on-write: nothing is read before the tensors are accessed, and processes
+        mapping the same file share its pages until they modify a tensor.
+    """
+    header, data_start = read_flat_weights_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode='c')
+    state_dict = OrderedDict()
+    for name, entry in header.items():
+        start = data_start + entry['offset']
+        array = data[start:start + entry['nbytes']].view(_NUMPY_DTYPES[entry['dtype']]).reshape(entry['shape'])
+        tensor = torch.from_numpy(array)
+        if entry['dtype'] == 'bfloat16':
+            tensor = tensor.view(torch.bfloat16)
+        state_dict[name] = tensor
+    return state_dict
+
+
+def bind_state_dict(model, state_dict, prefix=''):
+    """ Loads `state_dict` in `model` by making the parameters and buffers use its tensors as storage: the
+        tensors memory-mapped by `load_flat_weights` are bound without copy. Tensors which have another
+        dtype than the model, or models which are not on CPU, are copied.
+
+    Returns the lists of the missing keys (keys of `model` not in `state_dict`) and of the unexpected keys
+    (keys of `state_dict` starting with `prefix` not in `model`), with `prefix`.
+    """
+    missing_keys = []
+    used_keys = set()
+    with torch.no_grad():
+        for key, tensor in model.state_dict(keep_vars=True).items():
+            name = prefix + key
+            if name not in state_dict:
+                missing_keys.append(name)
+                continue
+            source = state_dict[name]
+            used_keys.add(name)
+            if source.size() != tensor.size():
+                raise RuntimeError("size mismatch for {}: copying a param of {} from checkpoint, where the shape "
+                                   "is {} in current model.".format(name, source.size(), tensor.size()))
+            if tensor.device.type == 'cpu' and tensor.dtype == source.dtype:
+                tensor.data = source
+            else:
+                tensor.copy_(source)
+    unexpected_keys = [key for key in state_dict if key.startswith(prefix) and key not in used_keys]
+    return missing_keys, unexpected_keys
@@ -22,16 +22,23 @@ import os
 import copy
 import json
 import math
+import time
 import logging
-import tarfile
-import tempfile
-import shutil
+import contextlib
+import functools
+import inspect
+import threading
+import zipfile
+from collections import OrderedDict
 
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from torch.nn import CrossEntropyLoss
 
-from .file_utils import cached_path
+from .file_utils import cached_path, extracted_archive_path
+from .flat_weights import save_flat_weights, load_flat_weights, bind_state_dict
+from .sharding import INDEX_SUFFIX, save_sharded_checkpoint, load_sharded_checkpoint, read_index
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s', 
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -46,7 +53,11 @@ PRETRAINED_MODEL_ARCHIVE_MAP = {
     'bert-base-chinese': "https://s3.amazonaws.com/models.huggingface.co/bert/bert-base-chinese.tar.gz",
 }
 CONFIG_NAME = 'bert_config.json'
+# Set in the threads building models whose weights are not initialized, see `no_init_weights`
+_NO_INIT_WEIGHTS = threading.local()
+MIXED_PRECISION_DTYPES = {'fp16': 'float16', 'bf16': 'bfloat16'}
 WEIGHTS_NAME = 'pytorch_model.bin'
+FLAT_WEIGHTS_NAME = 'pytorch_model.flat'
 
 def gelu(x):
     """Implementation of the gelu activation function.
@@ -63,6 +74,221 @@ def swish(x):
 ACT2FN = {"gelu": gelu, "relu": torch.nn.functional.relu, "swish": swish}
 
 
+@contextlib.contextmanager
+def no_init_weights():
+    """Context manager in which the models built by the current thread skip `init_bert_weights`: their weights
+        keep the values given by the PyTorch layers. Used by `from_pretrained`, which overwrites them with the
+        pretrained weights and only initializes the missing ones (see `init_missing_weights`).
+        Models built by other threads in the meantime are initialized as usual.
+    """
+    enabled = getattr(_NO_INIT_WEIGHTS, 'enabled', False)
+    _NO_INIT_WEIGHTS.enabled = True
+    try:
+        yield
+    finally:
+        _NO_INIT_WEIGHTS.enabled = enabled
+
+
+def _load_checkpoint(weights_path):
+    """Loads a `torch.save` checkpoint on CPU, memory-mapped when supported by `torch.load` (PyTorch >= 2.1
+        and zipfile checkpoints), whatever the device the tensors were saved from.
+    """
+    if 'mmap' in inspect.signature(torch.load).parameters and zipfile.is_zipfile(weights_path):
+        return torch.load(weights_path, map_location='cpu', mmap=True)
+    return torch.load(weights_path, map_location='cpu')
+
+
+def _default_device(device):
+    """Context manager in which the tensors are created on `device`, so that a model built in it is not
+        allocated on CPU first. Requires PyTorch >= 2.0, does nothing before (or if `device` is None).
+    """
+    if device is None or not hasattr(torch.device, '__enter__'):
+        return contextlib.ExitStack()
+    return torch.device(device)
+
+
+def _start_prefix(model, checkpoint_keys):
+    """Prefix of the weights of `model` in a checkpoint: `bert.` to load a `BertModel` from the checkpoint of
+        a model with a head.
+    """
+    if not hasattr(model, 'bert') and any(key.startswith('bert.') for key in checkpoint_keys):
+        return 'bert.'
+    return ''
+
+
+def _base_model_prefix(model, checkpoint_keys):
+    """Prefix of the weights of `model` missing from a checkpoint: `bert.` to load a model with a head from
+        the checkpoint of a `BertModel`.
+    """
+    if not hasattr(model, 'bert') or any(key.startswith('bert.') for key in checkpoint_keys):
+        return ''
+    base_model_keys = set(model.bert.state_dict().keys())
+    if any(key in base_model_keys for key in checkpoint_keys):
+        return 'bert.'
+    return ''
+
+
+def _add_prefix(state_dict, prefix):
+    """Returns `state_dict` with `prefix` added to its keys and to the keys of its metadata."""
+    prefixed_state_dict = OrderedDict((prefix + key, value) for key, value in state_dict.items())
+    metadata = getattr(state_dict, '_metadata', None)
+    if metadata is not None:
+        prefixed_state_dict._metadata = OrderedDict((prefix + key if key else prefix[:-1], value)
+                                                    for key, value in metadata.items())
+    return prefixed_state_dict
+
+
+# Non-reentrant checkpointing (PyTorch >= 1.11) also computes the gradients of the parameters of the
+# recomputed function when its inputs don't require grad (e.g. above frozen layers)
+_NON_REENTRANT_CHECKPOINT = 'use_reentrant' in inspect.signature(checkpoint).parameters
+
+
+# Set while running a checkpointed function, whose fused operations run their eager implementation
+_EAGER_FUSED_OPS = threading.local()
+
+
+def _checkpoint(function, *args):
+    """Runs `function` without storing its activations, which are recomputed in the backward pass.
+        The recomputation must produce tensors with the same metadata as the forward pass, which the
+        TorchScript profiling executor doesn't guarantee (it specializes the scripted functions after their
+        first runs): `function` runs with the eager implementation of the fused operations (see `_script`).
+    """
+    def eager_function(*args):
+        enabled = getattr(_EAGER_FUSED_OPS, 'enabled', False)
+        _EAGER_FUSED_OPS.enabled = True
+        try:
+            return function(*args)
+        finally:
+            _EAGER_FUSED_OPS.enabled = enabled
+
+    if _NON_REENTRANT_CHECKPOINT:
+        return checkpoint(eager_function, *args, use_reentrant=False)
+    return checkpoint(eager_function, *args)
+
+
+def _script(fn):
+    """Compiles `fn` with TorchScript when available, so that its elementwise operations are fused.
+        `fn` itself runs in checkpointed functions (see `_checkpoint`).
+    """
+    try:
+        scripted_fn = torch.jit.script(fn)
+    except Exception as e:  # TorchScript missing or unable to compile `fn` in this version of PyTorch
+        logger.info("Could not script {}, using the eager implementation: {}".format(fn.__name__, e))
+        return fn
+
+    @functools.wraps(fn)
+    def fused_fn(*args):
+        if getattr(_EAGER_FUSED_OPS, 'enabled', False):
+            return fn(*args)
+        return scripted_fn(*args)
+    return fused_fn
+
+
+def bias_gelu(bias, x):
+    # type: (Tensor, Tensor) -> Tensor
+    """Computes `gelu(x + bias)` in a single fused expression (see `gelu`)."""
+    x = x + bias
+    return x * 0.5 * (1.0 + torch.erf(x * 0.7071067811865476))
+
+
+def dropout_add_layer_norm(x, residual, gamma, beta, variance_epsilon, dropout_prob, training):
+    # type: (Tensor, Tensor, Tensor, Tensor, float, float, bool) -> Tensor
+    """Computes `LayerNorm(dropout(x) + residual)` with `torch.nn.functional.layer_norm`, which, as the TF
+        implementation, adds `variance_epsilon` to the biased variance inside the square root.
+        The residual sum and the normalization are computed in float32, the result has the dtype of `x`.
+    """
+    y = torch.nn.functional.dropout(x.float(), p=dropout_prob, training=training) + residual.float()
+    y = torch.nn.functional.layer_norm(y, gamma.size(), gamma.float(), beta.float(), variance_epsilon)
+    return y.type_as(x)
+
+
+fused_bias_gelu = _script(bias_gelu)
+fused_dropout_add_layer_norm = _script(dropout_add_layer_norm)
+
+
+def gather_positions(sequence_tensor, positions):
+    """Gathers the vectors at the specific positions over a minibatch.
+        sequence_tensor: torch.FloatTensor of shape [batch_size, sequence_length, width]
+        positions: torch.LongTensor of shape [batch_size, num_positions]
+        Returns a torch.FloatTensor of shape [batch_size, num_positions, width]
+    """
+    index = positions.unsqueeze(-1).expand(-1, -1, sequence_tensor.size(-1))
+    return torch.gather(sequence_tensor, 1, index)
+
+
+def prune_linear_layer(layer, index, dim=0):
+    """Prunes a `nn.Linear` layer to keep only the entries of `index` along `dim`.
+        dim=0 keeps output features (rows of the weight), dim=1 keeps input features (columns).
+        Returns a new `nn.Linear` on the same device and with the same dtype.
+    """
+    index = index.to(layer.weight.device)
+    new_size = list(layer.weight.size())
+    new_size[dim] = len(index)
+    new_layer = nn.Linear(new_size[1], new_size[0], bias=layer.bias is not None)
+    new_layer = new_layer.to(device=layer.weight.device, dtype=layer.weight.dtype)
+    with torch.no_grad():
+        new_layer.weight.copy_(layer.weight.index_select(dim, index))
+        if layer.bias is not None:
+            new_layer.bias.copy_(layer.bias if dim == 1 else layer.bias.index_select(0, index))
+    new_layer.weight.requires_grad = layer.weight.requires_grad
+    if layer.bias is not None:
+        new_layer.bias.requires_grad = layer.bias.requires_grad
+    return new_layer
+
+
+def set_module(model, name, module):
+    """Replaces the submodule of `model` called `name` (a dotted path from `named_modules`) by `module`."""
+    parent_name, _, child_name = name.rpartition('.')
+    parent = model.get_submodule(parent_name) if hasattr(model, 'get_submodule') \
+        else dict(model.named_modules())[parent_name]
+    setattr(parent, child_name, module)
+
+
+def benchmark_latency(model, input_ids, token_type_ids=None, attention_mask=None, num_runs=20, num_warmup=3):
+    """ Measures the average latency in seconds of a forward pass of `model` on the given inputs.
+    """
+    model.eval()
+    with torch.no_grad():
+        for _ in range(num_warmup):
+            model(input_ids, token_type_ids, attention_mask)
+        start = time.perf_counter()
+        for _ in range(num_runs):
+            model(input_ids, token_type_ids, attention_mask)
+        elapsed = time.perf_counter() - start
+    return elapsed / num_runs
+
+
+def _is_frozen(module):
+    """Whether none of the parameters of `module` requires grad (see `PreTrainedBertModel.freeze_layers`)."""
+    return not any(param.requires_grad for param in module.parameters())
+
+
+def shared_parameter_aliases(model):
+    """Maps the state_dict keys of the tensors referenced by several modules (layers shared with
+        `cross_layer_sharing`, decoder tied to the word embeddings) to the key of their first occurrence.
+    """
+    first_keys = {}
+    aliases = {}
+    for key, tensor in model.state_dict(keep_vars=True).items():
+        if id(tensor) in first_keys:
+            aliases[key] = first_keys[id(tensor)]
+        else:
+            first_keys[id(tensor)] = key
+    return aliases
+
+
+def select_labelled_positions(sequence_tensor, labels, ignore_index=-1):
+    """Keeps only the vectors whose label is not `ignore_index`.
+        Returns a tuple of the selected vectors, flattened to [num_labelled, width], and their labels
+        flattened to [num_labelled]. Used to run the masked language modeling head on the ~15% of
+        labelled positions instead of the whole sequence.
+    """
+    labels = labels.contiguous().view(-1)
+    labelled = labels != ignore_index
+    sequence_tensor = sequence_tensor.contiguous().view(-1, sequence_tensor.size(-1))
+    return sequence_tensor[labelled], labels[labelled]
+
+
 class BertConfig(object):
     """Configuration class to store the configuration of a `BertModel`.
     """
@@ -77,7 +303,12 @@ class BertConfig(object):
                  attention_probs_dropout_prob=0.1,
                  max_position_embeddings=512,
                  type_vocab_size=2,
-                 initializer_range=0.02):
+                 initializer_range=0.02,
+                 pruned_heads=None,
+                 cross_layer_sharing=None,
+                 ffn_chunk_size=None,
+                 adapter_size=None,
+                 attention_window=None):
         """Constructs BertConfig.
 
         Args:
@@ -87,7 +318,7 @@ class BertConfig(object):
             num_attention_heads: Number of attention heads for each attention layer in
                 the Transformer encoder.
             intermediate_size: The size of the "intermediate" (i.e., feed-forward)
-                layer in the Transformer encoder.
+                layer in the Transformer encoder. Either an int or a list with one size per layer.
             hidden_act: The non-linear activation function (function or string) in the
                 encoder and pooler. If string, "gelu", "relu" and "swish" are supported.
             hidden_dropout_prob: The dropout probabilitiy for all fully connected
@@ -101,6 +332,20 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            pruned_heads: dict of {layer_num (str): list of pruned attention heads} filled by
+                `PreTrainedBertModel.prune_heads`.
+            cross_layer_sharing: ALBERT-style sharing of the parameters of the Transformer layers. One of
+                None (no sharing), "all" (all the layers share one set of weights), "attention" (only the
+                attention blocks are shared) or "ffn" (only the feed-forward blocks are shared).
+            ffn_chunk_size: if set, the feed-forward blocks process the sequence in chunks of this many
+                tokens so that only one chunk of the [batch_size, chunk_size, intermediate_size]
+                activation exists at a time. In training, the chunks are recomputed in the backward pass.
+            adapter_size: if set, a bottleneck adapter of this size is inserted after the attention output
+                and feed-forward output projections of each layer (see `BertAdapter`), e.g. by
+                `PreTrainedBertModel.add_adapters`.
+            attention_window: if set, the self-attention is local: each token attends to the tokens at most
+                `attention_window` positions away and to the global tokens (see
+                `BertSelfAttention.local_attention`), in memory linear in the sequence length.
         """
         if isinstance(vocab_size_or_config_json_file, str):
             with open(vocab_size_or_config_json_file, "r") as reader:
@@ -119,6 +364,11 @@ class BertConfig(object):
             self.max_position_embeddings = max_position_embeddings
             self.type_vocab_size = type_vocab_size
             self.initializer_range = initializer_range
+            self.pruned_heads = pruned_heads if pruned_heads is not None else {}
+            self.cross_layer_sharing = cross_layer_sharing
+            self.ffn_chunk_size = ffn_chunk_size
+            self.adapter_size = adapter_size
+            self.attention_window = attention_window
         else:
             raise ValueError("First argument must be either a vocabulary size (int)"
                              "or the path to a pretrained model config file (str)")
@@ -161,10 +411,9 @@ class BertLayerNorm(nn.Module):
         self.variance_epsilon = variance_epsilon
 
     def forward(self, x):
-        u = x.mean(-1, keepdim=True)
-        s = (x - u).pow(2).mean(-1, keepdim=True)
-        x = (x - u) / torch.sqrt(s + self.variance_epsilon)
-        return self.gamma * x + self.beta
+        # Mean and variance are computed in float32, also for half precision and mixed precision inputs
+        return torch.nn.functional.layer_norm(x.float(), self.gamma.size(), self.gamma.float(), self.beta.float(),
+                                              self.variance_epsilon).type_as(x)
 
 
 class BertEmbeddings(nn.Module):
@@ -197,6 +446,21 @@ class BertEmbeddings(nn.Module):
         embeddings = self.dropout(embeddings)
         return embeddings
 
+    def extend_position_embeddings(self, max_position_embeddings):
+        """ Extends the position embeddings to `max_position_embeddings` positions by repeating the
+            learned ones: position i is initialized with the embedding of position i % the current maximum.
+        """
+        weight = self.position_embeddings.weight
+        if max_position_embeddings <= weight.size(0):
+            return
+        position_embeddings = nn.Embedding(max_position_embeddings, weight.size(1))
+        position_embeddings = position_embeddings.to(device=weight.device, dtype=weight.dtype)
+        with torch.no_grad():
+            positions = torch.arange(max_position_embeddings, device=weight.device) % weight.size(0)
+            position_embeddings.weight.copy_(weight[positions])
+        position_embeddings.weight.requires_grad = weight.requires_grad
+        self.position_embeddings = position_embeddings
+
 
 class BertSelfAttention(nn.Module):
     def __init__(self, config):
@@ -214,6 +478,7 @@ class BertSelfAttention(nn.Module):
         self.value = nn.Linear(config.hidden_size, self.all_head_size)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        self.attention_window = getattr(config, 'attention_window', None)
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
@@ -228,6 +493,10 @@ class BertSelfAttention(nn.Module):
         query_layer = self.transpose_for_scores(mixed_query_layer)
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
+        if self.attention_window:
+            context_layer = self.local_attention(query_layer, key_layer, value_layer, attention_mask)
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            return context_layer.view(*(context_layer.size()[:-2] + (self.all_head_size,)))
 
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
@@ -235,8 +504,8 @@ class BertSelfAttention(nn.Module):
         # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
         attention_scores = attention_scores + attention_mask
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+        # Normalize the attention scores to probabilities (in float32, also in half and mixed precision).
+        attention_probs = torch.nn.functional.softmax(attention_scores.float(), dim=-1).type_as(value_layer)
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
@@ -248,6 +517,109 @@ class BertSelfAttention(nn.Module):
         context_layer = context_layer.view(*new_context_layer_shape)
         return context_layer
 
+    def local_attention(self, query_layer, key_layer, value_layer, attention_mask):
+        """ Sliding window attention with global tokens (as in Longformer) computed block by block, in
+            O(seq_length * attention_window) memory instead of O(seq_length ** 2).
+
+            query_layer, key_layer, value_layer: torch.FloatTensor of shape [batch_size, num_heads, seq_length, head_size]
+            attention_mask: torch.LongTensor of shape [batch_size, seq_length] with 0 for padding tokens, 1 for
+                local tokens, attending to the tokens at most `attention_window` positions away, and 2 for
+                global tokens (e.g. [CLS] and the question), attending to and attended by all the tokens.
+            Returns the context layer, of shape [batch_size, num_heads, seq_length, head_size]
+        """
+        batch_size, num_heads, seq_length, head_size = query_layer.size()
+        window = self.attention_window
+        padding = (-seq_length) % window
+        if padding:
+            query_layer, key_layer, value_layer = [torch.nn.functional.pad(layer, (0, 0, 0, padding))
+                                                   for layer in (query_layer, key_layer, value_layer)]
+            attention_mask = torch.nn.functional.pad(attention_mask, (0, padding))
+        num_blocks = (seq_length + padding) // window
+
+        def sliding_blocks(x):
+            # [..., padded_length, width] -> [..., num_blocks, 3 * window, width]: the previous, current and
+            # next blocks of each block
+            x = torch.nn.functional.pad(x, (0, 0, window, window))
+            x = x.view(*(x.size()[:-2] + (num_blocks + 2, window, x.size(-1))))
+            return torch.cat([x[..., :-2, :, :], x[..., 1:-1, :, :], x[..., 2:, :, :]], dim=-2)
+
+        # Local scores of the queries of each block against the keys of the 3 surrounding blocks.
+        # Global keys are left out here and scored separately below.
+        query_blocks = query_layer.view(batch_size, num_heads, num_blocks, window, head_size)
+        local_keys = sliding_blocks(key_layer)
+        local_values = sliding_blocks(value_layer)
+        local_scores = torch.matmul(query_blocks, local_keys.transpose(-1, -2)) / math.sqrt(self.attention_head_size)
+        offsets = torch.arange(3 * window, device=query_layer.device).view(1, -1) - window - \
+            torch.arange(window, device=query_layer.device).view(-1, 1)
+        local_tokens = sliding_blocks(attention_mask.eq(1).to(query_layer.dtype).view(batch_size, 1, -1, 1))
+        allowed = (offsets.abs() <= window) & local_tokens.squeeze(-1).unsqueeze(-2).bool()
+        scores = local_scores.masked_fill(~allowed, -10000.0)
+
+        global_tokens = attention_mask.eq(2)
+        num_global = int(global_tokens.sum(1).max())
+        if num_global > 0:
+            # The first `num_global` indices sorted by decreasing flag are the global tokens (and padding
+            # slots, not valid, for the sequences with fewer global tokens)
+            global_flags, global_index = global_tokens.long().sort(dim=1, descending=True)
+            global_valid = global_flags[:, :num_global].bool()
+            global_index = global_index[:, :num_global].view(batch_size, 1, num_global, 1).expand(
+                -1, num_heads, -1, head_size)
+            global_keys = key_layer.gather(2, global_index)
+            global_values = value_layer.gather(2, global_index)
+            global_scores = torch.matmul(query_blocks, global_keys.unsqueeze(2).transpose(-1, -2))
+            global_scores = global_scores / math.sqrt(self.attention_head_size)
+            global_scores = global_scores.masked_fill(~global_valid.view(batch_size, 1, 1, 1, -1), -10000.0)
+            scores = torch.cat([scores, global_scores], dim=-1)
+
+        attention_probs = torch.nn.functional.softmax(scores.float(), dim=-1).type_as(value_layer)
+        attention_probs = self.dropout(attention_probs)
+        context_layer = torch.matmul(attention_probs[..., :3 * window], local_values)
+        if num_global > 0:
+            context_layer = context_layer + torch.matmul(attention_probs[..., 3 * window:],
+                                                         global_values.unsqueeze(2))
+        context_layer = context_layer.view(batch_size, num_heads, num_blocks * window, head_size)
+
+        if num_global > 0:
+            # Global tokens attend to the whole sequence
+            global_queries = query_layer.gather(2, global_index)
+            global_scores = torch.matmul(global_queries, key_layer.transpose(-1, -2))
+            global_scores = global_scores / math.sqrt(self.attention_head_size)
+            global_scores = global_scores.masked_fill(attention_mask.eq(0).view(batch_size, 1, 1, -1), -10000.0)
+            global_probs = torch.nn.functional.softmax(global_scores.float(), dim=-1).type_as(value_layer)
+            global_context = torch.matmul(self.dropout(global_probs), value_layer)
+            global_context = torch.where(global_valid.view(batch_size, 1, -1, 1), global_context,
+                                         context_layer.gather(2, global_index))
+            context_layer = context_layer.scatter(2, global_index, global_context)
+        return context_layer[:, :, :seq_length]
+
+
+class BertAdapter(nn.Module):
+    """ Bottleneck adapter (Houlsby et al., 2019): a residual down-projection to `config.adapter_size`,
+        non-linearity and up-projection. The up-projection is initialized to zero so that a newly added
+        adapter is the identity and leaves the pretrained model unchanged.
+    """
+    def __init__(self, config, adapter_size=None):
+        super(BertAdapter, self).__init__()
+        if adapter_size is None:
+            adapter_size = config.adapter_size
+        self.down = nn.Linear(config.hidden_size, adapter_size)
+        self.up = nn.Linear(adapter_size, config.hidden_size)
+        self.adapter_act_fn = ACT2FN[config.hidden_act] \
+            if isinstance(config.hidden_act, str) else config.hidden_act
+
+    def forward(self, hidden_states):
+        return hidden_states + self.up(self.adapter_act_fn(self.down(hidden_states)))
+
+
+def adapter_dropout_add_layer_norm(module, hidden_states, input_tensor):
+    """ Output block of `BertSelfOutput` and `BertOutput`: dropout, adapter (if any), residual and LayerNorm. """
+    dropout_prob = module.dropout.p
+    if module.adapter is not None:
+        hidden_states = module.adapter(module.dropout(hidden_states))
+        dropout_prob = 0.0
+    return fused_dropout_add_layer_norm(hidden_states, input_tensor, module.LayerNorm.gamma, module.LayerNorm.beta,
+                                        module.LayerNorm.variance_epsilon, dropout_prob, module.training)
+
 
 class BertSelfOutput(nn.Module):
     def __init__(self, config):
@@ -255,12 +627,11 @@ class BertSelfOutput(nn.Module):
         self.dense = nn.Linear(config.hidden_size, config.hidden_size)
         self.LayerNorm = BertLayerNorm(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.adapter = BertAdapter(config) if getattr(config, 'adapter_size', None) else None
 
     def forward(self, hidden_states, input_tensor):
         hidden_states = self.dense(hidden_states)
-        hidden_states = self.dropout(hidden_states)
-        hidden_states = self.LayerNorm(hidden_states + input_tensor)
-        return hidden_states
+        return adapter_dropout_add_layer_norm(self, hidden_states, input_tensor)
 
 
 class BertAttention(nn.Module):
@@ -268,6 +639,41 @@ class BertAttention(nn.Module):
         super(BertAttention, self).__init__()
         self.self = BertSelfAttention(config)
         self.output = BertSelfOutput(config)
+        # Indices (in the original numbering) of the heads removed by `prune_heads`
+        self.pruned_heads = set()
+
+    def prune_heads(self, heads):
+        """ Removes the given heads (indices in the original, unpruned numbering) by physically
+            shrinking the query/key/value projections and the input of the output projection.
+            Heads that are already pruned are skipped. At least one head must be kept.
+        """
+        heads = [int(head) for head in heads]
+        num_heads = self.self.num_attention_heads + len(self.pruned_heads)
+        if len(set(heads)) != len(heads):
+            raise ValueError("Duplicate head indices in {}".format(heads))
+        if any(head < 0 or head >= num_heads for head in heads):
+            raise ValueError("Invalid head indices {} - should be in [0, {})".format(heads, num_heads))
+        heads = set(heads) - self.pruned_heads
+        if len(heads) == 0:
+            return
+        if len(heads) == self.self.num_attention_heads:
+            raise ValueError("Can't prune all the {} attention heads of a layer".format(num_heads))
+        head_size = self.self.attention_head_size
+        mask = torch.ones(self.self.num_attention_heads, head_size)
+        for head in heads:
+            # Shift the index by the number of heads already pruned before it
+            head = head - sum(1 if pruned < head else 0 for pruned in self.pruned_heads)
+            mask[head] = 0
+        index = torch.arange(len(mask.view(-1)))[mask.view(-1).eq(1)].long()
+
+        self.self.query = prune_linear_layer(self.self.query, index)
+        self.self.key = prune_linear_layer(self.self.key, index)
+        self.self.value = prune_linear_layer(self.self.value, index)
+        self.output.dense = prune_linear_layer(self.output.dense, index, dim=1)
+
+        self.self.num_attention_heads = self.self.num_attention_heads - len(heads)
+        self.self.all_head_size = head_size * self.self.num_attention_heads
+        self.pruned_heads = self.pruned_heads | heads
 
     def forward(self, input_tensor, attention_mask):
         self_output = self.self(input_tensor, attention_mask)
@@ -276,56 +682,113 @@ class BertAttention(nn.Module):
 
 
 class BertIntermediate(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, intermediate_size=None):
         super(BertIntermediate, self).__init__()
-        self.dense = nn.Linear(config.hidden_size, config.intermediate_size)
+        if intermediate_size is None:
+            intermediate_size = config.intermediate_size
+        self.dense = nn.Linear(config.hidden_size, intermediate_size)
         self.intermediate_act_fn = ACT2FN[config.hidden_act] \
             if isinstance(config.hidden_act, str) else config.hidden_act
 
     def forward(self, hidden_states):
+        # The bias addition is fused with gelu, unless the projection was replaced (quantized, factorized...)
+        # or is observed by hooks (e.g. calibration) expecting its complete output
+        if self.intermediate_act_fn is gelu and type(self.dense) is nn.Linear and self.dense.bias is not None \
+                and not self.dense._forward_hooks:
+            return fused_bias_gelu(self.dense.bias, torch.nn.functional.linear(hidden_states, self.dense.weight))
         hidden_states = self.dense(hidden_states)
         hidden_states = self.intermediate_act_fn(hidden_states)
         return hidden_states
 
 
 class BertOutput(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, intermediate_size=None):
         super(BertOutput, self).__init__()
-        self.dense = nn.Linear(config.intermediate_size, config.hidden_size)
+        if intermediate_size is None:
+            intermediate_size = config.intermediate_size
+        self.dense = nn.Linear(intermediate_size, config.hidden_size)
         self.LayerNorm = BertLayerNorm(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.adapter = BertAdapter(config) if getattr(config, 'adapter_size', None) else None
 
     def forward(self, hidden_states, input_tensor):
         hidden_states = self.dense(hidden_states)
-        hidden_states = self.dropout(hidden_states)
-        hidden_states = self.LayerNorm(hidden_states + input_tensor)
-        return hidden_states
+        return adapter_dropout_add_layer_norm(self, hidden_states, input_tensor)
 
 
 class BertLayer(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, intermediate_size=None):
         super(BertLayer, self).__init__()
         self.attention = BertAttention(config)
-        self.intermediate = BertIntermediate(config)
-        self.output = BertOutput(config)
+        self.intermediate = BertIntermediate(config, intermediate_size)
+        self.output = BertOutput(config, intermediate_size)
+        self.ffn_chunk_size = getattr(config, 'ffn_chunk_size', None)
+
+    def prune_intermediate_neurons(self, neurons):
+        """ Removes the given neurons of the feed-forward block: the output features of
+            `intermediate.dense` and the matching input features of `output.dense`.
+        """
+        neurons = set(neurons)
+        intermediate_size = self.intermediate.dense.out_features
+        index = torch.LongTensor([i for i in range(intermediate_size) if i not in neurons])
+        self.intermediate.dense = prune_linear_layer(self.intermediate.dense, index)
+        self.output.dense = prune_linear_layer(self.output.dense, index, dim=1)
+
+    def feed_forward(self, attention_output):
+        intermediate_output = self.intermediate(attention_output)
+        return self.output(intermediate_output, attention_output)
 
     def forward(self, hidden_states, attention_mask):
         attention_output = self.attention(hidden_states, attention_mask)
-        intermediate_output = self.intermediate(attention_output)
-        layer_output = self.output(intermediate_output, attention_output)
-        return layer_output
+        if not self.ffn_chunk_size or attention_output.size(1) <= self.ffn_chunk_size:
+            return self.feed_forward(attention_output)
+        # The feed-forward block is position-wise: the sequence can be processed chunk by chunk.
+        # With autograd, the chunks are recomputed in the backward pass instead of being stored.
+        recompute = self.training and torch.is_grad_enabled() and \
+            (_NON_REENTRANT_CHECKPOINT or attention_output.requires_grad)
+        chunks = attention_output.split(self.ffn_chunk_size, dim=1)
+        return torch.cat([_checkpoint(self.feed_forward, chunk) if recompute else self.feed_forward(chunk)
+                          for chunk in chunks], dim=1)
 
 
 class BertEncoder(nn.Module):
     def __init__(self, config):
         super(BertEncoder, self).__init__()
-        layer = BertLayer(config)
-        self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])    
+        sharing = getattr(config, 'cross_layer_sharing', None)
+        if sharing not in (None, 'all', 'attention', 'ffn'):
+            raise ValueError("Invalid cross_layer_sharing: {} - should be None, 'all', "
+                             "'attention' or 'ffn'".format(sharing))
+        if isinstance(config.intermediate_size, (list, tuple)):
+            if sharing in ('all', 'ffn'):
+                raise ValueError("Per-layer intermediate sizes can't be used with shared feed-forward blocks")
+            # Per-layer feed-forward sizes (e.g. after `prune_intermediate_neurons`)
+            self.layer = nn.ModuleList([BertLayer(config, intermediate_size)
+                                        for intermediate_size in config.intermediate_size])
+        elif sharing == 'all':
+            # The same module is referenced `num_hidden_layers` times
+            layer = BertLayer(config)
+            self.layer = nn.ModuleList([layer for _ in range(config.num_hidden_layers)])
+        else:
+            layer = BertLayer(config)
+            self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
+        if sharing == 'attention':
+            for layer in self.layer[1:]:
+                layer.attention = self.layer[0].attention
+        elif sharing == 'ffn':
+            for layer in self.layer[1:]:
+                layer.intermediate = self.layer[0].intermediate
+                layer.output = self.layer[0].output
 
     def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
         all_encoder_layers = []
+        grad_enabled = torch.is_grad_enabled()
         for layer_module in self.layer:
-            hidden_states = layer_module(hidden_states, attention_mask)
+            # Layers without trained parameters above frozen inputs (e.g. after `freeze_layers`) need no
+            # autograd graph. This is checked on the actual `requires_grad` flags so that parameters trained
+            # again afterwards (e.g. by `train_adapters_only`) get their gradients.
+            frozen = not hidden_states.requires_grad and _is_frozen(layer_module)
+            with torch.set_grad_enabled(grad_enabled and not frozen):
+                hidden_states = layer_module(hidden_states, attention_mask)
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
         if not output_all_encoded_layers:
@@ -381,6 +844,39 @@ class BertLMPredictionHead(nn.Module):
         hidden_states = self.decoder(hidden_states) + self.bias
         return hidden_states
 
+    def candidate_scores(self, hidden_states, candidate_ids):
+        """ Computes the logits of a restricted set of candidate tokens only.
+            hidden_states: torch.FloatTensor of shape [..., hidden_size]
+            candidate_ids: torch.LongTensor of shape [..., num_candidates]
+            Returns a torch.FloatTensor of shape [..., num_candidates]
+        """
+        hidden_states = self.transform(hidden_states)
+        # Only the rows of the (tied) decoder weight of the candidates are gathered
+        candidate_weights = self.decoder.weight[candidate_ids]
+        scores = torch.matmul(candidate_weights, hidden_states.unsqueeze(-1)).squeeze(-1)
+        return scores + self.bias[candidate_ids]
+
+    def top_k(self, hidden_states, k, chunk_size=4096):
+        """ Computes the top-k logits over the whole vocabulary, chunk by chunk, so that
+            only [..., chunk_size] logits exist at a time instead of [..., vocab_size].
+            Returns a tuple (top_k_scores, top_k_ids), both of shape [..., k].
+        """
+        hidden_states = self.transform(hidden_states)
+        vocab_size = self.decoder.weight.size(0)
+        best_scores, best_ids = None, None
+        for start in range(0, vocab_size, chunk_size):
+            end = min(start + chunk_size, vocab_size)
+            scores = torch.matmul(hidden_states, self.decoder.weight[start:end].t()) + self.bias[start:end]
+            scores, ids = scores.topk(min(k, end - start), dim=-1)
+            ids = ids + start
+            if best_scores is not None:
+                scores = torch.cat([best_scores, scores], dim=-1)
+                ids = torch.cat([best_ids, ids], dim=-1)
+                scores, selected = scores.topk(min(k, scores.size(-1)), dim=-1)
+                ids = ids.gather(-1, selected)
+            best_scores, best_ids = scores, ids
+        return best_scores, best_ids
+
 
 class BertOnlyMLMHead(nn.Module):
     def __init__(self, config, bert_model_embedding_weights):
@@ -414,6 +910,94 @@ class BertPreTrainingHeads(nn.Module):
         return prediction_scores, seq_relationship_score
 
 
+class BertClassificationHead(nn.Module):
+    """ Classifier on the pooled output, as in `BertForSequenceClassification`. """
+    def __init__(self, config, num_labels=2):
+        super(BertClassificationHead, self).__init__()
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.classifier = nn.Linear(config.hidden_size, num_labels)
+
+    def forward(self, sequence_output, pooled_output, labels=None):
+        logits = self.classifier(self.dropout(pooled_output))
+        if labels is not None:
+            loss_fct = CrossEntropyLoss()
+            return loss_fct(logits, labels), logits
+        return logits
+
+
+class BertMultipleChoiceHead(nn.Module):
+    """ Scores each option on its pooled output and returns logits of shape [batch_size, num_options],
+        as in `BertForMultipleChoice`. The options are flattened in the batch of the encoder.
+    """
+    def __init__(self, config, num_options=2):
+        super(BertMultipleChoiceHead, self).__init__()
+        self.num_options = num_options
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.classifier = nn.Linear(config.hidden_size, 1)
+
+    def forward(self, sequence_output, pooled_output, labels=None):
+        logits = self.classifier(self.dropout(pooled_output)).view(-1, self.num_options)
+        if labels is not None:
+            loss_fct = CrossEntropyLoss()
+            return loss_fct(logits, labels), logits
+        return logits
+
+
+class BertSpanHead(nn.Module):
+    """ Start and end logits of answer spans on the sequence output, as in `BertForQuestionAnswering`.
+        labels: a tuple (start_positions, end_positions).
+    """
+    def __init__(self, config):
+        super(BertSpanHead, self).__init__()
+        self.qa_outputs = nn.Linear(config.hidden_size, 2)
+
+    def forward(self, sequence_output, pooled_output, labels=None):
+        logits = self.qa_outputs(sequence_output)
+        start_logits, end_logits = logits.split(1, dim=-1)
+        start_logits = start_logits.squeeze(-1)
+        end_logits = end_logits.squeeze(-1)
+        if labels is None:
+            return start_logits, end_logits
+        start_positions, end_positions = labels
+        if len(start_positions.size()) > 1:
+            start_positions = start_positions.squeeze(-1)
+        if len(end_positions.size()) > 1:
+            end_positions = end_positions.squeeze(-1)
+        # sometimes the start/end positions are outside our model inputs, we ignore these terms
+        ignored_index = start_logits.size(1)
+        start_positions = start_positions.clamp(0, ignored_index)
+        end_positions = end_positions.clamp(0, ignored_index)
+        loss_fct = CrossEntropyLoss(ignore_index=ignored_index)
+        total_loss = (loss_fct(start_logits, start_positions) + loss_fct(end_logits, end_positions)) / 2
+        return total_loss, (start_logits, end_logits)
+
+
+class BertMaskedLMHead(nn.Module):
+    """ Masked language modeling head tied to the word embeddings, as in `BertForMaskedLM`.
+        With labels, only the labelled positions are projected on the vocabulary and the logits are of
+        shape [num_labelled, vocab_size].
+    """
+    def __init__(self, config, bert_model_embedding_weights):
+        super(BertMaskedLMHead, self).__init__()
+        self.predictions = BertLMPredictionHead(config, bert_model_embedding_weights)
+
+    def forward(self, sequence_output, pooled_output, labels=None):
+        if labels is None:
+            return self.predictions(sequence_output)
+        sequence_output, labels = select_labelled_positions(sequence_output, labels)
+        prediction_scores = self.predictions(sequence_output)
+        loss_fct = CrossEntropyLoss(ignore_index=-1)
+        return loss_fct(prediction_scores, labels), prediction_scores
+
+
+MULTI_TASK_HEADS = {
+    'classification': BertClassificationHead,
+    'multiple_choice': BertMultipleChoiceHead,
+    'span': BertSpanHead,
+    'mlm': BertMaskedLMHead,
+}
+
+
 class PreTrainedBertModel(nn.Module):
     """ An abstract class to handle weights initialization and
         a simple interface for dowloading and loading pretrained models.
@@ -429,9 +1013,114 @@ class PreTrainedBertModel(nn.Module):
                 ))
         self.config = config
 
+    def prune_heads(self, heads_to_prune):
+        """ Prunes attention heads of the encoder.
+            heads_to_prune: dict of {layer_num: list of heads to prune in this layer}.
+            Head indices always refer to the original, unpruned numbering.
+            The pruned heads are recorded in `config.pruned_heads` so that a model saved with
+            `save_pretrained` is rebuilt with the same shapes by `from_pretrained`.
+        """
+        base_model = getattr(self, 'bert', self)
+        pruned_heads = getattr(self.config, 'pruned_heads', None) or {}
+        self.config.pruned_heads = pruned_heads
+        for layer, heads in list(heads_to_prune.items()):
+            base_model.encoder.layer[int(layer)].attention.prune_heads(heads)
+            heads = set(int(head) for head in heads)
+            pruned_heads[str(layer)] = sorted(set(pruned_heads.get(str(layer), [])) | heads)
+
+    def prune_intermediate_neurons(self, neurons_to_prune):
+        """ Prunes neurons of the feed-forward blocks of the encoder.
+            neurons_to_prune: dict of {layer_num: list of neurons to prune in this layer}, indexed in the
+            current (possibly already pruned) feed-forward block.
+            The resulting per-layer sizes are recorded in `config.intermediate_size` so that a model saved
+            with `save_pretrained` is rebuilt with the same shapes by `from_pretrained`.
+        """
+        layers = getattr(self, 'bert', self).encoder.layer
+        for layer_num, neurons in neurons_to_prune.items():
+            layers[int(layer_num)].prune_intermediate_neurons(neurons)
+        self.config.intermediate_size = [layer.intermediate.dense.out_features for layer in layers]
+
+    def set_ffn_chunk_size(self, ffn_chunk_size):
+        """ Sets the number of tokens processed at a time by the feed-forward blocks of the encoder
+            (None to process the whole sequence at once), e.g. to run a pretrained model on long sequences
+            with a bounded peak memory. See `BertConfig.ffn_chunk_size`.
+        """
+        self.config.ffn_chunk_size = ffn_chunk_size
+        for layer in getattr(self, 'bert', self).encoder.layer:
+            layer.ffn_chunk_size = ffn_chunk_size
+
+    def freeze_embeddings(self):
+        """ Freezes the embeddings of the encoder: their parameters don't require grad and, while none of
+            them does, they are computed without autograd.
+        """
+        base_model = getattr(self, 'bert', self)
+        for param in base_model.embeddings.parameters():
+            param.requires_grad = False
+
+    def freeze_layers(self, num_layers):
+        """ Freezes the embeddings and the bottom `num_layers` layers of the encoder for partial fine-tuning.
+            Their parameters don't require grad, so that the optimizers built on the trained parameters (see
+            the examples) keep no state for them. While nothing in them or below them requires grad, they are
+            run without autograd: their activations are not stored and the backward pass stops at the first
+            trained layer.
+        """
+        base_model = getattr(self, 'bert', self)
+        layers = base_model.encoder.layer
+        if not 0 <= num_layers <= len(layers):
+            raise ValueError("Invalid number of layers to freeze: {} - should be in [0, {}]".format(
+                num_layers, len(layers)))
+        if num_layers > 0 and getattr(self.config, 'cross_layer_sharing', None):
+            raise ValueError("Layers sharing their parameters (cross_layer_sharing) can't be frozen separately.")
+        self.freeze_embeddings()
+        for layer in layers[:num_layers]:
+            for param in layer.parameters():
+                param.requires_grad = False
+
+    def set_attention_window(self, attention_window, max_position_embeddings=None):
+        """ Switches the encoder to local attention (see `BertConfig.attention_window`), or back to full
+            attention with `attention_window=None`, e.g. to encode long documents in one pass.
+            With local attention, the attention_mask of the model takes the value 2 for global tokens.
+            If `max_position_embeddings` is larger than the current maximum, the position embeddings are
+            extended by copying the learned ones (see `BertEmbeddings.extend_position_embeddings`).
+            Both settings are recorded in the configuration.
+        """
+        base_model = getattr(self, 'bert', self)
+        if max_position_embeddings is not None and max_position_embeddings > self.config.max_position_embeddings:
+            base_model.embeddings.extend_position_embeddings(max_position_embeddings)
+            self.config.max_position_embeddings = max_position_embeddings
+        self.config.attention_window = attention_window
+        for layer in base_model.encoder.layer:
+            layer.attention.self.attention_window = attention_window
+
+    def set_mixed_precision(self, dtype=None):
+        """ Runs the encoder of the model under `torch.autocast`: the matrix multiplications are computed
+            in `dtype` while the weights stay in float32. LayerNorm and softmax are computed in float32 and the
+            outputs of `BertModel` are cast back to float32 so that the heads and losses run in float32.
+            float16 training needs a gradient scaler (`torch.cuda.amp.GradScaler`), bfloat16 doesn't and
+            also runs on CPU (e.g. Xeons with AVX512-BF16 or AMX).
+            dtype: 'fp16', 'bf16', a torch dtype, or None to run in the dtype of the weights.
+        """
+        if isinstance(dtype, str):
+            if dtype not in MIXED_PRECISION_DTYPES:
+                raise ValueError("Invalid mixed precision dtype: {} - should be one of {}".format(
+                    dtype, ', '.join(sorted(MIXED_PRECISION_DTYPES))))
+            dtype = getattr(torch, MIXED_PRECISION_DTYPES[dtype])
+        if dtype is not None and not hasattr(torch, 'autocast'):
+            raise ImportError("Mixed precision requires a PyTorch version providing `torch.autocast` (>= 1.10).")
+        getattr(self, 'bert', self).mixed_precision_dtype = dtype
+
+    def pretrained_key_map(self):
+        """ Returns a dict of {state_dict key of the model: key of a pretrained checkpoint} of the weights
+            loaded by `from_pretrained` from checkpoint keys of another name, when the checkpoint doesn't
+            have the key of the model. Default: none.
+        """
+        return {}
+
     def init_bert_weights(self, module):
         """ Initialize the weights.
         """
+        if getattr(_NO_INIT_WEIGHTS, 'enabled', False):
+            return
         if isinstance(module, (nn.Linear, nn.Embedding)):
             # Slightly different from the TF version which uses truncated_normal for initialization
             # cf https://github.com/pytorch/pytorch/pull/5617
@@ -441,9 +1130,112 @@ class PreTrainedBertModel(nn.Module):
             module.gamma.data.normal_(mean=0.0, std=self.config.initializer_range)
         if isinstance(module, nn.Linear) and module.bias is not None:
             module.bias.data.zero_()
+        if isinstance(module, BertAdapter):
+            # Adapters start as the identity
+            module.up.weight.data.zero_()
+
+    def init_missing_weights(self, missing_keys):
+        """ Initializes the modules owning the weights listed in `missing_keys` (state_dict keys of the
+            model), e.g. the task head of a model built with `no_init_weights` and loaded from a checkpoint
+            of the pretrained base model.
+        """
+        modules = dict(self.named_modules())
+        for module_name in sorted(set(key.rpartition('.')[0] for key in missing_keys)):
+            module = modules[module_name]
+            if isinstance(module, (nn.Linear, nn.Embedding, BertLayerNorm)):
+                self.init_bert_weights(module)
+            elif hasattr(module, 'reset_parameters'):
+                module.reset_parameters()
+            parent = modules.get(module_name.rpartition('.')[0])
+            if isinstance(parent, BertAdapter):
+                self.init_bert_weights(parent)
+
+    def add_adapters(self, adapter_size):
+        """ Inserts newly initialized bottleneck adapters of size `adapter_size` (see `BertAdapter`) in the
+            attention and feed-forward output blocks of each layer of the encoder. The size is recorded in
+            `config.adapter_size` so that a model saved with `save_pretrained` is rebuilt with its adapters by
+            `from_pretrained`.
+        """
+        adapter_size = int(adapter_size)
+        current_size = getattr(self.config, 'adapter_size', None)
+        if current_size and current_size != adapter_size:
+            raise ValueError("The model already has adapters of size {}".format(current_size))
+        self.config.adapter_size = adapter_size
+        for layer in getattr(self, 'bert', self).encoder.layer:
+            for output in (layer.attention.output, layer.output):
+                if output.adapter is None:
+                    adapter = BertAdapter(self.config)
+                    adapter.apply(self.init_bert_weights)
+                    output.adapter = adapter.to(device=output.dense.weight.device, dtype=output.dense.weight.dtype)
+
+    def adapter_parameter_names(self):
+        """ Returns the names of the parameters tuned in adapter fine-tuning: the adapters, the LayerNorms
+            and the task heads. The other parameters of the encoder are frozen by `train_adapters_only`.
+        """
+        has_heads = hasattr(self, 'bert')
+        return [name for name, _ in self.named_parameters()
+                if '.adapter.' in name or '.LayerNorm.' in name or (has_heads and not name.startswith('bert.'))]
+
+    def train_adapters_only(self):
+        """ Parameter-efficient fine-tuning: freezes all the parameters except those of
+            `adapter_parameter_names`, so that the optimizer (built on the parameters which require grad)
+            only keeps a state for about 2% of the parameters. Adapters are added with `add_adapters`.
+        """
+        if not getattr(self.config, 'adapter_size', None):
+            raise ValueError("The model has no adapters, add them with `add_adapters(adapter_size)`.")
+        tuned_names = set(self.adapter_parameter_names())
+        for name, param in self.named_parameters():
+            param.requires_grad = name in tuned_names
+
+    def save_adapters(self, save_path):
+        """ Saves the parameters of `adapter_parameter_names` only, a small fraction of the checkpoint of
+            the model, to be loaded by `load_adapters` in a model built from the same pretrained model.
+        """
+        state_dict = self.state_dict()
+        torch.save(OrderedDict((name, state_dict[name]) for name in self.adapter_parameter_names()), save_path)
+
+    def load_adapters(self, save_path):
+        """ Loads adapters and heads saved by `save_adapters`, e.g. to switch the task of a resident model. """
+        state_dict = torch.load(save_path, map_location='cpu')
+        unexpected_keys = set(state_dict) - set(self.adapter_parameter_names())
+        if unexpected_keys:
+            raise ValueError("Weights not tuned with adapters in {}: {}".format(
+                save_path, ', '.join(sorted(unexpected_keys))))
+        self.load_state_dict(state_dict, strict=False)
+
+    def quantize_dynamic(self, dtype=None, inplace=False):
+        """ Converts the `nn.Linear` layers of the model (attention, intermediate, output, pooler and heads)
+            to int8 dynamic quantization for CPU inference. See `quantization.quantize_dynamic`.
+        """
+        from .quantization import quantize_dynamic
+        return quantize_dynamic(self, dtype=dtype, inplace=inplace)
+
+    def save_pretrained(self, save_directory, flat_weights=False, max_shard_size=None):
+        """ Saves the model configuration (`bert_config.json`) and weights (`pytorch_model.bin`) in
+            `save_directory` so that the model can be reloaded with `from_pretrained(save_directory)`.
+            If `flat_weights` is True, the weights are saved in the memory-mappable format of
+            `flat_weights.py` (`pytorch_model.flat`), which `from_pretrained` loads without copy.
+            If `max_shard_size` is set (in bytes, or a str like "500MB"), the weights are split in shards of
+            at most this size and an index (see `sharding.py`), which `from_pretrained` reads in parallel.
+        """
+        if flat_weights and max_shard_size is not None:
+            raise ValueError("Flat weights files can't be sharded.")
+        os.makedirs(save_directory, exist_ok=True)
+        with open(os.path.join(save_directory, CONFIG_NAME), 'w') as writer:
+            writer.write(self.config.to_json_string())
+        # Shared tensors are only saved under the key of their first occurrence
+        state_dict = self.state_dict()
+        for alias in shared_parameter_aliases(self):
+            del state_dict[alias]
+        if flat_weights:
+            save_flat_weights(state_dict, os.path.join(save_directory, FLAT_WEIGHTS_NAME))
+        elif max_shard_size is not None:
+            save_sharded_checkpoint(state_dict, save_directory, max_shard_size, weights_name=WEIGHTS_NAME)
+        else:
+            torch.save(state_dict, os.path.join(save_directory, WEIGHTS_NAME))
 
     @classmethod
-    def from_pretrained(cls, pretrained_model_name, *inputs, **kwargs):
+    def from_pretrained(cls, pretrained_model_name, *inputs, quantize=None, device=None, dtype=None, **kwargs):
         """
         Instantiate a PreTrainedBertModel from a pre-trained model file.
         Download and cache the pre-trained model file if needed.
@@ -456,12 +1248,31 @@ class PreTrainedBertModel(nn.Module):
                     . `bert-base-cased`
                     . `bert-base-multilingual`
                     . `bert-base-chinese`
-                - a path or url to a pretrained model archive containing:
+                - a path or url to a pretrained model archive (or a directory written by `save_pretrained`) containing:
                     . `bert_config.json` a configuration file for the model
-                    . `pytorch_model.bin` a PyTorch dump of a BertForPreTraining instance
+                    . `pytorch_model.bin` a PyTorch dump of a BertForPreTraining instance, or
+                      `pytorch_model.flat` the same weights in the format of `flat_weights.py`. These are
+                      memory-mapped and the parameters of the model (on CPU) are views of the mapping, or
+                      `pytorch_model.bin.index.json` the index of the shards of a sharded checkpoint. Only the
+                      shards holding weights of the model are read, in parallel.
+                  If the configuration describes a compressed model (pruned heads, low-rank layers, see
+                  `compression.factorize_linear_layers`, or quantized modules, see `quantization.quantize_static`),
+                  the compressed modules are rebuilt before loading the weights.
+            quantize: an optional str. If set to "int8", the loaded model is converted to int8 dynamic
+                quantization for CPU inference (see `quantize_dynamic`).
+            device: an optional torch.device (or str) on which the model is loaded. Default: CPU.
+            dtype: an optional floating point torch.dtype (or str, e.g. "float16") of the loaded weights.
+                The model is built on `device` (with PyTorch >= 2.0, on CPU then moved before) and converted to
+                `dtype` before loading, then each pretrained tensor is converted while copied in its parameter and
+                released. Zipfile checkpoints are memory-mapped (PyTorch >= 2.1) so that they are never
+                duplicated in host memory; legacy (non-zipfile) checkpoints are fully read first.
             *inputs, **kwargs: additional input for the specific Bert class
                 (ex: num_labels for BertForSequenceClassification)
         """
+        if quantize not in (None, 'int8'):
+            raise ValueError("Invalid quantize parameter: {} - should be None or 'int8'".format(quantize))
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype)
         if pretrained_model_name in PRETRAINED_MODEL_ARCHIVE_MAP:
             archive_file = PRETRAINED_MODEL_ARCHIVE_MAP[pretrained_model_name]
         else:
@@ -483,25 +1294,48 @@ class PreTrainedBertModel(nn.Module):
         else:
             logger.info("loading archive file {} from cache at {}".format(
                 archive_file, resolved_archive_file))
-        tempdir = None
         if os.path.isdir(resolved_archive_file):
             serialization_dir = resolved_archive_file
         else:
-            # Extract archive to temp dir
-            tempdir = tempfile.mkdtemp()
-            logger.info("extracting archive file {} to temp dir {}".format(
-                resolved_archive_file, tempdir))
-            with tarfile.open(resolved_archive_file, 'r:gz') as archive:
-                archive.extractall(tempdir)
-            serialization_dir = tempdir
+            # Archives are extracted once in the cache, next to the downloaded archive
+            serialization_dir = extracted_archive_path(resolved_archive_file)
+            logger.info("loading extracted archive from {}".format(serialization_dir))
         # Load config
         config_file = os.path.join(serialization_dir, CONFIG_NAME)
         config = BertConfig.from_json_file(config_file)
         logger.info("Model config {}".format(config))
-        # Instantiate model.
-        model = cls(config, *inputs, **kwargs)
-        weights_path = os.path.join(serialization_dir, WEIGHTS_NAME)
-        state_dict = torch.load(weights_path)
+        # Instantiate model on its device. The weights are not initialized, except the ones missing from the checkpoint
+        with no_init_weights(), _default_device(device):
+            model = cls(config, *inputs, **kwargs)
+            if getattr(config, 'pruned_heads', None):
+                model.prune_heads(config.pruned_heads)
+            if getattr(config, 'low_rank', None):
+                from .compression import convert_to_low_rank_structure
+                convert_to_low_rank_structure(model, config.low_rank)
+            if getattr(config, 'quantization', None) is not None:
+                from .quantization import convert_to_quantized_structure
+                convert_to_quantized_structure(model, config.quantization)
+        if device is not None or dtype is not None:
+            # Only converts the dtype when the model was built on `device`
+            model.to(device=device, dtype=dtype)
+        flat_weights_path = os.path.join(serialization_dir, FLAT_WEIGHTS_NAME)
+        index_path = os.path.join(serialization_dir, WEIGHTS_NAME + INDEX_SUFFIX)
+        use_flat_weights = os.path.exists(flat_weights_path)
+        if use_flat_weights:
+            state_dict = load_flat_weights(flat_weights_path)
+        elif os.path.exists(index_path):
+            # Partial load: the shards without weights of the model (e.g. pretraining heads) are not read
+            checkpoint_keys = read_index(index_path).keys()
+            start_prefix = _start_prefix(model, checkpoint_keys)
+            base_prefix = _base_model_prefix(model, checkpoint_keys)
+            keys = [start_prefix + key[len(base_prefix):] for key in model.state_dict() if key.startswith(base_prefix)]
+            state_dict = load_sharded_checkpoint(index_path, keys=keys + list(model.pretrained_key_map().values()))
+        else:
+            state_dict = _load_checkpoint(os.path.join(serialization_dir, WEIGHTS_NAME))
+        # Checkpoint of a `BertModel` loaded in a model with a head
+        base_prefix = _base_model_prefix(model, state_dict.keys())
+        if base_prefix:
+            state_dict = _add_prefix(state_dict, base_prefix)
 
         missing_keys = []
         unexpected_keys = []
@@ -516,19 +1350,45 @@ class PreTrainedBertModel(nn.Module):
             local_metadata = {} if metadata is None else metadata.get(prefix[:-1], {})
             module._load_from_state_dict(
                 state_dict, prefix, local_metadata, True, missing_keys, unexpected_keys, error_msgs)
+            # Release the pretrained tensors as soon as they are copied in the model
+            for name in list(module._parameters) + list(module._buffers):
+                state_dict.pop(prefix + name, None)
             for name, child in module._modules.items():
                 if child is not None:
                     load(child, prefix + name + '.')
-        load(model, prefix='' if hasattr(model, 'bert') else 'bert.')
+        start_prefix = _start_prefix(model, state_dict.keys())
+        for key, pretrained_key in model.pretrained_key_map().items():
+            if start_prefix + key not in state_dict and pretrained_key in state_dict:
+                state_dict[start_prefix + key] = state_dict[pretrained_key]
+        # Shared tensors are loaded once, from the key of their first occurrence
+        aliases = shared_parameter_aliases(model)
+        ignored_keys = [start_prefix + alias for alias in aliases if start_prefix + alias in state_dict]
+        for key in ignored_keys:
+            del state_dict[key]
+        if getattr(config, 'cross_layer_sharing', None) and len(ignored_keys) > 0:
+            logger.info("Parameters shared across layers are initialized from their first occurrence, "
+                        "ignoring {} weights of the pretrained model".format(len(ignored_keys)))
+        if use_flat_weights:
+            missing_keys, unexpected_keys = bind_state_dict(model, state_dict, prefix=start_prefix)
+        else:
+            load(model, prefix=start_prefix)
+        missing_keys = [key for key in missing_keys if key[len(start_prefix):] not in aliases]
+        # A checkpoint without any weight of the encoder is an error, not a model to initialize at random
+        base_model_keys = [start_prefix + key for key in model.state_dict() if key not in aliases and
+                           (key.startswith('bert.') or not hasattr(model, 'bert'))]
+        if set(base_model_keys) <= set(missing_keys):
+            logger.error("None of the weights of the encoder of {} were found in the pretrained model '{}'.".format(
+                model.__class__.__name__, pretrained_model_name))
+            return None
+        model.init_missing_weights([key[len(start_prefix):] for key in missing_keys])
         if len(missing_keys) > 0:
             logger.info("Weights of {} not initialized from pretrained model: {}".format(
                 model.__class__.__name__, missing_keys))
         if len(unexpected_keys) > 0:
             logger.info("Weights from pretrained model not used in {}: {}".format(
                 model.__class__.__name__, unexpected_keys))
-        if tempdir:
-            # Clean up temp dir
-            shutil.rmtree(tempdir)
+        if quantize == 'int8':
+            model = model.quantize_dynamic(inplace=True)
         return model
 
 
@@ -582,8 +1442,24 @@ class BertModel(PreTrainedBertModel):
         self.encoder = BertEncoder(config)
         self.pooler = BertPooler(config)
         self.apply(self.init_bert_weights)
+        # Autocast dtype set by `set_mixed_precision`, None runs in the dtype of the weights
+        self.mixed_precision_dtype = None
 
     def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
+        mixed_precision_dtype = getattr(self, 'mixed_precision_dtype', None)
+        if mixed_precision_dtype is None:
+            return self._forward(input_ids, token_type_ids, attention_mask, output_all_encoded_layers)
+        with torch.autocast(device_type=input_ids.device.type, dtype=mixed_precision_dtype):
+            encoded_layers, pooled_output = self._forward(input_ids, token_type_ids, attention_mask,
+                                                          output_all_encoded_layers)
+        # The heads and the losses are computed in float32
+        if output_all_encoded_layers:
+            encoded_layers = [layer.float() for layer in encoded_layers]
+        else:
+            encoded_layers = encoded_layers.float()
+        return encoded_layers, pooled_output.float()
+
+    def _forward(self, input_ids, token_type_ids, attention_mask, output_all_encoded_layers):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -603,8 +1479,12 @@ class BertModel(PreTrainedBertModel):
         # effectively the same as removing these entirely.
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        if getattr(self.config, 'attention_window', None):
+            # Local attention takes the mask itself, with 2 for global tokens (see `BertSelfAttention.local_attention`)
+            extended_attention_mask = attention_mask
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not _is_frozen(self.embeddings)):
+            embedding_output = self.embeddings(input_ids, token_type_ids)
         encoded_layers = self.encoder(embedding_output,
                                       extended_attention_mask,
                                       output_all_encoded_layers=output_all_encoded_layers)
@@ -637,10 +1517,17 @@ class BertForPreTraining(PreTrainedBertModel):
             a batch has varying length sentences.
         `masked_lm_labels`: masked language modeling labels: torch.LongTensor of shape [batch_size, sequence_length]
             with indices selected in [-1, 0, ..., vocab_size]. All labels set to -1 are ignored (masked), the loss
-            is only computed for the labels set in [0, ..., vocab_size]
+            is only computed for the labels set in [0, ..., vocab_size]. Only the labelled positions are fed
+            to the masked language modeling head when computing the loss.
+            If `masked_lm_positions` is given, the labels are of shape [batch_size, num_masked_positions]
+            and aligned with `masked_lm_positions`.
         `next_sentence_label`: next sentence classification loss: torch.LongTensor of shape [batch_size]
             with indices selected in [0, 1].
             0 => next sentence is the continuation, 1 => next sentence is a random sentence.
+        `masked_lm_positions`: an optional torch.LongTensor of shape [batch_size, num_masked_positions] with
+            the indices of the positions to predict. When given, only these positions are projected on the
+            vocabulary and the masked language modeling logits are of shape
+            [batch_size, num_masked_positions, vocab_size].
 
     Outputs:
         if `masked_lm_labels` and `next_sentence_label` are not `None`:
@@ -671,9 +1558,14 @@ class BertForPreTraining(PreTrainedBertModel):
         self.cls = BertPreTrainingHeads(config, self.bert.embeddings.word_embeddings.weight)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None, next_sentence_label=None):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None, next_sentence_label=None,
+                masked_lm_positions=None):
         sequence_output, pooled_output = self.bert(input_ids, token_type_ids, attention_mask,
                                                    output_all_encoded_layers=False)
+        if masked_lm_positions is not None:
+            sequence_output = gather_positions(sequence_output, masked_lm_positions)
+        if masked_lm_labels is not None and next_sentence_label is not None:
+            sequence_output, masked_lm_labels = select_labelled_positions(sequence_output, masked_lm_labels)
         prediction_scores, seq_relationship_score = self.cls(sequence_output, pooled_output)
 
         if masked_lm_labels is not None and next_sentence_label is not None:
@@ -706,10 +1598,17 @@ class BertForMaskedLM(PreTrainedBertModel):
             a batch has varying length sentences.
         `masked_lm_labels`: masked language modeling labels: torch.LongTensor of shape [batch_size, sequence_length]
             with indices selected in [-1, 0, ..., vocab_size]. All labels set to -1 are ignored (masked), the loss
-            is only computed for the labels set in [0, ..., vocab_size]
+            is only computed for the labels set in [0, ..., vocab_size]. Only the labelled positions are fed
+            to the masked language modeling head when computing the loss.
+            If `masked_lm_positions` is given, the labels are of shape [batch_size, num_masked_positions]
+            and aligned with `masked_lm_positions`.
+        `masked_lm_positions`: an optional torch.LongTensor of shape [batch_size, num_masked_positions] with
+            the indices of the positions to predict. When given, only these positions are projected on the
+            vocabulary and the masked language modeling logits are of shape
+            [batch_size, num_masked_positions, vocab_size].
 
     Outputs:
-        if `masked_lm_labels` is `None`:
+        if `masked_lm_labels` is not `None`:
             Outputs the masked language modeling loss.
         if `masked_lm_labels` is `None`:
             Outputs the masked language modeling logits.
@@ -734,9 +1633,14 @@ class BertForMaskedLM(PreTrainedBertModel):
         self.cls = BertOnlyMLMHead(config, self.bert.embeddings.word_embeddings.weight)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None,
+                masked_lm_positions=None):
         sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask,
                                        output_all_encoded_layers=False)
+        if masked_lm_positions is not None:
+            sequence_output = gather_positions(sequence_output, masked_lm_positions)
+        if masked_lm_labels is not None:
+            sequence_output, masked_lm_labels = select_labelled_positions(sequence_output, masked_lm_labels)
         prediction_scores = self.cls(sequence_output)
 
         if masked_lm_labels is not None:
@@ -746,6 +1650,39 @@ class BertForMaskedLM(PreTrainedBertModel):
         else:
             return prediction_scores
 
+    def score_candidates(self, input_ids, masked_lm_positions, candidate_ids=None, token_type_ids=None,
+                         attention_mask=None, top_k=None, chunk_size=4096):
+        """ Scores masked positions against a small set of candidate tokens (e.g. for cloze-style evaluation)
+            without projecting them on the full vocabulary.
+
+        Inputs:
+            `input_ids`, `token_type_ids`, `attention_mask`: same as in `forward`.
+            `masked_lm_positions`: a torch.LongTensor of shape [batch_size, num_masked_positions] with the
+                indices of the positions to score.
+            `candidate_ids`: an optional torch.LongTensor of shape [batch_size, num_masked_positions, num_candidates]
+                with the vocabulary indices of the candidates of each masked position.
+            `top_k`: an optional int. If set, also computes the `top_k` best tokens over the full vocabulary,
+                `chunk_size` vocabulary rows at a time so the full logit matrix is never materialized.
+
+        Outputs:
+            if `candidate_ids` is not `None`: the candidate logits, a torch.FloatTensor of shape
+                [batch_size, num_masked_positions, num_candidates].
+            if `top_k` is not `None`: a tuple (top_k_scores, top_k_ids) of shape [batch_size, num_masked_positions, top_k].
+            if both are set: a tuple (candidate_scores, top_k_scores, top_k_ids).
+        """
+        if candidate_ids is None and top_k is None:
+            raise ValueError("At least one of `candidate_ids` or `top_k` must be set.")
+        sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask,
+                                       output_all_encoded_layers=False)
+        sequence_output = gather_positions(sequence_output, masked_lm_positions)
+
+        outputs = ()
+        if candidate_ids is not None:
+            outputs += (self.cls.predictions.candidate_scores(sequence_output, candidate_ids),)
+        if top_k is not None:
+            outputs += self.cls.predictions.top_k(sequence_output, top_k, chunk_size=chunk_size)
+        return outputs[0] if len(outputs) == 1 else outputs
+
 
 class BertForNextSentencePrediction(PreTrainedBertModel):
     """BERT model with next sentence prediction head.
@@ -1041,3 +1978,213 @@ class BertForQuestionAnswering(PreTrainedBertModel):
             return total_loss
         else:
             return start_logits, end_logits
+
+
+class BertForLongDocumentClassification(PreTrainedBertModel):
+    """BERT model for the classification of documents longer than `max_position_embeddings` tokens.
+    The documents are split in chunks (see `tokenization.chunk_tokens`) encoded by `BertModel` as one batch
+    of chunks, and the pooled outputs of the chunks of each document are aggregated by an attention or
+    mean pooling layer followed by a linear classifier.
+
+    Params:
+        `config`: a BertConfig class instance with the configuration to build a new model.
+        `num_labels`: the number of classes for the classifier. Default = 2.
+        `pooling`: aggregation of the chunks of a document: 'attention' (a learned weighted average) or
+            'mean'. Default = 'attention'.
+        `chunk_batch_size`: an optional maximum number of chunks encoded at a time, to bound the memory used
+            by long documents. In training, the micro-batches of chunks are recomputed in the backward pass
+            so that the activations of only one micro-batch exist at a time. Default: all the chunks at once.
+
+    Inputs:
+        `input_ids`: a torch.LongTensor of shape [batch_size, num_chunks, chunk_length] with the word token
+            indices of the chunks of each document. Documents with fewer chunks are padded with chunks of
+            padding tokens, which are not encoded.
+        `token_type_ids`: an optional torch.LongTensor of shape [batch_size, num_chunks, chunk_length] with
+            the token types indices selected in [0, 1].
+        `attention_mask`: an optional torch.LongTensor of shape [batch_size, num_chunks, chunk_length] with
+            indices selected in [0, 1]. Chunks without any token are ignored. The document vector of a
+            document without any token is zero.
+        `labels`: labels for the classification output: torch.LongTensor of shape [batch_size]
+            with indices selected in [0, ..., num_labels].
+
+    Outputs:
+        if `labels` is not `None`:
+            Outputs a tuple of the CrossEntropy classification loss of the output with the labels and of the logits.
+        if `labels` is `None`:
+            Outputs the classification logits.
+
+    Example usage:
+    ```python
+    chunks = [tokenizer.convert_tokens_to_ids(chunk) for chunk in chunk_tokens(tokenizer.tokenize(text), 512)]
+    input_mask = [[1] * len(chunk) + [0] * (512 - len(chunk)) for chunk in chunks]
+    input_ids = [chunk + [0] * (512 - len(chunk)) for chunk in chunks]
+
+    model = BertForLongDocumentClassification.from_pretrained('bert-base-uncased', num_labels=2,
+                                                              chunk_batch_size=16)
+    logits = model(torch.LongTensor([input_ids]), attention_mask=torch.LongTensor([input_mask]))
+    ```
+    """
+    def __init__(self, config, num_labels=2, pooling='attention', chunk_batch_size=None):
+        super(BertForLongDocumentClassification, self).__init__(config)
+        if pooling not in ('attention', 'mean'):
+            raise ValueError("Invalid pooling: {} - should be 'attention' or 'mean'".format(pooling))
+        self.bert = BertModel(config)
+        self.pooling = pooling
+        self.chunk_batch_size = chunk_batch_size
+        self.chunk_attention = nn.Linear(config.hidden_size, 1) if pooling == 'attention' else None
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.classifier = nn.Linear(config.hidden_size, num_labels)
+        self.apply(self.init_bert_weights)
+
+    def encode_chunks(self, input_ids, token_type_ids, attention_mask):
+        _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
+        return pooled_output
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
+        batch_size, num_chunks, chunk_length = input_ids.size()
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        input_ids = input_ids.view(-1, chunk_length)
+        token_type_ids = token_type_ids.view(-1, chunk_length)
+        attention_mask = attention_mask.view(-1, chunk_length)
+
+        # Only the chunks with tokens are encoded, by micro-batches of `chunk_batch_size` chunks
+        chunk_mask = attention_mask.sum(-1) > 0
+        chunk_index = chunk_mask.nonzero().view(-1)
+        recompute = self.training and torch.is_grad_enabled() and self.chunk_batch_size is not None \
+            and _NON_REENTRANT_CHECKPOINT
+        step = self.chunk_batch_size or len(chunk_index)
+        pooled_outputs = []
+        for start in range(0, len(chunk_index), max(step, 1)):
+            index = chunk_index[start:start + step]
+            inputs = (input_ids[index], token_type_ids[index], attention_mask[index])
+            if recompute:
+                pooled_outputs.append(_checkpoint(self.encode_chunks, *inputs))
+            else:
+                pooled_outputs.append(self.encode_chunks(*inputs))
+        if pooled_outputs:
+            pooled_output = torch.cat(pooled_outputs)
+        else:
+            # Only empty documents: their chunk vectors are zeros
+            pooled_output = self.classifier.weight.new_zeros(0, self.classifier.in_features)
+        chunk_vectors = pooled_output.new_zeros(batch_size * num_chunks, pooled_output.size(-1))
+        chunk_vectors = chunk_vectors.index_copy(0, chunk_index, pooled_output).view(batch_size, num_chunks, -1)
+        chunk_mask = chunk_mask.view(batch_size, num_chunks)
+
+        if self.pooling == 'attention':
+            chunk_scores = self.chunk_attention(chunk_vectors).squeeze(-1).masked_fill(~chunk_mask, -10000.0)
+            chunk_weights = torch.nn.functional.softmax(chunk_scores, dim=-1)
+        else:
+            chunk_weights = chunk_mask.to(chunk_vectors.dtype)
+            chunk_weights = chunk_weights / chunk_weights.sum(-1, keepdim=True).clamp(min=1)
+        document_vectors = torch.matmul(chunk_weights.unsqueeze(1), chunk_vectors).squeeze(1)
+        logits = self.classifier(self.dropout(document_vectors))
+
+        if labels is not None:
+            loss_fct = CrossEntropyLoss()
+            loss = loss_fct(logits, labels)
+            return loss, logits
+        else:
+            return logits
+
+
+class BertMultiTask(PreTrainedBertModel):
+    """BERT model with several named task heads sharing one encoder.
+    The encoder runs once per batch and the requested heads are evaluated on its shared
+    `sequence_output` / `pooled_output`, instead of running one fine-tuned model per task.
+
+    Params:
+        `config`: a BertConfig class instance with the configuration to build a new model.
+        `heads`: a dict of {task name: head}, a head being a type of `MULTI_TASK_HEADS` or a tuple of
+            (type, argument):
+            - 'classification' or ('classification', num_labels): a classifier on the pooled output,
+            - ('multiple_choice', num_options): a multiple choice classifier on the pooled output,
+            - 'span': start and end logits of answer spans on the sequence output,
+            - 'mlm': a masked language modeling head tied to the word embeddings, loaded by `from_pretrained`
+              from the `cls.predictions` weights of pretraining and masked language modeling checkpoints.
+            The heads are not saved in the configuration and must be given again to `from_pretrained`.
+
+    Inputs:
+        `input_ids`: a torch.LongTensor of shape [batch_size, sequence_length] with the word token indices in
+            the vocabulary, or of shape [batch_size, num_options, sequence_length] for multiple choice heads.
+            The options are then flattened in the batch seen by every head.
+        `token_type_ids`: an optional torch.LongTensor of the shape of `input_ids` with the token types
+            indices selected in [0, 1].
+        `attention_mask`: an optional torch.LongTensor of the shape of `input_ids` with indices selected in [0, 1].
+        `tasks`: an optional list of the names of the heads to evaluate. Default: the tasks of `labels` if
+            given, else all the heads.
+        `labels`: an optional dict of {task name: labels} with the labels of the matching single-task model
+            (a tuple (start_positions, end_positions) for 'span' heads, the masked language modeling labels
+            for 'mlm' heads).
+
+    Outputs:
+        if `labels` is not `None`:
+            Outputs a tuple of the sum of the losses of the labelled tasks (a zero tensor if no task is
+            labelled) and of a dict of {task name: loss}.
+        if `labels` is `None`:
+            Outputs a dict of {task name: outputs of its head}.
+
+    Example usage:
+    ```python
+    heads = {'sentiment': ('classification', 3), 'qa': 'span', 'mlm': 'mlm'}
+    model = BertMultiTask.from_pretrained('bert-base-uncased', heads=heads)
+    outputs = model(input_ids, token_type_ids, input_mask, tasks=['sentiment', 'qa'])
+    sentiment_logits = outputs['sentiment']
+    start_logits, end_logits = outputs['qa']
+    ```
+    """
+    def __init__(self, config, heads):
+        super(BertMultiTask, self).__init__(config)
+        self.bert = BertModel(config)
+        self.heads = nn.ModuleDict()
+        for name, head in heads.items():
+            head_type, head_args = (head[0], tuple(head[1:])) if isinstance(head, (tuple, list)) else (head, ())
+            if head_type not in MULTI_TASK_HEADS:
+                raise ValueError("Invalid head type for task {}: {} - should be one of {}".format(
+                    name, head_type, ', '.join(sorted(MULTI_TASK_HEADS))))
+            if head_type == 'mlm':
+                head_args = (self.bert.embeddings.word_embeddings.weight,) + head_args
+            self.heads[name] = MULTI_TASK_HEADS[head_type](config, *head_args)
+        self.apply(self.init_bert_weights)
+
+    def pretrained_key_map(self):
+        """ The masked language modeling heads are loaded from the `cls.predictions` weights of the
+            checkpoints of `BertForPreTraining` and `BertForMaskedLM`.
+        """
+        key_map = {}
+        for name, head in self.heads.items():
+            if isinstance(head, BertMaskedLMHead):
+                for key in head.predictions.state_dict():
+                    key_map['heads.{}.predictions.{}'.format(name, key)] = 'cls.predictions.' + key
+        return key_map
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, tasks=None, labels=None):
+        if tasks is None:
+            tasks = list(labels.keys()) if labels is not None else list(self.heads.keys())
+        unknown_tasks = [task for task in tasks if task not in self.heads]
+        if unknown_tasks:
+            raise ValueError("Unknown tasks: {} - the heads of this model are {}".format(
+                ', '.join(unknown_tasks), ', '.join(self.heads.keys())))
+
+        if input_ids.dim() == 3:
+            input_ids = input_ids.view(-1, input_ids.size(-1))
+            if token_type_ids is not None:
+                token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1))
+            if attention_mask is not None:
+                attention_mask = attention_mask.view(-1, attention_mask.size(-1))
+        sequence_output, pooled_output = self.bert(input_ids, token_type_ids, attention_mask,
+                                                   output_all_encoded_layers=False)
+
+        if labels is None:
+            return dict((task, self.heads[task](sequence_output, pooled_output)) for task in tasks)
+        losses = {}
+        for task in tasks:
+            if labels.get(task) is not None:
+                losses[task], _ = self.heads[task](sequence_output, pooled_output, labels[task])
+        # Zero loss connected to the graph if no task is labelled in this batch
+        total_loss = pooled_output.sum() * 0.0
+        for loss in losses.values():
+            total_loss = total_loss + loss
+        return total_loss, losses
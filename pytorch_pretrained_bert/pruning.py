@@ -0,0 +1,215 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Structured pruning utilities for BERT models."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+_NO_GRADIENT_ERROR = ("No gradient reaches the {} of layer {}: the layer and the layers below it are frozen "
+                      "(see `freeze_layers`). Unfreeze them to compute gradient based importance scores.")
+
+
+def _base_model(model):
+    return getattr(model, 'bert', model)
+
+
+def _loss(model, batch, device):
+    """ Computes the loss of a task model on a batch (input_ids, input_mask, segment_ids, label_ids),
+        as built in `run_classifier.py`.
+    """
+    input_ids, input_mask, segment_ids, label_ids = tuple(t.to(device) for t in batch[:4])
+    outputs = model(input_ids, segment_ids, input_mask, label_ids)
+    return outputs[0] if isinstance(outputs, tuple) else outputs
+
+
+def compute_head_importance(model, dataloader, device='cpu', num_batches=None, normalize=True):
+    """ Scores the attention heads by gradient sensitivity: the absolute gradient of the loss with
+        respect to a mask multiplying the output of each head, accumulated over a dataset
+        (Michel et al., 2019, "Are Sixteen Heads Really Better than One?").
+
+    Params:
+        model: a task model returning its loss (or a tuple starting with the loss) when called
+            with labels, e.g. `BertForSequenceClassification` or `BertForMultipleChoice`.
+        dataloader: an iterable of batches (input_ids, input_mask, segment_ids, label_ids).
+        num_batches: maximum number of batches to use. Default: the whole dataloader.
+        normalize: whether to normalize the scores of each layer by their L2 norm. Default: True.
+
+    Returns a list with one torch.FloatTensor of shape [num_attention_heads] per layer. Scores are
+    indexed by the current position of the heads in the (possibly already pruned) layer.
+    """
+    attentions = [layer.attention.self for layer in _base_model(model).encoder.layer]
+    head_masks = [torch.ones(attention.num_attention_heads, device=device, requires_grad=True)
+                  for attention in attentions]
+    head_importance = [torch.zeros(attention.num_attention_heads) for attention in attentions]
+
+    def make_hook(head_mask):
+        def hook(module, inputs, context_layer):
+            size = context_layer.size()
+            context_layer = context_layer.view(size[0], size[1], module.num_attention_heads,
+                                               module.attention_head_size)
+            return (context_layer * head_mask.view(1, 1, -1, 1)).view(*size)
+        return hook
+
+    hooks = [attention.register_forward_hook(make_hook(head_mask))
+             for attention, head_mask in zip(attentions, head_masks)]
+    model.eval()
+    try:
+        for step, batch in enumerate(dataloader):
+            if num_batches is not None and step >= num_batches:
+                break
+            loss = _loss(model, batch, device)
+            loss.backward()
+            for layer_num, (layer_importance, head_mask) in enumerate(zip(head_importance, head_masks)):
+                if head_mask.grad is None:
+                    raise ValueError(_NO_GRADIENT_ERROR.format('attention heads', layer_num))
+                layer_importance += head_mask.grad.detach().abs().cpu()
+                head_mask.grad.zero_()
+    finally:
+        for hook in hooks:
+            hook.remove()
+        model.zero_grad()
+
+    if normalize:
+        head_importance = [scores / (scores.norm() + 1e-20) for scores in head_importance]
+    return head_importance
+
+
+def select_heads_to_prune(model, head_importance, num_heads):
+    """ Selects the `num_heads` least important heads over the whole model, keeping at least one head
+        per layer.
+
+    Returns a dict {layer_num: list of heads} to give to `model.prune_heads`, with the heads indexed
+    in the original, unpruned numbering.
+    """
+    candidates = []
+    for layer_num, scores in enumerate(head_importance):
+        attention = _base_model(model).encoder.layer[layer_num].attention
+        total_heads = attention.self.num_attention_heads + len(attention.pruned_heads)
+        original_heads = [head for head in range(total_heads) if head not in attention.pruned_heads]
+        for position, score in enumerate(scores.tolist()):
+            candidates.append((score, layer_num, original_heads[position]))
+    candidates.sort()
+
+    remaining_heads = [len(scores) for scores in head_importance]
+    heads_to_prune = {}
+    num_selected = 0
+    for _, layer_num, head in candidates:
+        if num_selected >= num_heads:
+            break
+        if remaining_heads[layer_num] <= 1:
+            continue
+        heads_to_prune.setdefault(layer_num, []).append(head)
+        remaining_heads[layer_num] -= 1
+        num_selected += 1
+    logger.info("Heads selected for pruning: {}".format(heads_to_prune))
+    return heads_to_prune
+
+
+def compute_neuron_importance(model, dataloader, method='taylor', device='cpu', num_batches=None):
+    """ Scores the neurons of the feed-forward blocks (outputs of `BertIntermediate`) over a dataset.
+
+    Params:
+        model: a task model returning its loss when called with labels (see `compute_head_importance`).
+        dataloader: an iterable of batches (input_ids, input_mask, segment_ids, label_ids).
+        method: either
+            - `activation`: mean absolute activation of the neuron, or
+            - `taylor`: first order Taylor estimate of the change of the loss when the neuron is removed,
+              |sum over tokens of activation * gradient|, summed over examples (Molchanov et al., 2017).
+              Requires gradients to reach every layer, i.e. no layer frozen together with all the layers
+              below it (see `freeze_layers`).
+        num_batches: maximum number of batches to use. Default: the whole dataloader.
+
+    Returns a list with one torch.FloatTensor of shape [intermediate_size] per layer.
+    """
+    if method not in ('activation', 'taylor'):
+        raise ValueError("Invalid method: {} - should be 'activation' or 'taylor'".format(method))
+    intermediates = [layer.intermediate for layer in _base_model(model).encoder.layer]
+    neuron_importance = [torch.zeros(intermediate.dense.out_features) for intermediate in intermediates]
+    # Whether the backward pass of the current batch is running, and the per-example sums over the tokens
+    # of activation * gradient of each layer, accumulated over the chunks of a chunked feed-forward block
+    in_backward = [False]
+    taylor_sums = {}
+
+    def make_hook(layer_num, layer_importance):
+        def hook(module, inputs, activation):
+            if method == 'activation':
+                layer_importance.add_(activation.detach().abs().sum(dim=1).sum(dim=0).cpu())
+            elif torch.is_grad_enabled() and activation.requires_grad and not in_backward[0]:
+                # Activations recomputed in the backward pass (checkpointed layers) are skipped so that
+                # each forward pass is only counted once
+                def grad_hook(grad):
+                    taylor = (activation.detach() * grad).sum(dim=1)
+                    if layer_num in taylor_sums:
+                        taylor = taylor + taylor_sums[layer_num]
+                    taylor_sums[layer_num] = taylor
+                activation.register_hook(grad_hook)
+        return hook
+
+    hooks = [intermediate.register_forward_hook(make_hook(layer_num, layer_importance))
+             for layer_num, (intermediate, layer_importance) in enumerate(zip(intermediates, neuron_importance))]
+    nb_tokens = 0
+    model.eval()
+    try:
+        for step, batch in enumerate(dataloader):
+            if num_batches is not None and step >= num_batches:
+                break
+            if method == 'activation':
+                with torch.no_grad():
+                    _loss(model, batch, device)
+            else:
+                loss = _loss(model, batch, device)
+                taylor_sums.clear()
+                in_backward[0] = True
+                try:
+                    loss.backward()
+                finally:
+                    in_backward[0] = False
+                for layer_num, layer_importance in enumerate(neuron_importance):
+                    if layer_num not in taylor_sums:
+                        raise ValueError(_NO_GRADIENT_ERROR.format('feed-forward block', layer_num))
+                    layer_importance.add_(taylor_sums[layer_num].abs().sum(dim=0).cpu())
+            nb_tokens += batch[0].numel()
+    finally:
+        for hook in hooks:
+            hook.remove()
+        model.zero_grad()
+
+    if method == 'activation':
+        neuron_importance = [scores / max(nb_tokens, 1) for scores in neuron_importance]
+    return neuron_importance
+
+
+def select_neurons_to_prune(neuron_importance, prune_ratio):
+    """ Selects, in each layer, the `prune_ratio` fraction of least important feed-forward neurons
+        (keeping at least one).
+
+    Returns a dict {layer_num: list of neurons} to give to `model.prune_intermediate_neurons`.
+    """
+    if not 0.0 <= prune_ratio < 1.0:
+        raise ValueError("Invalid prune_ratio: {} - should be in [0.0, 1.0[".format(prune_ratio))
+    neurons_to_prune = {}
+    for layer_num, scores in enumerate(neuron_importance):
+        num_neurons = min(int(len(scores) * prune_ratio), len(scores) - 1)
+        if num_neurons > 0:
+            neurons_to_prune[layer_num] = scores.argsort()[:num_neurons].tolist()
+    return neurons_to_prune
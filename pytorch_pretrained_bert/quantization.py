@@ -0,0 +1,340 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Int8 quantization utilities for CPU inference with BERT models."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import logging
+
+import torch
+from torch import nn
+
+from .modeling import set_module, benchmark_latency
+
+logger = logging.getLogger(__name__)
+
+
+def _check_quantization_available():
+    if not hasattr(torch, 'quantization') or not hasattr(torch.quantization, 'quantize_dynamic'):
+        raise ImportError("Int8 quantization requires PyTorch >= 1.3. Please see "
+                          "https://pytorch.org/ for installation instructions.")
+
+
+def quantizable_linear_names(model):
+    """ Returns the names of the `nn.Linear` modules of `model` that are converted to int8:
+        attention, intermediate, output, pooler and task heads.
+        The masked language modeling decoder is skipped: its weight is tied to the word embeddings.
+    """
+    return set(name for name, module in model.named_modules()
+               if isinstance(module, nn.Linear) and not name.endswith('decoder'))
+
+
+def quantize_dynamic(model, dtype=None, inplace=False):
+    """ Converts the `nn.Linear` layers of a BERT model to int8 dynamic quantization
+        (weights stored in int8, activations quantized on the fly) for CPU inference.
+
+    Params:
+        model: a `PreTrainedBertModel` instance.
+        dtype: quantized weight type. Default: `torch.qint8`.
+        inplace: whether to convert `model` in place or to return a converted copy. Default: False.
+            The converted model is in eval mode. Unless converted in place, `model` keeps its training mode.
+    """
+    _check_quantization_available()
+    if dtype is None:
+        dtype = torch.qint8
+    training = model.training
+    model.eval()
+    try:
+        return torch.quantization.quantize_dynamic(model, quantizable_linear_names(model),
+                                                   dtype=dtype, inplace=inplace)
+    finally:
+        if not inplace:
+            model.train(training)
+
+
+def _activation_qparams(min_val, max_val):
+    """ Returns the (scale, zero_point) of an asymmetric quint8 quantization of the range [min_val, max_val]. """
+    min_val, max_val = min(min_val, 0.0), max(max_val, 0.0)
+    scale = (max_val - min_val) / 255.0
+    if scale == 0.0:
+        scale = 1.0
+    zero_point = min(255, max(0, int(round(-min_val / scale))))
+    return scale, zero_point
+
+
+class StaticQuantizedLinear(nn.Module):
+    """ A `nn.Linear` with int8 per-output-channel weights whose input and output activations are
+        quantized to int8 with scales calibrated beforehand (see `quantize_static`).
+        Non linear operations (LayerNorm, softmax, activation functions) stay in fp32 around it.
+    """
+    def __init__(self, in_features, out_features):
+        super(StaticQuantizedLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer('weight_int8', torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer('weight_scale', torch.ones(out_features))
+        self.register_buffer('bias', torch.zeros(out_features))
+        # (scale, zero_point) of the input and output activations
+        self.register_buffer('input_qparams', torch.tensor([1.0, 0.0]))
+        self.register_buffer('output_qparams', torch.tensor([1.0, 0.0]))
+        self._packed_params = None
+
+    @classmethod
+    def from_float(cls, linear, input_range, output_range):
+        module = cls(linear.in_features, linear.out_features)
+        weight = linear.weight.data.float()
+        scale = weight.abs().max(dim=1)[0].clamp(min=1e-8) / 127.0
+        module.weight_int8.copy_(torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8))
+        module.weight_scale.copy_(scale)
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.data)
+        module.input_qparams.copy_(torch.tensor(_activation_qparams(*input_range)))
+        module.output_qparams.copy_(torch.tensor(_activation_qparams(*output_range)))
+        return module
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super(StaticQuantizedLinear, self)._load_from_state_dict(*args, **kwargs)
+        self._packed_params = None
+
+    def _pack(self):
+        weight = self.weight_int8.float() * self.weight_scale.unsqueeze(1)
+        zero_points = torch.zeros(self.out_features, dtype=torch.long)
+        qweight = torch.quantize_per_channel(weight, self.weight_scale.double(), zero_points, 0, torch.qint8)
+        self._packed_params = torch.ops.quantized.linear_prepack(qweight, self.bias)
+
+    def forward(self, x):
+        if self._packed_params is None:
+            self._pack()
+        input_scale, input_zero_point = self.input_qparams.tolist()
+        output_scale, output_zero_point = self.output_qparams.tolist()
+        output_shape = x.size()[:-1] + (self.out_features,)
+        qx = torch.quantize_per_tensor(x.float().contiguous().view(-1, self.in_features),
+                                       input_scale, int(input_zero_point), torch.quint8)
+        qy = torch.ops.quantized.linear(qx, self._packed_params, output_scale, int(output_zero_point))
+        return qy.dequantize().view(*output_shape)
+
+    def extra_repr(self):
+        return 'in_features={}, out_features={}'.format(self.in_features, self.out_features)
+
+
+class Int8Embedding(nn.Module):
+    """ An embedding table stored in int8 with one fp32 scale per row, dequantized on lookup.
+    """
+    def __init__(self, num_embeddings, embedding_dim):
+        super(Int8Embedding, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.register_buffer('weight_int8', torch.zeros(num_embeddings, embedding_dim, dtype=torch.int8))
+        self.register_buffer('weight_scale', torch.ones(num_embeddings))
+
+    @classmethod
+    def from_float(cls, embedding):
+        module = cls(embedding.num_embeddings, embedding.embedding_dim)
+        weight = embedding.weight.data.float()
+        scale = weight.abs().max(dim=1)[0].clamp(min=1e-8) / 127.0
+        module.weight_int8.copy_(torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8))
+        module.weight_scale.copy_(scale)
+        return module
+
+    def forward(self, input_ids):
+        flat_ids = input_ids.contiguous().view(-1)
+        rows = self.weight_int8.index_select(0, flat_ids).float()
+        rows = rows * self.weight_scale.index_select(0, flat_ids).unsqueeze(1)
+        return rows.view(*(tuple(input_ids.size()) + (self.embedding_dim,)))
+
+    def extra_repr(self):
+        return '{}, {}'.format(self.num_embeddings, self.embedding_dim)
+
+
+def _tied_weight_ids(model):
+    """ Ids of the embedding weights shared with the masked language modeling decoder. """
+    return set(id(module.weight) for name, module in model.named_modules() if name.endswith('decoder'))
+
+
+def calibrate(model, calibration_dataloader, num_batches=None, device='cpu'):
+    """ Runs the model on a calibration set and records the range of the input and output activations
+        of each quantizable `nn.Linear`. The inputs of the query/key/value projections are the
+        activations at the `BertLayer` boundaries (output of the previous LayerNorm).
+
+    Params:
+        calibration_dataloader: an iterable of batches starting with (input_ids, input_mask, segment_ids),
+            as built in `run_classifier.py`.
+        num_batches: maximum number of batches to use. Default: the whole dataloader.
+
+    Returns a dict {module name: {'input': [min, max], 'output': [min, max]}}.
+    """
+    ranges = {}
+
+    def make_hook(name):
+        def hook(module, inputs, output):
+            for key, tensor in (('input', inputs[0]), ('output', output)):
+                low, high = tensor.min().item(), tensor.max().item()
+                module_ranges = ranges.setdefault(name, {})
+                if key in module_ranges:
+                    low, high = min(low, module_ranges[key][0]), max(high, module_ranges[key][1])
+                module_ranges[key] = [low, high]
+        return hook
+
+    linear_names = quantizable_linear_names(model)
+    hooks = [module.register_forward_hook(make_hook(name))
+             for name, module in model.named_modules() if name in linear_names]
+    model.eval()
+    try:
+        for step, batch in enumerate(calibration_dataloader):
+            if num_batches is not None and step >= num_batches:
+                break
+            _forward(model, batch, device)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return ranges
+
+
+def quantize_static(model, calibration_dataloader, num_batches=None, quantize_embeddings=True, inplace=False):
+    """ Static post-training int8 quantization of a BERT model for CPU inference.
+
+        The activation ranges are collected on a calibration set (see `calibrate`), the `nn.Linear` layers
+        are replaced by `StaticQuantizedLinear` and the embedding tables by `Int8Embedding` (int8 with a
+        scale per row). LayerNorm, softmax and activation functions stay in fp32.
+        The quantization scheme is recorded in `model.config.quantization` so that the checkpoint written
+        by `model.save_pretrained(...)` is self-describing and can be reloaded with `from_pretrained`.
+
+    Params:
+        model: a `PreTrainedBertModel` instance.
+        calibration_dataloader, num_batches: see `calibrate`.
+        quantize_embeddings: whether to store the embedding tables in int8. The word embeddings
+            tied to a masked language modeling decoder are kept in fp32. Default: True.
+        inplace: whether to convert `model` in place or to return a converted copy. Default: False.
+    """
+    _check_quantization_available()
+    if not inplace:
+        model = copy.deepcopy(model)
+    ranges = calibrate(model, calibration_dataloader, num_batches=num_batches)
+    modules = dict(model.named_modules())
+
+    linear_names = sorted(ranges.keys())
+    for name in linear_names:
+        set_module(model, name, StaticQuantizedLinear.from_float(modules[name], ranges[name]['input'],
+                                                                 ranges[name]['output']))
+    embedding_names = []
+    if quantize_embeddings:
+        tied_weight_ids = _tied_weight_ids(model)
+        for name, module in modules.items():
+            if isinstance(module, nn.Embedding):
+                if id(module.weight) in tied_weight_ids:
+                    logger.info("Keeping {} in fp32: it is tied to the decoder".format(name))
+                    continue
+                embedding_names.append(name)
+        for name in embedding_names:
+            set_module(model, name, Int8Embedding.from_float(modules[name]))
+
+    model.config.quantization = {'scheme': 'static_int8',
+                                 'linear_modules': linear_names,
+                                 'embedding_modules': embedding_names}
+    return model
+
+
+def convert_to_quantized_structure(model, quantization):
+    """ Replaces the modules listed in a `config.quantization` description by empty quantized modules,
+        so that a quantized state_dict can be loaded in `model`. Used by `from_pretrained`.
+    """
+    if quantization.get('scheme') != 'static_int8':
+        raise ValueError("Unknown quantization scheme: {}".format(quantization.get('scheme')))
+    modules = dict(model.named_modules())
+
+    def resolve(name):
+        # Checkpoints saved from a model with a head can be loaded in a `BertModel` (without `bert.` prefix)
+        if name not in modules and name.startswith('bert.'):
+            name = name[len('bert.'):]
+        return name if name in modules else None
+
+    for saved_name in quantization.get('linear_modules', []):
+        name = resolve(saved_name)
+        if name is not None:
+            linear = modules[name]
+            set_module(model, name, StaticQuantizedLinear(linear.in_features, linear.out_features))
+    for saved_name in quantization.get('embedding_modules', []):
+        name = resolve(saved_name)
+        if name is not None:
+            embedding = modules[name]
+            set_module(model, name, Int8Embedding(embedding.num_embeddings, embedding.embedding_dim))
+    return model
+
+
+def _forward(model, batch, device):
+    input_ids, input_mask, segment_ids = tuple(t.to(device) for t in batch[:3])
+    with torch.no_grad():
+        return model(input_ids, segment_ids, input_mask)
+
+
+def _predict(model, batch, device):
+    logits = _forward(model, batch, device)
+    if isinstance(logits, tuple):
+        logits = logits[0]
+    return logits.view(batch[0].size(0), -1)
+
+
+def accuracy_delta(model, quantized_model, eval_dataloader, device='cpu'):
+    """ Compares the accuracy of a model and of its quantized version on an evaluation set.
+
+    Params:
+        model, quantized_model: classification models (e.g. `BertForSequenceClassification`
+            or `BertForMultipleChoice`) returning logits when called without labels.
+        eval_dataloader: an iterable of batches (input_ids, input_mask, segment_ids, label_ids),
+            as built in `run_classifier.py`.
+
+    Returns a dict with `accuracy`, `quantized_accuracy`, `accuracy_delta` (quantized - original),
+    `agreement` (fraction of identical predictions) and `max_logit_diff`.
+    """
+    model.eval()
+    quantized_model.eval()
+    nb_examples, nb_correct, nb_quantized_correct, nb_agree = 0, 0, 0, 0
+    max_logit_diff = 0.0
+    for batch in eval_dataloader:
+        label_ids = batch[3].to(device)
+        logits = _predict(model, batch, device)
+        quantized_logits = _predict(quantized_model, batch, device)
+        predictions = logits.argmax(-1)
+        quantized_predictions = quantized_logits.argmax(-1)
+        nb_correct += (predictions == label_ids).sum().item()
+        nb_quantized_correct += (quantized_predictions == label_ids).sum().item()
+        nb_agree += (predictions == quantized_predictions).sum().item()
+        max_logit_diff = max(max_logit_diff, (logits - quantized_logits).abs().max().item())
+        nb_examples += label_ids.size(0)
+    if nb_examples == 0:
+        raise ValueError("The evaluation set is empty.")
+    result = {'accuracy': nb_correct / nb_examples,
+              'quantized_accuracy': nb_quantized_correct / nb_examples,
+              'agreement': nb_agree / nb_examples,
+              'max_logit_diff': max_logit_diff}
+    result['accuracy_delta'] = result['quantized_accuracy'] - result['accuracy']
+    logger.info("Quantization accuracy check: {}".format(result))
+    return result
+
+
+def compare_latency(model, quantized_model, input_ids, token_type_ids=None, attention_mask=None, num_runs=20):
+    """ Returns a dict with the average latency of `model` and `quantized_model` and the speedup.
+    """
+    latency = benchmark_latency(model, input_ids, token_type_ids, attention_mask, num_runs=num_runs)
+    quantized_latency = benchmark_latency(quantized_model, input_ids, token_type_ids, attention_mask,
+                                          num_runs=num_runs)
+    result = {'latency': latency,
+              'quantized_latency': quantized_latency,
+              'speedup': latency / quantized_latency}
+    logger.info("Quantization latency check: {}".format(result))
+    return result
@@ -0,0 +1,206 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Process-wide registry of pretrained backbones shared by several task models."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import logging
+import threading
+
+from torch import nn
+
+from .file_utils import cached_path, archive_key
+from .modeling import PRETRAINED_MODEL_ARCHIVE_MAP, BertModel, BertLMPredictionHead, no_init_weights
+
+logger = logging.getLogger(__name__)
+
+
+class FrozenBackbone(nn.Module):
+    """ Wraps a `BertModel` shared by several task models: its parameters don't require gradients and it
+        stays in eval mode whatever the mode of the task models using it.
+
+        The wrapper holds the submodules of the backbone itself, so that the task models have the same
+        weight names as with a `BertModel`, and the other attributes of the backbone (e.g. `config`) are
+        read from it.
+    """
+    def __init__(self, backbone):
+        super(FrozenBackbone, self).__init__()
+        self.__dict__['backbone'] = backbone
+        self.__dict__['_modules'] = backbone._modules
+        for param in backbone.parameters():
+            param.requires_grad = False
+        self.train(False)
+
+    def train(self, mode=True):
+        self.training = False
+        self.backbone.eval()
+        return self
+
+    def forward(self, *inputs, **kwargs):
+        return self.backbone(*inputs, **kwargs)
+
+    def __getattr__(self, name):
+        try:
+            return super(FrozenBackbone, self).__getattr__(name)
+        except AttributeError:
+            if 'backbone' not in self.__dict__:
+                raise
+            return getattr(self.__dict__['backbone'], name)
+
+
+def _tensors_size(model):
+    tensors = {}
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        tensors[id(tensor)] = tensor
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
+
+
+class BackboneRegistry(object):
+    """ Loads each pretrained `BertModel` once per process and hands it out to the task models built with
+        `build_task_model`, so that only the task heads are separate.
+
+        The backbones are frozen (no gradients, always in eval mode, see `FrozenBackbone`) and reference
+        counted: a backbone is dropped from the registry when all the models using it are released.
+        Backbones are keyed by a hash of their resolved archive (see `file_utils.archive_key`), device and dtype.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> [backbone, reference count]
+        self._entries = {}
+        # key -> event set when the thread loading the backbone is done
+        self._loading = {}
+
+    def _key(self, pretrained_model_name, device=None, dtype=None):
+        archive_file = PRETRAINED_MODEL_ARCHIVE_MAP.get(pretrained_model_name, pretrained_model_name)
+        return archive_key(cached_path(archive_file)), str(device), str(dtype)
+
+    def _load(self, pretrained_model_name, device=None, dtype=None):
+        backbone = BertModel.from_pretrained(pretrained_model_name, device=device, dtype=dtype)
+        if backbone is None:
+            raise ValueError("The backbone {} could not be loaded.".format(pretrained_model_name))
+        return FrozenBackbone(backbone)
+
+    def acquire(self, pretrained_model_name, device=None, dtype=None):
+        """ Returns the shared `FrozenBackbone` of `pretrained_model_name` (see `from_pretrained`), loading it
+            if needed, and increments its reference count.
+            A backbone is loaded outside of the registry lock: the threads acquiring the same backbone wait
+            for the thread loading it, the others are not blocked.
+        """
+        key = self._key(pretrained_model_name, device, dtype)
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    entry = self._entries[key]
+                    entry[1] += 1
+                    return entry[0]
+                loaded = self._loading.get(key)
+                if loaded is None:
+                    loaded = self._loading[key] = threading.Event()
+                    break
+            # If the loading thread fails, the waiting threads try again
+            loaded.wait()
+        backbone = None
+        try:
+            backbone = self._load(pretrained_model_name, device=device, dtype=dtype)
+        finally:
+            with self._lock:
+                if backbone is not None:
+                    self._entries[key] = [backbone, 1]
+                del self._loading[key]
+            loaded.set()
+        logger.info("Registered backbone {} ({} bytes)".format(pretrained_model_name, _tensors_size(backbone)))
+        return backbone
+
+    def release(self, backbone):
+        """ Decrements the reference count of a backbone returned by `acquire` and removes it from the
+            registry when it reaches 0.
+        """
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry[0] is backbone:
+                    entry[1] -= 1
+                    if entry[1] <= 0:
+                        del self._entries[key]
+                        logger.info("Unregistered backbone {}".format(key[0]))
+                    return
+        raise ValueError("This backbone is not in the registry.")
+
+    def reference_count(self, backbone):
+        with self._lock:
+            for backbone_entry, count in self._entries.values():
+                if backbone_entry is backbone:
+                    return count
+        return 0
+
+    def memory_usage(self):
+        """ Returns a dict with the memory (in bytes) of the parameters and buffers of the registered
+            backbones (`backbones_bytes`), the memory that loading them once per task model would have used
+            (`unshared_bytes`) and the difference (`saved_bytes`).
+        """
+        with self._lock:
+            sizes = [(_tensors_size(backbone), count) for backbone, count in self._entries.values()]
+        backbones_bytes = sum(size for size, _ in sizes)
+        unshared_bytes = sum(size * count for size, count in sizes)
+        return {'num_backbones': len(sizes),
+                'num_references': sum(count for _, count in sizes),
+                'backbones_bytes': backbones_bytes,
+                'unshared_bytes': unshared_bytes,
+                'saved_bytes': unshared_bytes - backbones_bytes}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+backbone_registry = BackboneRegistry()
+
+
+def build_task_model(cls, pretrained_model_name, *inputs, registry=None, device=None, dtype=None, **kwargs):
+    """ Builds a task model (e.g. `BertForSequenceClassification`) whose `bert` attribute is the shared
+        backbone of `pretrained_model_name` in `registry` (default: the process-wide `backbone_registry`).
+        The task head is newly initialized and is the only trainable part of the model. Call
+        `registry.release(model.bert)` when the model is discarded.
+
+        Each task model has its own copy of the configuration, but the backbone modules are shared by all the
+        task models built from them: the settings applied to the encoder (`set_attention_window`,
+        `set_ffn_chunk_size`, `set_mixed_precision`, `freeze_layers`, `add_adapters`, pruning, quantization...)
+        must not be used on these models as they would change the backbone of every other model.
+
+    Params:
+        cls: a task model class with a `bert` attribute.
+        pretrained_model_name, device, dtype: the backbone to use, see `PreTrainedBertModel.from_pretrained`.
+        *inputs, **kwargs: additional inputs of the task model class (e.g. num_labels).
+    """
+    registry = registry if registry is not None else backbone_registry
+    backbone = registry.acquire(pretrained_model_name, device=device, dtype=dtype)
+    # The encoder allocated by `cls` is never initialized and is replaced by the shared backbone
+    with no_init_weights():
+        model = cls(copy.deepcopy(backbone.config), *inputs, **kwargs)
+    model.bert = backbone
+    for name, module in model.named_children():
+        if name != 'bert':
+            module.apply(model.init_bert_weights)
+    for module in model.modules():
+        if isinstance(module, BertLMPredictionHead):
+            # Masked language modeling decoders are tied to the word embeddings of the backbone
+            module.decoder.weight = backbone.embeddings.word_embeddings.weight
+    if device is not None or dtype is not None:
+        for name, module in model.named_children():
+            if name != 'bert':
+                module.to(device=device, dtype=dtype)
+    return model
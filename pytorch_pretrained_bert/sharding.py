@@ -0,0 +1,127 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checkpoints split in several shard files described by an index.
+
+A sharded checkpoint `pytorch_model.bin` is made of the files `pytorch_model-00001-of-0000N.bin`, each a
+`torch.save` of a part of the state_dict, and of the index `pytorch_model.bin.index.json`:
+    {"metadata": {"total_size": size in bytes of the tensors},
+     "weight_map": {tensor name: shard file name}}
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.index.json'
+_SIZE_UNITS = {'B': 1, 'KB': 10 ** 3, 'MB': 10 ** 6, 'GB': 10 ** 9, 'KIB': 2 ** 10, 'MIB': 2 ** 20, 'GIB': 2 ** 30}
+
+
+def parse_size(size):
+    """ Converts a size in bytes given as an int or a str with a unit (e.g. "500MB", "2GiB") to an int. """
+    if isinstance(size, int):
+        return size
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*$', size)
+    if match is None or match.group(2).upper() not in _SIZE_UNITS:
+        raise ValueError("Invalid size: {} - should be a number of bytes or a number with a unit in {}".format(
+            size, ', '.join(sorted(_SIZE_UNITS))))
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper() or 'B'])
+
+
+def _tensor_size(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+def shard_state_dict(state_dict, max_shard_size):
+    """ Splits a state_dict in a list of OrderedDicts of at most `max_shard_size` bytes each (int or str,
+        see `parse_size`), keeping the order of the keys. A tensor bigger than `max_shard_size` gets a shard
+        of its own.
+    """
+    max_shard_size = parse_size(max_shard_size)
+    shards = [OrderedDict()]
+    shard_size = 0
+    for name, tensor in state_dict.items():
+        size = _tensor_size(tensor)
+        if shard_size + size > max_shard_size and len(shards[-1]) > 0:
+            shards.append(OrderedDict())
+            shard_size = 0
+        shards[-1][name] = tensor
+        shard_size += size
+    return shards
+
+
+def save_sharded_checkpoint(state_dict, save_directory, max_shard_size, weights_name='pytorch_model.bin'):
+    """ Saves `state_dict` in `save_directory` as shards of at most `max_shard_size` bytes and their index.
+        Returns the path to the index.
+    """
+    shards = shard_state_dict(state_dict, max_shard_size)
+    root, extension = os.path.splitext(weights_name)
+    weight_map = OrderedDict()
+    for shard_num, shard in enumerate(shards):
+        shard_file = "{}-{:05d}-of-{:05d}{}".format(root, shard_num + 1, len(shards), extension)
+        torch.save(shard, os.path.join(save_directory, shard_file))
+        for name in shard:
+            weight_map[name] = shard_file
+    index = {'metadata': {'total_size': sum(_tensor_size(tensor) for tensor in state_dict.values())},
+             'weight_map': weight_map}
+    index_path = os.path.join(save_directory, weights_name + INDEX_SUFFIX)
+    with open(index_path, 'w') as writer:
+        writer.write(json.dumps(index, indent=2) + "\n")
+    logger.info("Saved {} shards indexed in {}".format(len(shards), index_path))
+    return index_path
+
+
+def read_index(index_path):
+    """ Returns the weight map {tensor name: shard file} of a sharded checkpoint index. """
+    with open(index_path, 'r') as reader:
+        return json.loads(reader.read(), object_pairs_hook=OrderedDict)['weight_map']
+
+
+def load_sharded_checkpoint(index_path, keys=None, num_workers=8, map_location='cpu'):
+    """ Loads the shards of a sharded checkpoint in parallel with a pool of `num_workers` threads.
+
+    Params:
+        index_path: path to the index of the checkpoint.
+        keys: optional collection of the names of the tensors to load (e.g. the keys of the encoder only).
+            Shards without any of them are not read. Default: all the tensors.
+        num_workers: number of shards read concurrently. Default: 8.
+        map_location: passed to `torch.load`. Default: 'cpu'.
+
+    Returns an OrderedDict of the loaded tensors, in the order of the index.
+    """
+    weight_map = read_index(index_path)
+    if keys is not None:
+        keys = set(keys)
+        weight_map = OrderedDict((name, shard_file) for name, shard_file in weight_map.items() if name in keys)
+    shard_files = list(OrderedDict.fromkeys(weight_map.values()))
+    directory = os.path.dirname(index_path)
+
+    def load_shard(shard_file):
+        return torch.load(os.path.join(directory, shard_file), map_location=map_location)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(num_workers, len(shard_files)))) as executor:
+        shards = dict(zip(shard_files, executor.map(load_shard, shard_files)))
+    logger.info("Loaded {} shards of {}".format(len(shard_files), index_path))
+    return OrderedDict((name, shards[shard_file][name]) for name, shard_file in weight_map.items())
@@ -85,6 +85,28 @@ def whitespace_tokenize(text):
     return tokens
 
 
+def chunk_tokens(tokens, max_seq_length, doc_stride=None):
+    """Splits the tokens of a long document in windows of `max_seq_length` tokens, [CLS] and [SEP]
+    included, which start every `doc_stride` tokens (default: consecutive windows without overlap).
+    Used to feed whole documents to `BertForLongDocumentClassification` instead of truncating them."""
+    window_length = max_seq_length - 2
+    if window_length <= 0:
+        raise ValueError("max_seq_length should leave room for the tokens, got {}".format(max_seq_length))
+    if doc_stride is None:
+        doc_stride = window_length
+    if not 1 <= doc_stride <= window_length:
+        raise ValueError("Invalid doc_stride: {} - should be in [1, {}] (max_seq_length - 2)".format(
+            doc_stride, window_length))
+    chunks = []
+    start = 0
+    while True:
+        chunks.append(["[CLS]"] + tokens[start:start + window_length] + ["[SEP]"])
+        if start + window_length >= len(tokens):
+            break
+        start += doc_stride
+    return chunks
+
+
 class BertTokenizer(object):
     """Runs end-to-end tokenization: punctuation splitting + wordpiece"""
     def __init__(self, vocab_file, do_lower_case=True):
@@ -0,0 +1,76 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from pytorch_pretrained_bert import BertModel
+from pytorch_pretrained_bert.compression import (LowRankLinear, select_rank, factorize_linear_layers,
+                                                 compression_report)
+
+from testing_utils import small_config
+
+
+class CompressionTest(unittest.TestCase):
+
+    def test_low_rank_linear_full_rank_is_exact(self):
+        linear = torch.nn.Linear(6, 4)
+        low_rank = LowRankLinear.from_linear(linear, rank=4)
+        x = torch.randn(3, 6)
+        self.assertTrue(torch.allclose(low_rank(x), linear(x), atol=1e-5))
+
+    def test_select_rank(self):
+        weight = torch.diag(torch.tensor([10.0, 1.0, 0.1, 0.01]))
+        self.assertEqual(select_rank(weight, energy=0.95), 1)
+        self.assertEqual(select_rank(weight, energy=0.999), 2)
+        self.assertEqual(select_rank(torch.zeros(30, 10), param_ratio=0.5), 3)
+
+    def test_factorize_save_and_reload(self):
+        config = small_config(intermediate_size=64)
+        model = BertModel(config)
+        model.eval()
+        compressed_model = copy.deepcopy(model)
+        ranks = factorize_linear_layers(compressed_model, param_ratio=0.5)
+        self.assertIn('encoder.layer.0.intermediate.dense', ranks)
+        self.assertIsInstance(compressed_model.encoder.layer[1].attention.self.query, LowRankLinear)
+
+        input_ids = torch.randint(0, 99, (2, 7), dtype=torch.long)
+        report = compression_report(model, compressed_model, input_ids, num_runs=1)
+        self.assertGreater(report['flops_reduction'], 0.4)
+
+        with torch.no_grad():
+            _, pooled_output = compressed_model(input_ids)
+        save_dir = tempfile.mkdtemp()
+        try:
+            compressed_model.save_pretrained(save_dir)
+            reloaded_model = BertModel.from_pretrained(save_dir)
+        finally:
+            shutil.rmtree(save_dir)
+        reloaded_model.eval()
+        self.assertEqual(reloaded_model.encoder.layer[0].output.dense.rank, ranks['encoder.layer.0.output.dense'])
+        with torch.no_grad():
+            _, reloaded_pooled_output = reloaded_model(input_ids)
+        self.assertTrue(torch.allclose(reloaded_pooled_output, pooled_output, atol=1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
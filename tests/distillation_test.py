@@ -0,0 +1,72 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import shutil
+import tempfile
+import unittest
+
+import torch
+from torch.utils.data import TensorDataset
+
+from pytorch_pretrained_bert import BertAdam
+from pytorch_pretrained_bert.modeling import BertForMultipleChoice
+from pytorch_pretrained_bert.distillation import (uniform_layer_map, create_student, TeacherOutputCache,
+                                                  DistillationLoss, distill)
+
+from testing_utils import small_config
+
+
+class DistillationTest(unittest.TestCase):
+
+    def test_uniform_layer_map(self):
+        self.assertListEqual(uniform_layer_map(4, 12), [2, 5, 8, 11])
+        self.assertListEqual(uniform_layer_map(6, 12), [1, 3, 5, 7, 9, 11])
+
+    def test_distill_multiple_choice(self):
+        config = small_config(num_hidden_layers=4)
+        teacher = BertForMultipleChoice(config, num_labels=2, num_options=2)
+        student, layer_map = create_student(teacher, 2, 2, 2)
+        self.assertListEqual(layer_map, [1, 3])
+        self.assertEqual(student.config.num_hidden_layers, 2)
+        self.assertTrue(torch.equal(student.bert.encoder.layer[1].output.dense.weight,
+                                    teacher.bert.encoder.layer[3].output.dense.weight))
+        self.assertTrue(torch.equal(student.classifier.weight, teacher.classifier.weight))
+
+        input_ids = torch.randint(0, 99, (6, 2, 7), dtype=torch.long)
+        train_dataset = TensorDataset(input_ids, torch.ones_like(input_ids), torch.zeros_like(input_ids),
+                                      torch.randint(0, 2, (6,), dtype=torch.long))
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = TeacherOutputCache.build(teacher, train_dataset, cache_dir, hidden_layers=layer_map,
+                                             attention_layers=layer_map, batch_size=4)
+            self.assertListEqual(list(cache.logits.size()), [6, 2])
+            self.assertListEqual(list(cache.hidden_states(3, torch.tensor([5, 0])).size()), [2, 2 * 7 * 32])
+
+            distillation_loss = DistillationLoss(student.config, teacher.config,
+                                                 hidden_weight=1.0, attention_weight=1.0)
+            optimizer = BertAdam(student.parameters(), lr=1e-3)
+            loss = distill(student, cache, train_dataset, distillation_loss, optimizer, layer_map,
+                           num_train_epochs=1, batch_size=4)
+        finally:
+            shutil.rmtree(cache_dir)
+        self.assertFalse(math.isnan(loss))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from pytorch_pretrained_bert import BertModel, BertForQuestionAnswering
+from pytorch_pretrained_bert.modeling import BertForMultipleChoice
+from pytorch_pretrained_bert.export import export_torchscript, export_onnx, compare_onnx_runtime
+
+from testing_utils import small_config
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.export_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.export_dir)
+
+    def test_torchscript_dynamic_axes(self):
+        for model in (BertModel(small_config()), BertForQuestionAnswering(small_config())):
+            model.eval()
+            path = os.path.join(self.export_dir, 'model.pt')
+            example_ids = torch.randint(0, 99, (2, 7), dtype=torch.long)
+            export_torchscript(model, (example_ids,), path)
+            scripted = torch.jit.load(path)
+
+            input_ids = torch.randint(0, 99, (3, 11), dtype=torch.long)
+            token_type_ids = torch.zeros_like(input_ids)
+            attention_mask = torch.ones_like(input_ids)
+            attention_mask[0, 8:] = 0
+            with torch.no_grad():
+                if isinstance(model, BertModel):
+                    expected_outputs = model(input_ids, token_type_ids, attention_mask,
+                                             output_all_encoded_layers=False)
+                else:
+                    expected_outputs = model(input_ids, token_type_ids, attention_mask)
+                outputs = scripted(input_ids, token_type_ids, attention_mask)
+            for output, expected_output in zip(outputs, expected_outputs):
+                self.assertTrue(torch.allclose(output, expected_output, atol=1e-5))
+
+    def test_torchscript_multiple_choice(self):
+        model = BertForMultipleChoice(small_config(), num_labels=2, num_options=2)
+        path = os.path.join(self.export_dir, 'model.pt')
+        example_ids = torch.randint(0, 99, (2, 2, 7), dtype=torch.long)
+        export_torchscript(model, (example_ids, torch.zeros_like(example_ids), torch.ones_like(example_ids)), path)
+        self.assertTrue(model.training)
+        scripted = torch.jit.load(path)
+
+        model.eval()
+        input_ids = torch.randint(0, 99, (3, 4, 9), dtype=torch.long)
+        token_type_ids = torch.zeros_like(input_ids)
+        attention_mask = torch.ones_like(input_ids)
+        with torch.no_grad():
+            expected_logits = model(input_ids, token_type_ids, attention_mask).view(3, 4)
+            logits = scripted(input_ids, token_type_ids, attention_mask)
+        self.assertTrue(torch.allclose(logits, expected_logits, atol=1e-5))
+
+    @unittest.skipIf(onnxruntime is None, "onnxruntime is not installed")
+    def test_onnx_parity(self):
+        for model, shape in ((BertForMultipleChoice(small_config(), num_labels=2, num_options=2), (2, 2, 7)),
+                             (BertForQuestionAnswering(small_config()), (2, 7))):
+            for fold_attention_mask in (False, True):
+                path = os.path.join(self.export_dir, 'model.onnx')
+                example_ids = torch.randint(0, 99, shape, dtype=torch.long)
+                input_names = export_onnx(model, (example_ids,), path, fold_attention_mask=fold_attention_mask)
+                self.assertEqual('attention_mask' in input_names, not fold_attention_mask)
+
+                # Other batch size, sequence length and number of options than the example batch
+                input_ids = torch.randint(0, 99, tuple(size + 1 for size in shape), dtype=torch.long)
+                attention_mask = torch.ones_like(input_ids)
+                if not fold_attention_mask:
+                    attention_mask[..., 5:] = 0
+                model.train()
+                result = compare_onnx_runtime(model, path, (input_ids, torch.zeros_like(input_ids), attention_mask),
+                                              num_runs=2, num_warmup=1)
+                self.assertLess(result['max_abs_diff'], 1e-4)
+                self.assertTrue(model.training)
+
+        with self.assertRaises(ValueError):
+            export_onnx(BertModel(small_config()), (example_ids,), path)
+
+
+if __name__ == "__main__":
+    unittest.main()
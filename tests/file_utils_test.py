@@ -0,0 +1,68 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from pytorch_pretrained_bert.file_utils import extracted_archive_path
+
+
+class FileUtilsTest(unittest.TestCase):
+
+    def test_extracted_archive_path(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(work_dir, "bert_config.json"), "w") as config_file:
+                config_file.write("{}")
+            archive_path = os.path.join(work_dir, "model.tar.gz")
+            with tarfile.open(archive_path, "w:gz") as archive:
+                archive.add(os.path.join(work_dir, "bert_config.json"), arcname="bert_config.json")
+            cache_dir = os.path.join(work_dir, "cache")
+
+            extracted_path = extracted_archive_path(archive_path, cache_dir)
+            self.assertTrue(os.path.isfile(os.path.join(extracted_path, "bert_config.json")))
+            mtime = os.path.getmtime(extracted_path)
+            # The second call reuses the extracted directory
+            self.assertEqual(extracted_archive_path(archive_path, cache_dir), extracted_path)
+            self.assertEqual(os.path.getmtime(extracted_path), mtime)
+            self.assertListEqual(sorted(name for name in os.listdir(cache_dir) if not name.endswith('.lock')),
+                                 [os.path.basename(extracted_path)])
+
+            # An archive replaced in place, even with the same size and modification time, is extracted again
+            # and the directory of its previous version is removed
+            stat = os.stat(archive_path)
+            with open(os.path.join(work_dir, "bert_config.json"), "w") as config_file:
+                config_file.write("[]")
+            with tarfile.open(archive_path, "w:gz") as archive:
+                archive.add(os.path.join(work_dir, "bert_config.json"), arcname="bert_config.json")
+            os.utime(archive_path, (stat.st_atime, stat.st_mtime))
+            new_extracted_path = extracted_archive_path(archive_path, cache_dir)
+            self.assertNotEqual(new_extracted_path, extracted_path)
+            with open(os.path.join(new_extracted_path, "bert_config.json")) as config_file:
+                self.assertEqual(config_file.read(), "[]")
+            self.assertListEqual(sorted(name for name in os.listdir(cache_dir) if not name.endswith('.lock')),
+                                 [os.path.basename(new_extracted_path)])
+        finally:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import torch
+
+from pytorch_pretrained_bert import BertModel, BertForSequenceClassification
+from pytorch_pretrained_bert.flat_weights import (ALIGNMENT, save_flat_weights, load_flat_weights,
+                                                  read_flat_weights_header)
+
+from testing_utils import small_config
+
+
+class FlatWeightsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.save_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.save_dir)
+
+    def test_round_trip(self):
+        state_dict = OrderedDict([('a', torch.randn(3, 5)),
+                                  ('b', torch.arange(7, dtype=torch.long)),
+                                  ('c', torch.randn(4).to(torch.bfloat16)),
+                                  ('d', torch.tensor([True, False])),
+                                  ('e', torch.randn(0, 2).half())])
+        path = os.path.join(self.save_dir, 'weights.flat')
+        save_flat_weights(state_dict, path)
+
+        header, data_start = read_flat_weights_header(path)
+        self.assertListEqual(list(header.keys()), list(state_dict.keys()))
+        self.assertEqual(data_start % ALIGNMENT, 0)
+        self.assertTrue(all(entry['offset'] % ALIGNMENT == 0 for entry in header.values()))
+
+        loaded = load_flat_weights(path)
+        for name, tensor in state_dict.items():
+            self.assertEqual(loaded[name].dtype, tensor.dtype)
+            self.assertTrue(torch.equal(loaded[name], tensor))
+
+    def test_from_pretrained_binds_mapped_weights(self):
+        config = small_config()
+        model = BertModel(config)
+        model.eval()
+        model.save_pretrained(self.save_dir, flat_weights=True)
+        self.assertTrue(os.path.exists(os.path.join(self.save_dir, 'pytorch_model.flat')))
+        self.assertFalse(os.path.exists(os.path.join(self.save_dir, 'pytorch_model.bin')))
+
+        classifier = BertForSequenceClassification.from_pretrained(self.save_dir, 3)
+        classifier.eval()
+        input_ids = torch.randint(0, 99, (2, 7), dtype=torch.long)
+        with torch.no_grad():
+            _, pooled_output = model(input_ids)
+            _, reloaded_pooled_output = classifier.bert(input_ids)
+        self.assertTrue(torch.allclose(pooled_output, reloaded_pooled_output, atol=1e-6))
+        # The weights of the BertModel checkpoint are bound under the `bert.` prefix of the head model
+        for name, tensor in model.state_dict().items():
+            self.assertTrue(torch.equal(classifier.state_dict()['bert.' + name], tensor), name)
+        # Missing weights are initialized, and the mapped weights can be trained (copy-on-write)
+        self.assertTrue(torch.equal(classifier.classifier.bias, torch.zeros(3)))
+        classifier.bert.pooler.dense.weight.data.add_(1.0)
+        reloaded = BertForSequenceClassification.from_pretrained(self.save_dir, 3)
+        self.assertTrue(torch.equal(reloaded.bert.pooler.dense.weight, model.pooler.dense.weight))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,13 +16,22 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import unittest
 import json
 import random
+import shutil
+import tempfile
+import threading
 
 import torch
 
-from pytorch_pretrained_bert import BertConfig, BertModel
+from pytorch_pretrained_bert import (BertConfig, BertModel, BertForMaskedLM, BertForSequenceClassification,
+                                     BertForQuestionAnswering, BertForLongDocumentClassification, BertMultiTask)
+from pytorch_pretrained_bert.modeling import (BertLayerNorm, gelu, fused_bias_gelu,
+                                              fused_dropout_add_layer_norm, no_init_weights)
+
+from testing_utils import small_config, unit_layer_norms, relative_error, run_in_fresh_process
 
 
 class BertModelTest(unittest.TestCase):
@@ -117,6 +126,481 @@ class BertModelTest(unittest.TestCase):
         self.assertEqual(obj["vocab_size"], 99)
         self.assertEqual(obj["hidden_size"], 37)
 
+    def test_masked_lm_sparse_positions(self):
+        config = small_config()
+        model = BertForMaskedLM(config)
+        model.eval()
+        input_ids = BertModelTest.ids_tensor([3, 7], config.vocab_size)
+        masked_lm_labels = torch.full((3, 7), -1, dtype=torch.long)
+        masked_lm_labels[:, 2] = input_ids[:, 2]
+        masked_lm_labels[0, 5] = input_ids[0, 5]
+
+        with torch.no_grad():
+            full_scores = model(input_ids)
+            positions = torch.tensor([[2, 5], [2, 0], [2, 4]], dtype=torch.long)
+            sparse_scores = model(input_ids, masked_lm_positions=positions)
+            loss = model(input_ids, masked_lm_labels=masked_lm_labels)
+
+        self.assertListEqual(list(sparse_scores.size()), [3, 2, config.vocab_size])
+        self.assertTrue(torch.allclose(sparse_scores[1, 1], full_scores[1, 0], atol=1e-5))
+        self.assertTrue(torch.allclose(sparse_scores[2, 1], full_scores[2, 4], atol=1e-5))
+
+        labelled = masked_lm_labels.view(-1) != -1
+        expected_loss = torch.nn.functional.cross_entropy(
+            full_scores.view(-1, config.vocab_size)[labelled], masked_lm_labels.view(-1)[labelled])
+        self.assertAlmostEqual(loss.item(), expected_loss.item(), places=5)
+
+    def test_masked_lm_candidate_scores(self):
+        config = small_config()
+        model = BertForMaskedLM(config)
+        model.eval()
+        input_ids = BertModelTest.ids_tensor([3, 7], config.vocab_size)
+        positions = torch.tensor([[1, 3], [0, 6], [2, 2]], dtype=torch.long)
+        candidate_ids = BertModelTest.ids_tensor([3, 2, 5], config.vocab_size)
+
+        with torch.no_grad():
+            full_scores = model(input_ids, masked_lm_positions=positions)
+            candidate_scores, top_scores, top_ids = model.score_candidates(
+                input_ids, positions, candidate_ids, top_k=4, chunk_size=10)
+
+        expected_scores = full_scores.gather(-1, candidate_ids)
+        self.assertTrue(torch.allclose(candidate_scores, expected_scores, atol=1e-5))
+        expected_top_scores, _ = full_scores.topk(4, dim=-1)
+        self.assertTrue(torch.allclose(top_scores, expected_top_scores, atol=1e-5))
+        self.assertTrue(torch.allclose(full_scores.gather(-1, top_ids), top_scores, atol=1e-5))
+
+    def test_cross_layer_sharing(self):
+        unshared_model = BertModel(small_config())
+        layer_params = sum(p.numel() for p in unshared_model.encoder.layer[0].parameters())
+        for sharing, shared_params in (('all', layer_params),
+                                       ('attention', 2 * layer_params - sum(
+                                           p.numel() for p in unshared_model.encoder.layer[0].attention.parameters())),
+                                       ('ffn', 2 * layer_params - sum(
+                                           p.numel() for p in unshared_model.encoder.layer[0].output.parameters()) - sum(
+                                           p.numel() for p in unshared_model.encoder.layer[0].intermediate.parameters()))):
+            model = BertModel(small_config(cross_layer_sharing=sharing))
+            model.eval()
+            self.assertEqual(sum(p.numel() for p in model.encoder.parameters()), shared_params)
+
+            input_ids = BertModelTest.ids_tensor([2, 7], model.config.vocab_size)
+            with torch.no_grad():
+                _, pooled_output = model(input_ids)
+            save_dir = tempfile.mkdtemp()
+            try:
+                model.save_pretrained(save_dir)
+                saved_keys = torch.load(save_dir + '/pytorch_model.bin').keys()
+                reloaded_model = BertModel.from_pretrained(save_dir)
+            finally:
+                shutil.rmtree(save_dir)
+            if sharing == 'all':
+                self.assertFalse(any(key.startswith('encoder.layer.1.') for key in saved_keys))
+            reloaded_model.eval()
+            with torch.no_grad():
+                _, reloaded_pooled_output = reloaded_model(input_ids)
+            self.assertTrue(torch.allclose(pooled_output, reloaded_pooled_output, atol=1e-5))
+
+        with self.assertRaises(ValueError):
+            BertModel(small_config(cross_layer_sharing='ffn', intermediate_size=[37, 20]))
+
+    def test_chunked_feed_forward(self):
+        model = BertModel(small_config(hidden_dropout_prob=0.0, attention_probs_dropout_prob=0.0))
+        input_ids = BertModelTest.ids_tensor([2, 7], model.config.vocab_size)
+        model.eval()
+        with torch.no_grad():
+            sequence_output, _ = model(input_ids, output_all_encoded_layers=False)
+            model.set_ffn_chunk_size(3)
+            chunked_sequence_output, _ = model(input_ids, output_all_encoded_layers=False)
+        self.assertTrue(torch.allclose(sequence_output, chunked_sequence_output, atol=1e-5))
+
+        # Chunks are recomputed in the backward pass, the gradients are unchanged
+        model.train()
+        gradients = []
+        for chunk_size in (None, 3):
+            model.zero_grad()
+            model.set_ffn_chunk_size(chunk_size)
+            sequence_output, _ = model(input_ids, output_all_encoded_layers=False)
+            sequence_output.sum().backward()
+            gradients.append(model.encoder.layer[0].intermediate.dense.weight.grad.clone())
+        self.assertTrue(torch.allclose(gradients[0], gradients[1], atol=1e-4))
+
+        # Recomputed chunks above frozen layers, whose inputs don't require grad, also get gradients
+        model.freeze_layers(1)
+        model.zero_grad()
+        sequence_output, _ = model(input_ids, output_all_encoded_layers=False)
+        sequence_output.sum().backward()
+        self.assertIsNotNone(model.encoder.layer[1].intermediate.dense.weight.grad)
+
+        # The recomputation doesn't depend on a warm-up of the fused operations by earlier forward passes
+        run_in_fresh_process(self, """
+            import torch
+            from pytorch_pretrained_bert import BertModel
+            from testing_utils import small_config
+
+            model = BertModel(small_config(ffn_chunk_size=3))
+            model.train()
+            sequence_output, _ = model(torch.randint(0, 99, (2, 7)), output_all_encoded_layers=False)
+            sequence_output.sum().backward()
+            assert model.encoder.layer[0].intermediate.dense.weight.grad is not None
+            """)
+
+    def test_fused_operations(self):
+        config = small_config()
+        layer_norm = BertLayerNorm(config)
+        layer_norm.gamma.data.normal_()
+        layer_norm.beta.data.normal_()
+        x = torch.randn(2, 7, config.hidden_size)
+        residual = torch.randn(2, 7, config.hidden_size)
+        bias = torch.randn(config.hidden_size)
+
+        def reference_layer_norm(x):
+            # TF-style layer normalization: epsilon inside the square root
+            u = x.mean(-1, keepdim=True)
+            s = (x - u).pow(2).mean(-1, keepdim=True)
+            return layer_norm.gamma * (x - u) / torch.sqrt(s + layer_norm.variance_epsilon) + layer_norm.beta
+
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(layer_norm(x), reference_layer_norm(x), atol=1e-5))
+            self.assertTrue(torch.allclose(fused_bias_gelu(bias, x), gelu(x + bias), atol=1e-6))
+            for training in (False, True):
+                fused_output = fused_dropout_add_layer_norm(x, residual, layer_norm.gamma, layer_norm.beta,
+                                                            layer_norm.variance_epsilon, 0.0, training)
+                self.assertTrue(torch.allclose(fused_output, reference_layer_norm(x + residual), atol=1e-5))
+            dropped_output = fused_dropout_add_layer_norm(x, residual, layer_norm.gamma, layer_norm.beta,
+                                                          layer_norm.variance_epsilon, 0.5, True)
+            self.assertFalse(torch.allclose(dropped_output, reference_layer_norm(x + residual), atol=1e-5))
+
+    @unittest.skipIf(not hasattr(torch, 'autocast'), "torch.autocast is not available")
+    def test_bf16_mixed_precision(self):
+        model = BertForMaskedLM(small_config())
+        model.eval()
+        input_ids = BertModelTest.ids_tensor([2, 7], model.config.vocab_size)
+        with torch.no_grad():
+            prediction_scores = model(input_ids)
+            model.set_mixed_precision('bf16')
+            mixed_precision_scores = model(input_ids)
+        self.assertEqual(model.bert.mixed_precision_dtype, torch.bfloat16)
+        self.assertEqual(mixed_precision_scores.dtype, torch.float32)
+        self.assertTrue(torch.allclose(prediction_scores, mixed_precision_scores, atol=0.1))
+
+        model.train()
+        loss = model(input_ids, masked_lm_labels=input_ids)
+        loss.backward()
+        self.assertEqual(model.bert.encoder.layer[0].output.dense.weight.grad.dtype, torch.float32)
+        with self.assertRaises(ValueError):
+            model.set_mixed_precision('fp8')
+
+    def test_from_pretrained_initializes_missing_weights_only(self):
+        config = small_config(hidden_size=64, intermediate_size=64)
+        kaiming_uniform = torch.nn.init.kaiming_uniform_
+        other_thread_models = []
+        with no_init_weights():
+            with no_init_weights():
+                pass
+            skipped = BertModel(config)
+            # Only the current thread skips `init_bert_weights`
+            thread = threading.Thread(target=lambda: other_thread_models.append(BertModel(config)))
+            thread.start()
+            thread.join()
+            self.assertIs(torch.nn.init.kaiming_uniform_, kaiming_uniform)
+        self.assertTrue(torch.equal(skipped.embeddings.LayerNorm.gamma, torch.ones(64)))
+        self.assertFalse(torch.equal(other_thread_models[0].embeddings.LayerNorm.gamma, torch.ones(64)))
+        self.assertFalse(torch.equal(BertModel(config).embeddings.LayerNorm.gamma, torch.ones(64)))
+
+        model = BertModel(config)
+        save_dir = tempfile.mkdtemp()
+        try:
+            model.save_pretrained(save_dir)
+            classifier = BertForSequenceClassification.from_pretrained(save_dir, 3)
+            # A checkpoint without any weight of the model isn't loaded
+            torch.save({'classifier.weight': torch.zeros(3, 64)}, os.path.join(save_dir, 'pytorch_model.bin'))
+            self.assertIsNone(BertForSequenceClassification.from_pretrained(save_dir, 3))
+        finally:
+            shutil.rmtree(save_dir)
+        self.assertTrue(torch.equal(classifier.bert.encoder.layer[1].output.dense.weight,
+                                    model.encoder.layer[1].output.dense.weight))
+        # The classifier is missing from the checkpoint and initialized as in `init_bert_weights`
+        self.assertTrue(torch.equal(classifier.classifier.bias, torch.zeros(3)))
+        self.assertAlmostEqual(classifier.classifier.weight.std().item(), config.initializer_range, delta=0.005)
+
+    def test_from_pretrained_dtype(self):
+        model = BertModel(small_config())
+        save_dir = tempfile.mkdtemp()
+        try:
+            model.save_pretrained(save_dir)
+            half_model = BertModel.from_pretrained(save_dir, device='cpu', dtype='float16')
+        finally:
+            shutil.rmtree(save_dir)
+        self.assertTrue(all(param.dtype == torch.float16 for param in half_model.parameters()))
+        self.assertTrue(torch.equal(half_model.encoder.layer[0].attention.self.query.weight,
+                                    model.encoder.layer[0].attention.self.query.weight.half()))
+
+    def test_multi_task_heads(self):
+        config = small_config()
+        classifier = BertForSequenceClassification(config, 3)
+        qa_model = BertForQuestionAnswering(config)
+        model = BertMultiTask(config, {'sentiment': ('classification', 3), 'qa': 'span', 'mlm': 'mlm'})
+        model.bert.load_state_dict(classifier.bert.state_dict())
+        model.heads['sentiment'].classifier.load_state_dict(classifier.classifier.state_dict())
+        qa_model.bert.load_state_dict(classifier.bert.state_dict())
+        model.heads['qa'].qa_outputs.load_state_dict(qa_model.qa_outputs.state_dict())
+        self.assertIs(model.heads['mlm'].predictions.decoder.weight, model.bert.embeddings.word_embeddings.weight)
+
+        for module in (model, classifier, qa_model):
+            module.eval()
+        input_ids = BertModelTest.ids_tensor([2, 7], config.vocab_size)
+        with torch.no_grad():
+            outputs = model(input_ids, tasks=['sentiment', 'qa'])
+            self.assertListEqual(sorted(outputs.keys()), ['qa', 'sentiment'])
+            self.assertTrue(torch.allclose(outputs['sentiment'], classifier(input_ids), atol=1e-5))
+            for output, expected_output in zip(outputs['qa'], qa_model(input_ids)):
+                self.assertTrue(torch.allclose(output, expected_output, atol=1e-5))
+
+        masked_lm_labels = torch.full((2, 7), -1, dtype=torch.long)
+        masked_lm_labels[:, 3] = input_ids[:, 3]
+        labels = {'sentiment': torch.tensor([0, 2]),
+                  'qa': (torch.tensor([1, 2]), torch.tensor([3, 4])),
+                  'mlm': masked_lm_labels}
+        total_loss, losses = model(input_ids, labels=labels)
+        self.assertAlmostEqual(total_loss.item(), sum(loss.item() for loss in losses.values()), places=5)
+        self.assertAlmostEqual(losses['sentiment'].item(),
+                               classifier(input_ids, labels=labels['sentiment'])[0].item(), places=5)
+
+        # Batches without labels of the evaluated tasks have a zero loss
+        total_loss, losses = model(input_ids, labels={'sentiment': None})
+        total_loss.backward()
+        self.assertEqual(total_loss.item(), 0.0)
+        self.assertDictEqual(losses, {})
+
+        # The masked language modeling heads are loaded from the `cls.predictions` weights of a checkpoint
+        masked_lm_model = BertForMaskedLM(config)
+        save_dir = tempfile.mkdtemp()
+        try:
+            masked_lm_model.save_pretrained(save_dir)
+            loaded_model = BertMultiTask.from_pretrained(save_dir, heads={'mlm': 'mlm', 'sentiment': 'classification'})
+        finally:
+            shutil.rmtree(save_dir)
+        for key, tensor in masked_lm_model.cls.predictions.state_dict().items():
+            self.assertTrue(torch.equal(loaded_model.heads['mlm'].predictions.state_dict()[key], tensor))
+        self.assertIs(loaded_model.heads['mlm'].predictions.decoder.weight,
+                      loaded_model.bert.embeddings.word_embeddings.weight)
+
+        with self.assertRaises(ValueError):
+            model(input_ids, tasks=['unknown'])
+        with self.assertRaises(ValueError):
+            BertMultiTask(config, {'ner': 'token_classification'})
+
+    def test_adapters(self):
+        config = small_config()
+        # Unit LayerNorms give encoder outputs of order 1, compared with relative tolerances
+        model = unit_layer_norms(BertForSequenceClassification(config, 3))
+        model.eval()
+        input_ids = BertModelTest.ids_tensor([2, 7], config.vocab_size)
+        with torch.no_grad():
+            hidden_states, _ = model.bert(input_ids, output_all_encoded_layers=False)
+            # Newly added adapters are the identity
+            model.add_adapters(8)
+            self.assertLess(relative_error(hidden_states, model.bert(input_ids, output_all_encoded_layers=False)[0]),
+                            1e-5)
+        self.assertEqual(model.config.adapter_size, 8)
+        with self.assertRaises(ValueError):
+            model.add_adapters(16)
+
+        model.train_adapters_only()
+        tuned_names = [name for name, param in model.named_parameters() if param.requires_grad]
+        self.assertListEqual(tuned_names, model.adapter_parameter_names())
+        self.assertIn('bert.encoder.layer.0.output.adapter.up.weight', tuned_names)
+        self.assertIn('bert.encoder.layer.1.attention.output.LayerNorm.gamma', tuned_names)
+        self.assertIn('classifier.weight', tuned_names)
+        self.assertNotIn('bert.encoder.layer.0.output.dense.weight', tuned_names)
+
+        model.train()
+        loss, _ = model(input_ids, labels=torch.tensor([0, 2]))
+        loss.backward()
+        self.assertIsNone(model.bert.encoder.layer[0].output.dense.weight.grad)
+        self.assertIsNotNone(model.bert.encoder.layer[0].output.adapter.down.weight.grad)
+        with torch.no_grad():
+            model.bert.encoder.layer[0].output.adapter.up.weight.normal_()
+        model.eval()
+
+        save_dir = tempfile.mkdtemp()
+        try:
+            model.save_pretrained(save_dir)
+            model.save_adapters(save_dir + '/adapter_model.bin')
+            reloaded_model = BertForSequenceClassification.from_pretrained(save_dir, 3)
+            with no_init_weights():
+                other_task_model = BertForSequenceClassification(config, 3)
+            backbone_state_dict = dict((key, tensor) for key, tensor in reloaded_model.bert.state_dict().items()
+                                       if '.adapter.' not in key)
+            other_task_model.bert.load_state_dict(backbone_state_dict, strict=False)
+            other_task_model.load_adapters(save_dir + '/adapter_model.bin')
+        finally:
+            shutil.rmtree(save_dir)
+        reloaded_model.eval()
+        other_task_model.eval()
+        with torch.no_grad():
+            adapted_hidden_states, _ = model.bert(input_ids, output_all_encoded_layers=False)
+            self.assertGreater(relative_error(hidden_states, adapted_hidden_states), 1e-2)
+            for other_model in (reloaded_model, other_task_model):
+                self.assertLess(relative_error(adapted_hidden_states,
+                                               other_model.bert(input_ids, output_all_encoded_layers=False)[0]), 1e-5)
+                self.assertLess(relative_error(model(input_ids), other_model(input_ids)), 1e-5)
+
+    def test_freeze_layers(self):
+        model = BertForSequenceClassification(small_config(), 3)
+        model.eval()
+        input_ids = BertModelTest.ids_tensor([2, 7], model.config.vocab_size)
+        labels = torch.tensor([0, 2])
+        loss, _ = model(input_ids, labels=labels)
+        loss.backward()
+        expected_gradient = model.bert.encoder.layer[1].output.dense.weight.grad.clone()
+        model.zero_grad()
+
+        model.freeze_layers(1)
+        self.assertFalse(any(param.requires_grad for param in model.bert.embeddings.parameters()))
+        self.assertFalse(any(param.requires_grad for param in model.bert.encoder.layer[0].parameters()))
+        self.assertTrue(all(param.requires_grad for param in model.bert.encoder.layer[1].parameters()))
+        frozen_outputs = []
+        model.bert.encoder.layer[0].register_forward_hook(lambda module, inputs, output: frozen_outputs.append(output))
+        frozen_loss, _ = model(input_ids, labels=labels)
+        frozen_loss.backward()
+        # The frozen layer keeps no autograd graph and the gradients of the trained layers are unchanged
+        self.assertFalse(frozen_outputs[0].requires_grad)
+        self.assertAlmostEqual(frozen_loss.item(), loss.item(), places=5)
+        self.assertIsNone(model.bert.encoder.layer[0].output.dense.weight.grad)
+        self.assertTrue(torch.allclose(model.bert.encoder.layer[1].output.dense.weight.grad, expected_gradient,
+                                       atol=1e-6))
+
+        # Parameters of a frozen layer trained again (e.g. by `train_adapters_only`) get gradients
+        model.zero_grad()
+        layer_norm_gamma = model.bert.encoder.layer[0].output.LayerNorm.gamma
+        layer_norm_gamma.requires_grad = True
+        del frozen_outputs[:]
+        loss, _ = model(input_ids, labels=labels)
+        loss.backward()
+        self.assertTrue(frozen_outputs[0].requires_grad)
+        self.assertIsNotNone(layer_norm_gamma.grad)
+        self.assertIsNone(model.bert.encoder.layer[0].output.dense.weight.grad)
+
+        with self.assertRaises(ValueError):
+            model.freeze_layers(3)
+        with self.assertRaises(ValueError):
+            BertModel(small_config(cross_layer_sharing='attention')).freeze_layers(1)
+
+    def test_local_attention(self):
+        model = BertModel(small_config(hidden_dropout_prob=0.0, attention_probs_dropout_prob=0.0))
+        model.eval()
+        window = 3
+        input_ids = BertModelTest.ids_tensor([2, 17], model.config.vocab_size)
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[0, :4] = 2
+        attention_mask[1, 0] = 2
+        attention_mask[1, 9] = 2
+        attention_mask[1, 14:] = 0
+
+        # Full attention restricted to the window and the global tokens with a [batch_size, 1, from, to] mask
+        positions = torch.arange(17)
+        in_window = (positions.view(-1, 1) - positions.view(1, -1)).abs() <= window
+        local_queries = attention_mask.ne(2).unsqueeze(2)
+        allowed = (in_window.unsqueeze(0) & attention_mask.eq(1).unsqueeze(1)) | attention_mask.eq(2).unsqueeze(1)
+        allowed = torch.where(local_queries, allowed, attention_mask.ne(0).unsqueeze(1).expand(-1, 17, -1))
+        full_attention_mask = (1.0 - allowed.float().unsqueeze(1)) * -10000.0
+        self_attention = model.encoder.layer[0].attention.self
+        hidden_states = torch.randn(2, 17, model.config.hidden_size)
+        with torch.no_grad():
+            expected_context = self_attention(hidden_states, full_attention_mask)
+            self_attention.attention_window = window
+            context = self_attention(hidden_states, attention_mask)
+        valid = attention_mask.ne(0)
+        self.assertTrue(torch.allclose(context[valid], expected_context[valid], atol=1e-5))
+
+        # Longer sequences than the pretrained position embeddings
+        self_attention.attention_window = None
+        model.set_attention_window(window, max_position_embeddings=128)
+        self.assertEqual(model.config.attention_window, window)
+        self.assertEqual(model.embeddings.position_embeddings.weight.size(0), 128)
+        self.assertTrue(torch.equal(model.embeddings.position_embeddings.weight[64 + 5],
+                                    model.embeddings.position_embeddings.weight[5]))
+        long_input_ids = BertModelTest.ids_tensor([2, 100], model.config.vocab_size)
+        long_attention_mask = torch.ones_like(long_input_ids)
+        long_attention_mask[:, 0] = 2
+        with torch.no_grad():
+            sequence_output, _ = model(long_input_ids, attention_mask=long_attention_mask,
+                                       output_all_encoded_layers=False)
+        self.assertListEqual(list(sequence_output.size()), [2, 100, model.config.hidden_size])
+
+    def test_long_document_classification(self):
+        config = small_config(hidden_dropout_prob=0.0, attention_probs_dropout_prob=0.0)
+        input_ids = BertModelTest.ids_tensor([2, 3, 9], config.vocab_size)
+        attention_mask = torch.ones_like(input_ids)
+        # The second document has 2 chunks, the last one partially padded
+        attention_mask[1, 1, 5:] = 0
+        attention_mask[1, 2] = 0
+        labels = torch.tensor([1, 0])
+
+        # Micro-batches of chunks recomputed in the backward pass give the same gradients. The recomputation
+        # runs first, before any pass in eval mode
+        model = BertForLongDocumentClassification(config, 3)
+        model.train()
+        gradients = []
+        for chunk_batch_size in (2, None):
+            model.zero_grad()
+            model.chunk_batch_size = chunk_batch_size
+            loss, _ = model(input_ids, attention_mask=attention_mask, labels=labels)
+            loss.backward()
+            gradients.append(model.bert.encoder.layer[0].output.dense.weight.grad.clone())
+        self.assertTrue(torch.allclose(gradients[0], gradients[1], atol=1e-5))
+
+        # Also in a process where the model never ran, with dropout
+        run_in_fresh_process(self, """
+            import torch
+            from pytorch_pretrained_bert import BertForLongDocumentClassification
+            from testing_utils import small_config
+
+            model = BertForLongDocumentClassification(small_config(), 3, chunk_batch_size=2)
+            model.train()
+            loss, _ = model(torch.randint(0, 99, (2, 3, 9)), labels=torch.tensor([1, 0]))
+            loss.backward()
+            assert model.bert.encoder.layer[0].output.dense.weight.grad is not None
+            """)
+
+        model = BertForLongDocumentClassification(config, 3, pooling='mean')
+        model.eval()
+        with torch.no_grad():
+            logits = model(input_ids, attention_mask=attention_mask)
+            _, pooled_output = model.bert(input_ids[1, :2], attention_mask=attention_mask[1, :2],
+                                          output_all_encoded_layers=False)
+            expected_logits = model.classifier(pooled_output.mean(0))
+        self.assertTrue(torch.allclose(logits[1], expected_logits, atol=1e-5))
+
+        model = BertForLongDocumentClassification(config, 3)
+        model.eval()
+        with torch.no_grad():
+            logits = model(input_ids, attention_mask=attention_mask)
+            model.chunk_batch_size = 2
+            self.assertTrue(torch.allclose(model(input_ids, attention_mask=attention_mask), logits, atol=1e-5))
+            # Padding chunks are ignored
+            model.chunk_batch_size = None
+            single_logits = model(input_ids[1:, :2], attention_mask=attention_mask[1:, :2])
+        self.assertTrue(torch.allclose(single_logits[0], logits[1], atol=1e-5))
+
+        # Empty documents, also in batches without any token, are classified from a zero document vector
+        attention_mask[0] = 0
+        for pooling in ('attention', 'mean'):
+            model = BertForLongDocumentClassification(config, 3, pooling=pooling)
+            model.eval()
+            with torch.no_grad():
+                logits = model(input_ids, attention_mask=attention_mask)
+                empty_logits = model(input_ids, attention_mask=torch.zeros_like(attention_mask))
+            self.assertTrue(torch.allclose(logits[0], model.classifier.bias, atol=1e-6))
+            self.assertTrue(torch.allclose(empty_logits, model.classifier.bias.expand(2, -1), atol=1e-6))
+        model.train()
+        loss, _ = model(input_ids, attention_mask=torch.zeros_like(attention_mask), labels=labels)
+        loss.backward()
+        self.assertIsNotNone(model.classifier.bias.grad)
+
+        with self.assertRaises(ValueError):
+            BertForLongDocumentClassification(config, pooling='max')
+
     def run_tester(self, tester):
         output_result = tester.create_model()
         tester.check_output(output_result)
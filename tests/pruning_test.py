@@ -0,0 +1,135 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from pytorch_pretrained_bert import BertForSequenceClassification
+from pytorch_pretrained_bert.pruning import (compute_head_importance, select_heads_to_prune,
+                                              compute_neuron_importance, select_neurons_to_prune)
+
+from testing_utils import small_config
+
+
+def random_batch(batch_size=4, seq_length=7, num_labels=3):
+    input_ids = torch.randint(0, 99, (batch_size, seq_length), dtype=torch.long)
+    input_mask = torch.ones_like(input_ids)
+    segment_ids = torch.zeros_like(input_ids)
+    label_ids = torch.randint(0, num_labels, (batch_size,), dtype=torch.long)
+    return input_ids, input_mask, segment_ids, label_ids
+
+
+class PruningTest(unittest.TestCase):
+
+    def test_prune_heads_save_and_reload(self):
+        model = BertForSequenceClassification(small_config(), num_labels=3)
+        model.eval()
+        model.prune_heads({0: [0, 2], 1: [3]})
+        model.prune_heads({0: [2, 3]})
+
+        attention = model.bert.encoder.layer[0].attention
+        self.assertEqual(attention.self.num_attention_heads, 1)
+        self.assertListEqual(list(attention.self.query.weight.size()), [8, 32])
+        self.assertListEqual(list(attention.output.dense.weight.size()), [32, 8])
+        self.assertEqual(model.bert.encoder.layer[1].attention.self.num_attention_heads, 3)
+        self.assertDictEqual(model.config.pruned_heads, {'0': [0, 2, 3], '1': [3]})
+
+        # Duplicate or out of range indices, and pruning the last head of a layer
+        for heads in ([1, 1], [4], [-1], [1]):
+            with self.assertRaises(ValueError):
+                model.prune_heads({0: heads})
+        self.assertEqual(attention.self.num_attention_heads, 1)
+        self.assertDictEqual(model.config.pruned_heads, {'0': [0, 2, 3], '1': [3]})
+
+        input_ids, input_mask, segment_ids, _ = random_batch()
+        with torch.no_grad():
+            logits = model(input_ids, segment_ids, input_mask)
+
+        save_dir = tempfile.mkdtemp()
+        try:
+            model.save_pretrained(save_dir)
+            reloaded_model = BertForSequenceClassification.from_pretrained(save_dir, num_labels=3)
+        finally:
+            shutil.rmtree(save_dir)
+        reloaded_model.eval()
+        self.assertEqual(reloaded_model.bert.encoder.layer[0].attention.self.num_attention_heads, 1)
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(reloaded_model(input_ids, segment_ids, input_mask), logits, atol=1e-6))
+
+    def test_head_importance(self):
+        model = BertForSequenceClassification(small_config(), num_labels=3)
+        model.prune_heads({1: [1]})
+        head_importance = compute_head_importance(model, [random_batch(), random_batch()])
+        self.assertListEqual([len(scores) for scores in head_importance], [4, 3])
+
+        heads_to_prune = select_heads_to_prune(model, head_importance, num_heads=6)
+        self.assertEqual(sum(len(heads) for heads in heads_to_prune.values()), 5)
+        self.assertNotIn(1, heads_to_prune.get(1, []))
+        model.prune_heads(heads_to_prune)
+        for layer in model.bert.encoder.layer:
+            self.assertEqual(layer.attention.self.num_attention_heads, 1)
+
+    def test_prune_intermediate_neurons_save_and_reload(self):
+        model = BertForSequenceClassification(small_config(), num_labels=3)
+        batch = random_batch()
+        for method in ('activation', 'taylor'):
+            neuron_importance = compute_neuron_importance(model, [batch], method=method)
+            self.assertListEqual([len(scores) for scores in neuron_importance], [37, 37])
+
+        # The scores don't depend on the chunking of the feed-forward blocks
+        model.set_ffn_chunk_size(3)
+        chunked_importance = compute_neuron_importance(model, [batch], method='taylor')
+        model.set_ffn_chunk_size(None)
+        for scores, chunked_scores in zip(neuron_importance, chunked_importance):
+            self.assertTrue(torch.allclose(scores, chunked_scores, rtol=1e-3, atol=1e-4 * scores.max().item()))
+
+        frozen_model = BertForSequenceClassification(small_config(), num_labels=3)
+        frozen_model.freeze_layers(1)
+        with self.assertRaises(ValueError):
+            compute_neuron_importance(frozen_model, [batch], method='taylor')
+        with self.assertRaises(ValueError):
+            compute_head_importance(frozen_model, [batch])
+
+        neurons_to_prune = select_neurons_to_prune(neuron_importance, prune_ratio=0.5)
+        self.assertListEqual([len(neurons) for neurons in neurons_to_prune.values()], [18, 18])
+        neurons_to_prune[1] = neurons_to_prune[1][:10]
+        model.prune_intermediate_neurons(neurons_to_prune)
+        self.assertListEqual(model.config.intermediate_size, [19, 27])
+        self.assertListEqual(list(model.bert.encoder.layer[1].output.dense.weight.size()), [32, 27])
+
+        model.eval()
+        input_ids, input_mask, segment_ids, _ = batch
+        with torch.no_grad():
+            logits = model(input_ids, segment_ids, input_mask)
+        save_dir = tempfile.mkdtemp()
+        try:
+            model.save_pretrained(save_dir)
+            reloaded_model = BertForSequenceClassification.from_pretrained(save_dir, num_labels=3)
+        finally:
+            shutil.rmtree(save_dir)
+        reloaded_model.eval()
+        self.assertEqual(reloaded_model.bert.encoder.layer[0].intermediate.dense.out_features, 19)
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(reloaded_model(input_ids, segment_ids, input_mask), logits, atol=1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from pytorch_pretrained_bert import BertForSequenceClassification
+from pytorch_pretrained_bert.quantization import (accuracy_delta, compare_latency, quantize_static,
+                                                   Int8Embedding, StaticQuantizedLinear)
+
+from testing_utils import small_config, unit_layer_norms, relative_error
+
+
+@unittest.skipIf(not hasattr(torch, 'quantization'), "PyTorch quantization is not available")
+class QuantizationTest(unittest.TestCase):
+
+    def test_quantize_dynamic(self):
+        torch.manual_seed(0)
+        model = unit_layer_norms(BertForSequenceClassification(small_config(), num_labels=3))
+        model.train()
+        quantized_model = model.quantize_dynamic()
+
+        self.assertTrue(model.training)
+        self.assertFalse(quantized_model.training)
+        self.assertIsInstance(model.classifier, torch.nn.Linear)
+        self.assertNotIsInstance(quantized_model.classifier, torch.nn.Linear)
+        self.assertNotIsInstance(quantized_model.bert.encoder.layer[0].intermediate.dense, torch.nn.Linear)
+
+        input_ids = torch.randint(0, 99, (4, 7), dtype=torch.long)
+        input_mask = torch.ones_like(input_ids)
+        segment_ids = torch.zeros_like(input_ids)
+        label_ids = torch.randint(0, 3, (4,), dtype=torch.long)
+        model.eval()
+        with torch.no_grad():
+            logits = model(input_ids, segment_ids, input_mask)
+            quantized_logits = quantized_model(input_ids, segment_ids, input_mask)
+        self.assertListEqual(list(quantized_logits.size()), list(logits.size()))
+        self.assertLess(relative_error(logits, quantized_logits), 0.1)
+
+        result = accuracy_delta(model, quantized_model, [(input_ids, input_mask, segment_ids, label_ids)])
+        self.assertAlmostEqual(result['accuracy_delta'], result['quantized_accuracy'] - result['accuracy'])
+        self.assertTrue(0.0 <= result['agreement'] <= 1.0)
+
+        latency = compare_latency(model, quantized_model, input_ids, segment_ids, input_mask, num_runs=2)
+        self.assertGreater(latency['latency'], 0.0)
+
+    def test_quantize_static_save_and_reload(self):
+        torch.manual_seed(0)
+        model = unit_layer_norms(BertForSequenceClassification(small_config(), num_labels=3))
+        model.eval()
+        input_ids = torch.randint(0, 99, (4, 7), dtype=torch.long)
+        input_mask = torch.ones_like(input_ids)
+        segment_ids = torch.zeros_like(input_ids)
+        calibration_data = [(input_ids, input_mask, segment_ids)]
+
+        quantized_model = quantize_static(model, calibration_data)
+        self.assertIsInstance(quantized_model.bert.embeddings.word_embeddings, Int8Embedding)
+        self.assertIsInstance(quantized_model.bert.encoder.layer[1].output.dense, StaticQuantizedLinear)
+        self.assertIsNone(getattr(model.config, 'quantization', None))
+
+        with torch.no_grad():
+            logits = model(input_ids, segment_ids, input_mask)
+            quantized_logits = quantized_model(input_ids, segment_ids, input_mask)
+        self.assertLess(relative_error(logits, quantized_logits), 0.1)
+
+        save_dir = tempfile.mkdtemp()
+        try:
+            quantized_model.save_pretrained(save_dir)
+            reloaded_model = BertForSequenceClassification.from_pretrained(save_dir, num_labels=3)
+        finally:
+            shutil.rmtree(save_dir)
+        reloaded_model.eval()
+        self.assertIsInstance(reloaded_model.bert.embeddings.word_embeddings, Int8Embedding)
+        with torch.no_grad():
+            reloaded_logits = reloaded_model(input_ids, segment_ids, input_mask)
+        self.assertTrue(torch.allclose(reloaded_logits, quantized_logits))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import torch
+
+from pytorch_pretrained_bert import (BertModel, BertForSequenceClassification,
+                                     BertForQuestionAnswering)
+from pytorch_pretrained_bert.registry import BackboneRegistry, FrozenBackbone, build_task_model
+
+from testing_utils import small_config
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.save_dir = tempfile.mkdtemp()
+        config = small_config()
+        BertModel(config).save_pretrained(self.save_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.save_dir)
+
+    def test_shared_backbone(self):
+        registry = BackboneRegistry()
+        classifier = build_task_model(BertForSequenceClassification, self.save_dir, 3, registry=registry)
+        qa_model = build_task_model(BertForQuestionAnswering, self.save_dir, registry=registry)
+        self.assertIs(classifier.bert, qa_model.bert)
+        self.assertIsNot(classifier.config, qa_model.config)
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(registry.reference_count(classifier.bert), 2)
+
+        # Only the heads are trainable, and the backbone stays in eval mode
+        classifier.train()
+        self.assertIsInstance(classifier.bert, FrozenBackbone)
+        self.assertFalse(any(module.training for module in classifier.bert.modules()))
+        self.assertFalse(classifier.bert.backbone.training)
+        self.assertListEqual(list(classifier.state_dict().keys()),
+                             list(BertForSequenceClassification(small_config(), 3).state_dict().keys()))
+        self.assertTrue(classifier.classifier.training)
+        self.assertListEqual([name for name, param in classifier.named_parameters() if param.requires_grad],
+                             ['classifier.weight', 'classifier.bias'])
+        input_ids = torch.randint(0, 99, (2, 7), dtype=torch.long)
+        loss, _ = classifier(input_ids, labels=torch.tensor([0, 2]))
+        loss.backward()
+        self.assertIsNotNone(classifier.classifier.weight.grad)
+
+        usage = registry.memory_usage()
+        self.assertEqual(usage['num_references'], 2)
+        self.assertEqual(usage['saved_bytes'], usage['backbones_bytes'])
+
+        registry.release(qa_model.bert)
+        registry.release(classifier.bert)
+        self.assertEqual(len(registry), 0)
+        with self.assertRaises(ValueError):
+            registry.release(classifier.bert)
+
+    def test_concurrent_acquire(self):
+        loading = threading.Event()
+        done = threading.Event()
+        loaded_names = []
+
+        class BlockingRegistry(BackboneRegistry):
+            def _load(self, pretrained_model_name, device=None, dtype=None):
+                loaded_names.append(pretrained_model_name)
+                loading.set()
+                done.wait()
+                return super(BlockingRegistry, self)._load(pretrained_model_name, device=device, dtype=dtype)
+
+        registry = BlockingRegistry()
+        backbones = []
+        threads = [threading.Thread(target=lambda: backbones.append(registry.acquire(self.save_dir)))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        loading.wait()
+        # The registry lock isn't held while the backbone is loaded
+        self.assertTrue(registry._lock.acquire(timeout=5))
+        registry._lock.release()
+        self.assertEqual(len(registry), 0)
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(loaded_names), 1)
+        self.assertEqual(len(backbones), 3)
+        self.assertTrue(all(backbone is backbones[0] for backbone in backbones))
+        self.assertEqual(registry.reference_count(backbones[0]), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
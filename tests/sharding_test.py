@@ -0,0 +1,78 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from pytorch_pretrained_bert import BertModel, BertForPreTraining
+from pytorch_pretrained_bert.sharding import parse_size, shard_state_dict, read_index, load_sharded_checkpoint
+
+from testing_utils import small_config
+
+
+class ShardingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.save_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.save_dir)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size(123), 123)
+        self.assertEqual(parse_size("500MB"), 500 * 10 ** 6)
+        self.assertEqual(parse_size("2GiB"), 2 * 2 ** 30)
+        with self.assertRaises(ValueError):
+            parse_size("12 parsecs")
+
+    def test_shard_state_dict(self):
+        state_dict = {'a': torch.zeros(10), 'b': torch.zeros(30), 'c': torch.zeros(5), 'd': torch.zeros(5)}
+        shards = shard_state_dict(state_dict, 100)
+        self.assertListEqual([list(shard.keys()) for shard in shards], [['a'], ['b'], ['c', 'd']])
+
+    def test_sharded_pretrained_model(self):
+        config = small_config()
+        model = BertForPreTraining(config)
+        model.eval()
+        model.save_pretrained(self.save_dir, max_shard_size="20KB")
+        weight_map = read_index(os.path.join(self.save_dir, 'pytorch_model.bin.index.json'))
+        shard_files = set(weight_map.values())
+        self.assertGreater(len(shard_files), 2)
+        self.assertTrue(all(os.path.exists(os.path.join(self.save_dir, shard_file)) for shard_file in shard_files))
+
+        # Partial load: only the tensors of the encoder
+        encoder_keys = [key for key in weight_map if key.startswith('bert.encoder.')]
+        state_dict = load_sharded_checkpoint(os.path.join(self.save_dir, 'pytorch_model.bin.index.json'),
+                                             keys=encoder_keys, num_workers=4)
+        self.assertListEqual(list(state_dict.keys()), encoder_keys)
+
+        bert = BertModel.from_pretrained(self.save_dir)
+        bert.eval()
+        input_ids = torch.randint(0, 99, (2, 7), dtype=torch.long)
+        with torch.no_grad():
+            _, pooled_output = model.bert(input_ids)
+            _, reloaded_pooled_output = bert(input_ids)
+        self.assertTrue(torch.allclose(pooled_output, reloaded_pooled_output, atol=1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
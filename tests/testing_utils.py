@@ -0,0 +1,70 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import textwrap
+
+from pytorch_pretrained_bert import BertConfig
+from pytorch_pretrained_bert.modeling import BertLayerNorm
+
+
+def small_config(**kwargs):
+    """Creates a tiny BertConfig for fast tests. Keyword arguments override the defaults."""
+    config_kwargs = dict(vocab_size_or_config_json_file=99,
+                         hidden_size=32,
+                         num_hidden_layers=2,
+                         num_attention_heads=4,
+                         intermediate_size=37,
+                         max_position_embeddings=64,
+                         type_vocab_size=2)
+    config_kwargs.update(kwargs)
+    return BertConfig(**config_kwargs)
+
+
+def unit_layer_norms(model):
+    """Sets the LayerNorm scales to 1 and shifts to 0. They are initialized like the other weights
+    (N(0, initializer_range)), which makes the outputs of a randomly initialized model vanishingly small.
+    """
+    for module in model.modules():
+        if isinstance(module, BertLayerNorm):
+            module.gamma.data.fill_(1.0)
+            module.beta.data.zero_()
+    return model
+
+
+def relative_error(expected, actual):
+    """Largest absolute difference between two tensors, relative to the largest magnitude of `expected`."""
+    return ((expected - actual).abs().max() / expected.abs().max()).item()
+
+
+def run_in_fresh_process(test_case, source):
+    """Runs the Python `source` in a new interpreter, for code whose behavior depends on process-wide state
+    (e.g. the warm-up of the TorchScript executor), and fails `test_case` with its output if it raises.
+    `testing_utils` and `pytorch_pretrained_bert` can be imported from `source`.
+    """
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    python_path = [tests_dir, os.path.dirname(tests_dir)]
+    if os.environ.get('PYTHONPATH'):
+        python_path.append(os.environ['PYTHONPATH'])
+    process = subprocess.run([sys.executable, '-c', textwrap.dedent(source)],
+                             env=dict(os.environ, PYTHONPATH=os.pathsep.join(python_path)),
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if process.returncode != 0:
+        test_case.fail(process.stdout)
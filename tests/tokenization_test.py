@@ -20,7 +20,7 @@ import os
 import unittest
 
 from pytorch_pretrained_bert.tokenization import (BertTokenizer, BasicTokenizer, WordpieceTokenizer,
-                                                  _is_whitespace, _is_control, _is_punctuation)
+                                                  _is_whitespace, _is_control, _is_punctuation, chunk_tokens)
 
 
 class TokenizationTest(unittest.TestCase):
@@ -86,6 +86,20 @@ class TokenizationTest(unittest.TestCase):
         self.assertListEqual(
             tokenizer.tokenize("unwantedX running"), ["[UNK]", "runn", "##ing"])
 
+    def test_chunk_tokens(self):
+        tokens = ["t%d" % i for i in range(7)]
+        self.assertListEqual(
+            chunk_tokens(tokens, 5),
+            [["[CLS]", "t0", "t1", "t2", "[SEP]"], ["[CLS]", "t3", "t4", "t5", "[SEP]"], ["[CLS]", "t6", "[SEP]"]])
+        self.assertListEqual(
+            chunk_tokens(tokens, 6, doc_stride=2),
+            [["[CLS]", "t0", "t1", "t2", "t3", "[SEP]"], ["[CLS]", "t2", "t3", "t4", "t5", "[SEP]"],
+             ["[CLS]", "t4", "t5", "t6", "[SEP]"]])
+        self.assertListEqual(chunk_tokens([], 5), [["[CLS]", "[SEP]"]])
+        for doc_stride in (0, -1, 4):
+            with self.assertRaises(ValueError):
+                chunk_tokens(tokens, 5, doc_stride=doc_stride)
+
     def test_is_whitespace(self):
         self.assertTrue(_is_whitespace(u" "))
         self.assertTrue(_is_whitespace(u"\t"))